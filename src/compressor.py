@@ -0,0 +1,91 @@
+import zlib
+from struct import Struct
+
+from utils import ESocket
+from constants import MB, KB
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# 压缩数据按块传输，每块前为该块压缩后的大小，等于原始大小时表示该块未压缩
+COMPRESS_BLOCK_SIZE = MB
+COMPRESS_SAMPLE_SIZE = 64 * KB
+block_struct = Struct('>I')
+
+# 本身已经压缩过的文件格式，不再尝试压缩
+COMPRESSED_SUFFIXES = frozenset(
+    ['.7z', '.zip', '.rar', '.gz', '.tgz', '.bz2', '.xz', '.txz', '.zst', '.lz4', '.br', '.jar', '.apk', '.cab',
+     '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif', '.mp3', '.aac', '.ogg', '.opus', '.flac', '.m4a',
+     '.mp4', '.mkv', '.mov', '.avi', '.webm', '.wmv', '.flv', '.docx', '.xlsx', '.pptx', '.pdf', '.epub'])
+
+
+def available_codecs() -> list[str]:
+    """
+    本机可用的压缩算法，按优先级排列
+    """
+    return [name for name, module in (('zstd', zstandard), ('lz4', lz4), ('zlib', zlib)) if module]
+
+
+class BlockCodec:
+    """
+    按块压缩/解压文件数据，每块相互独立，因此文件的任意分段都可以单独压缩传输
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        if name == 'zstd':
+            self.__compress = zstandard.ZstdCompressor(level=3).compress
+            self.__decompress = lambda data, size: zstandard.ZstdDecompressor().decompress(data,
+                                                                                         max_output_size=size)
+        elif name == 'lz4':
+            self.__compress = lz4.frame.compress
+            self.__decompress = lambda data, size: lz4.frame.decompress(data)
+        else:
+            self.__compress = lambda data: zlib.compress(data, 1)
+            self.__decompress = lambda data, size: zlib.decompressobj().decompress(data, size)
+
+    def compressible(self, filename: str, sample) -> bool:
+        """
+        根据文件后缀及首块样本的压缩率判断是否值得压缩
+        """
+        if filename[filename.rfind('.'):].lower() in COMPRESSED_SUFFIXES or not len(sample):
+            return False
+        sample = sample[:COMPRESS_SAMPLE_SIZE]
+        return len(self.__compress(sample)) < len(sample) * 0.9
+
+    def send(self, conn: ESocket, data):
+        """
+        将数据分块压缩后发送，压缩无效的块直接发送原始数据
+        """
+        view = memoryview(data)
+        for offset in range(0, len(view), COMPRESS_BLOCK_SIZE):
+            block = view[offset:offset + COMPRESS_BLOCK_SIZE]
+            if len(compressed := self.__compress(block)) >= len(block):
+                compressed = block
+            conn.sendall(block_struct.pack(len(compressed)))
+            conn.sendall(compressed)
+
+    def recv_into(self, conn: ESocket, buffer, size: int) -> int:
+        """
+        接收一块数据并解压到缓冲区中
+
+        @param size: 该块的原始大小
+        @return: 解压后的大小
+        """
+        view = memoryview(buffer)
+        compressed_size = block_struct.unpack(conn.recv_data(block_struct.size))[0]
+        if compressed_size == size:
+            return conn.recv_into(view, size)
+        if compressed_size > size:
+            raise ValueError(f'Invalid compressed block size: {compressed_size}')
+        data = self.__decompress(conn.recv_data(compressed_size), size)
+        if len(data) != size:
+            raise ValueError(f'Decompressed block size mismatch: {len(data)} != {size}')
+        view[:size] = data
+        return size
@@ -1,6 +1,6 @@
 import sys
 import psutil
-from enum import IntEnum, StrEnum, auto
+from enum import IntEnum, IntFlag, StrEnum, auto
 from struct import Struct
 from typing import Final
 from platform import system
@@ -17,6 +17,49 @@ cpu_count = psutil.cpu_count(logical=False) or 2
 
 LARGE_FILE_SIZE_THRESHOLD = 20  # 1024 * 1024
 SMALL_FILE_CHUNK_SIZE = 21  # 1024 * 1024 * 2
+SMALL_BATCH_MAX_SIZE = 24  # 1024 * 1024 * 16
+STRIPE_FILE_SIZE_THRESHOLD = 24  # 1024 * 1024 * 16
+FILE_SEGMENT_SIZE = 26  # 1024 * 1024 * 64
+RESUME_CHUNK_SIZE = 22  # 1024 * 1024 * 4
+DELTA_SYNC_SIZE_THRESHOLD = 24  # 1024 * 1024 * 16
+# 扫描文件夹时每批核对的文件数，以及发送队列中最多积压的批数
+SCAN_BATCH_SIZE = 1000
+MAX_QUEUED_BATCHES = 64
+# 并行扫描文件夹的线程数，网络文件系统及机械硬盘上并行枚举目录更快
+SCAN_WORKERS = 16
+# 发送一批小文件的目标耗时(秒)，据此调整每批的大小
+SMALL_BATCH_TIME = 0.5
+# 发送方预先读取小文件的线程数及每个连接预读的批数，大文件提前提示内核预读的长度
+READER_THREADS = 4
+PREFETCH_BATCHES = 2
+READ_AHEAD_SIZE = 23  # 1024 * 1024 * 8
+# 接收方写入文件的线程数，已接收、等待写入的小文件最多批数，以及接收大文件所用的缓冲区数 (每个 1MB)
+WRITER_THREADS = 4
+MAX_PENDING_WRITES = 16
+MAX_WRITE_BUFFERS = 64
+# 数据连接断开后重新连接的次数及间隔(秒)，等待对方重新连接的超时时间(秒)
+RECONNECT_ATTEMPTS = 5
+RECONNECT_INTERVAL = 2
+RECONNECT_TIMEOUT = 120
+# 本方正在收发其他文件时，接收方等待的秒数；对方正忙时发送任务重试前最多等待的秒数
+BUSY_TIMEOUT = 5
+BUSY_RETRY_INTERVAL = 3
+# 自动调整数据连接数：每轮测量的最短秒数，吞吐量变化超过该比例才视为有效，保持的轮数，最多的连接数，
+# 往返时延(秒)达到该值时视为高时延链路
+TUNE_INTERVAL = 2
+TUNE_GAIN = 0.05
+TUNE_HOLD_ROUNDS = 5
+MAX_CONNECTIONS = 64
+HIGH_LATENCY_RTT = 0.02
+# 数据连接缓冲区的上限，以及非 Linux 系统自动调整缓冲区能达到的大小的估计值
+MAX_SOCKET_BUFFER = 26  # 1024 * 1024 * 64
+SOCKET_BUFFER_AUTOTUNE = 22  # 1024 * 1024 * 4
+# 测速时反复发送的预生成数据块的大小，以及每个数据连接上测量往返时延的次数
+SPEEDTEST_CHUNK_SIZE = 20  # 1024 * 1024
+PING_COUNT = 20
+# 计算哈希的文件数达到该值时按批交给进程池计算
+HASH_PROCESS_THRESHOLD = 1000
+HASH_BATCH_SIZE = 64
 KB = 1024
 MB = 1024 * KB
 FILE_TAIL_SIZE = 512 * KB
@@ -55,6 +98,9 @@ class COMMAND(IntEnum):
     FINISH = auto()
     PUSH_CLIPBOARD = auto()
     PULL_CLIPBOARD = auto()
+    SEND_STRIPED_FILE = auto()
+    SEND_FILE_RANGE = auto()
+    ADD_CONNECTION = auto()
 
 
 # 控制类型
@@ -64,6 +110,32 @@ class CONTROL(IntEnum):
     FAIL2OPEN = -2
 
 
+# 文件数据前的标记：数据是否压缩，数据后是否附带摘要
+class DATA_FLAG(IntFlag):
+    COMPRESSED = 1
+    DIGEST = 2
+
+
+# 发送任务的状态
+class JOB_STATUS(StrEnum):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+# 数据连接的通道类型
+class DATA_CHANNEL(StrEnum):
+    TLS = 'tls'
+    KTLS = 'ktls'
+    PLAIN = 'plain'
+
+
+# Linux 内核 TLS 的套接字选项层级及发送方向的加密参数，用于确认内核是否已接管连接的加密
+SOL_TLS: Final[int] = 282
+TLS_TX: Final[int] = 1
+
+
 # 其他常量
 FAIL: Final[str] = 'fail'
 GET: Final[str] = 'get'
@@ -81,7 +153,8 @@ cp: Final[str] = "cp"
 say: Final[str] = 'say'
 clipboard_send: Final[str] = 'send clipboard'
 clipboard_get: Final[str] = 'get clipboard'
-commands = [sysinfo, compare, speedtest, setbase, say, history, clipboard_send, clipboard_get, force_sync]
+jobs: Final[str] = 'jobs'
+commands = [sysinfo, compare, speedtest, setbase, say, history, clipboard_send, clipboard_get, force_sync, jobs]
 sn_commands = [sysinfo, compare, history, force_sync, cp]
 
 # Struct 对象
@@ -93,3 +166,6 @@ sn_commands = [sysinfo, compare, history, force_sync, cp]
 head_struct = Struct('>BQH')
 size_struct = Struct('q')
 times_struct = Struct('ddd')
+range_struct = Struct('qq')
+# Linux tcp_info 结构的开头部分，第 24 个字段为平滑往返时延 (微秒)
+tcp_info_struct = Struct('8B17I')
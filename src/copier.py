@@ -0,0 +1,164 @@
+import errno
+import os
+import threading
+from enum import IntEnum
+from typing import Callable
+
+from constants import windows, MB
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Linux 上克隆整个文件的 ioctl 请求号，btrfs/XFS 等支持写时复制的文件系统可共享数据块而不实际拷贝
+FICLONE = 0x40049409
+# 每次调用内核拷贝的长度，也是更新进度的粒度
+COPY_CHUNK_SIZE = 23  # 1024 * 1024 * 8
+# 内核拷贝不可用时，用户态拷贝所用缓冲区的大小
+COPY_BUFFER_SIZE = 4 * MB
+# 表示平台或文件系统不支持该拷贝方式的错误码，遇到后不再尝试该方式
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)}
+# 只表示本次调用无法使用该方式的错误码 (如区间重叠、个别文件或文件系统不支持)，本次改用下一种方式，之后仍会尝试
+FALLBACK_ERRNOS = {errno.EINVAL, errno.ENOTTY}
+
+
+class COPY_METHOD(IntEnum):
+    REFLINK = 0
+    COPY_FILE_RANGE = 1
+    SENDFILE = 2
+
+
+class CopyEngine:
+    """
+    本地文件拷贝，依次尝试：写时复制克隆 (FICLONE)、os.copy_file_range、os.sendfile，最后使用大缓冲区读写。
+    平台或文件系统不支持某种方式时记录下来，之后的文件直接使用下一种方式；各区间可由多个线程并行拷贝
+    """
+
+    def __init__(self):
+        # 当前可用的拷贝方式
+        self.__methods = {method for method, available in (
+            (COPY_METHOD.REFLINK, fcntl is not None and not windows),
+            (COPY_METHOD.COPY_FILE_RANGE, hasattr(os, 'copy_file_range')),
+            (COPY_METHOD.SENDFILE, hasattr(os, 'sendfile') and not windows)) if available}
+        self.__lock = threading.Lock()
+
+    def __fall_back(self, method: COPY_METHOD, error: OSError) -> bool:
+        """
+        拷贝方式失败时判断能否改用下一种方式，错误表明不被支持时停用该方式
+
+        @return: 能否改用下一种方式，不能时调用方应抛出该错误
+        """
+        if error.errno in FALLBACK_ERRNOS:
+            return True
+        if error.errno not in UNSUPPORTED_ERRNOS:
+            return False
+        with self.__lock:
+            self.__methods.discard(method)
+        return True
+
+    def clone(self, source_fd: int, target_fd: int) -> bool:
+        """
+        尝试以写时复制的方式克隆整个文件
+
+        @return: 是否克隆成功，失败时目标文件内容不变
+        """
+        if COPY_METHOD.REFLINK not in self.__methods:
+            return False
+        try:
+            fcntl.ioctl(target_fd, FICLONE, source_fd)
+            return True
+        except OSError as error:
+            if not self.__fall_back(COPY_METHOD.REFLINK, error):
+                raise
+            return False
+
+    def copy_range(self, source_fd: int, target_fd: int, offset: int, count: int,
+                   update: Callable[[int], None] = None):
+        """
+        将源文件 [offset, offset + count) 的数据写入目标文件的相同位置，不依赖文件的当前位置
+
+        @param update: 每拷贝一段后以该段长度调用，用于更新进度
+        """
+        end = offset + count
+        if COPY_METHOD.COPY_FILE_RANGE in self.__methods:
+            offset = self.__kernel_copy(source_fd, target_fd, offset, end, update)
+        if offset < end and COPY_METHOD.SENDFILE in self.__methods:
+            offset = self.__send_copy(source_fd, target_fd, offset, end, update)
+        if offset < end:
+            self.__buffer_copy(source_fd, target_fd, offset, end, update)
+
+    def __kernel_copy(self, source_fd: int, target_fd: int, offset: int, end: int, update) -> int:
+        """
+        @return: 拷贝到的位置，该方式不被支持时提前返回
+        """
+        while offset < end:
+            try:
+                size = os.copy_file_range(source_fd, target_fd, min(end - offset, 1 << COPY_CHUNK_SIZE),
+                                          offset, offset)
+            except OSError as error:
+                if not self.__fall_back(COPY_METHOD.COPY_FILE_RANGE, error):
+                    raise
+                return offset
+            if not size:
+                raise EOFError(f'Source file truncated at {offset}')
+            offset += size
+            if update:
+                update(size)
+        return offset
+
+    def __send_copy(self, source_fd: int, target_fd: int, offset: int, end: int, update) -> int:
+        """
+        sendfile 写入目标文件的当前位置，因此每个区间需使用各自打开的目标文件
+
+        @return: 拷贝到的位置，该方式不被支持时提前返回
+        """
+        os.lseek(target_fd, offset, os.SEEK_SET)
+        while offset < end:
+            try:
+                size = os.sendfile(target_fd, source_fd, offset, min(end - offset, 1 << COPY_CHUNK_SIZE))
+            except OSError as error:
+                if not self.__fall_back(COPY_METHOD.SENDFILE, error):
+                    raise
+                return offset
+            if not size:
+                raise EOFError(f'Source file truncated at {offset}')
+            offset += size
+            if update:
+                update(size)
+        return offset
+
+    @staticmethod
+    def __buffer_copy(source_fd: int, target_fd: int, offset: int, end: int, update):
+        view = memoryview(bytearray(COPY_BUFFER_SIZE))
+        with open(source_fd, 'rb', buffering=0, closefd=False) as sfp, \
+                open(target_fd, 'wb', buffering=0, closefd=False) as tfp:
+            sfp.seek(offset)
+            tfp.seek(offset)
+            while offset < end:
+                if not (size := sfp.readinto(view[:min(end - offset, COPY_BUFFER_SIZE)])):
+                    raise EOFError(f'Source file truncated at {offset}')
+                written = 0
+                while written < size:
+                    written += tfp.write(view[written:size])
+                offset += size
+                if update:
+                    update(size)
+
+    def copy_file(self, source: str, target: str, file_size: int, update: Callable[[int], None] = None):
+        """
+        拷贝单个文件的内容，目标文件已存在时覆盖
+        """
+        source_fd = os.open(source, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            target_fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+            try:
+                if self.clone(source_fd, target_fd):
+                    if update:
+                        update(file_size)
+                    return
+                self.copy_range(source_fd, target_fd, 0, file_size, update)
+            finally:
+                os.close(target_fd)
+        finally:
+            os.close(source_fd)
@@ -0,0 +1,128 @@
+"""
+fsync 中较大文件的差量同步：接收方发送旧文件每一块的签名，发送方只发送本地文件中与旧文件不同的块。
+
+块只在对齐的偏移上比较，适用于原地修改、在末尾追加或截断的文件；在文件中间插入或删除数据后，
+其后的块整体错位，无法匹配到旧文件中的块，全部作为新数据发送
+"""
+import zlib
+from enum import IntEnum
+from hashlib import blake2b
+from struct import Struct
+
+from utils import ESocket
+from constants import KB, MB
+
+# 差量同步的最小块大小，文件越大块越大，使每个文件的块签名数不超过约 64K 个
+DELTA_MIN_BLOCK_SIZE = 64 * KB
+# 块签名：弱校验 adler32 + 强校验 blake2b
+signature_struct = Struct('>I16s')
+# 差量指令：指令类型，旧文件中的偏移，长度
+delta_struct = Struct('>Bqq')
+
+
+class DELTA(IntEnum):
+    COPY = 0  # 复用旧文件中的数据
+    DATA = 1  # 之后紧跟新数据
+    END = 2
+    ABORT = 3
+
+
+def delta_block_size(file_size: int) -> int:
+    return max(DELTA_MIN_BLOCK_SIZE, 1 << (file_size >> 16).bit_length())
+
+
+def strong_digest(block) -> bytes:
+    return blake2b(block, digest_size=16).digest()
+
+
+def send_signatures(conn: ESocket, fp, file_size: int):
+    """
+    接收方计算旧文件每一块的签名并发送给发送方
+    """
+    block_size = delta_block_size(file_size)
+    signatures = bytearray()
+    view = memoryview(buffer := bytearray(block_size))
+    while size := fp.readinto(buffer):
+        block = view[:size]
+        signatures += signature_struct.pack(zlib.adler32(block), strong_digest(block))
+    conn.send_size(block_size)
+    conn.send_data_with_size(signatures)
+
+
+def send_delta(conn: ESocket, fp, pbar) -> int:
+    """
+    发送方接收旧文件的块签名，将本地文件按块与之比较，相同的块只发送复用指令，其余块发送数据
+
+    块按对齐的偏移比较，适用于原地修改的大文件（虚拟机镜像、数据库等）；
+    逐字节滚动匹配在 Python 中对大文件过慢，因此未采用，插入或删除数据后的块无法复用
+
+    @return: 实际发送的数据大小
+    """
+    block_size = conn.recv_size()
+    signatures = conn.recv_data(conn.recv_size())
+    blocks: dict[int, dict[bytes, int]] = {}
+    for index, (weak, strong) in enumerate(signature_struct.iter_unpack(signatures)):
+        blocks.setdefault(weak, {}).setdefault(strong, index * block_size)
+    view = memoryview(buffer := bytearray(block_size))
+    copy_offset = copy_size = sent_size = 0
+    while size := fp.readinto(buffer):
+        block = view[:size]
+        # 先以弱校验筛选，命中后再比较强校验
+        candidates = blocks.get(zlib.adler32(block))
+        offset = candidates.get(strong_digest(block)) if candidates else None
+        if offset is not None:
+            # 合并旧文件中连续的复用块
+            if copy_size and copy_offset + copy_size == offset:
+                copy_size += size
+            else:
+                if copy_size:
+                    conn.sendall(delta_struct.pack(DELTA.COPY, copy_offset, copy_size))
+                copy_offset, copy_size = offset, size
+        else:
+            if copy_size:
+                conn.sendall(delta_struct.pack(DELTA.COPY, copy_offset, copy_size))
+                copy_size = 0
+            conn.sendall(delta_struct.pack(DELTA.DATA, 0, size))
+            conn.sendall(block)
+            sent_size += size
+        pbar.update(size)
+    if copy_size:
+        conn.sendall(delta_struct.pack(DELTA.COPY, copy_offset, copy_size))
+    conn.sendall(delta_struct.pack(DELTA.END, 0, 0))
+    return sent_size
+
+
+def recv_delta(conn: ESocket, old_fp, new_fp) -> bool:
+    """
+    接收方按差量指令由旧文件和新数据生成新文件，写入失败时仍接收完所有指令
+
+    @return: 新文件是否生成成功，发送方中止时为 None
+    """
+    view = memoryview(buffer := bytearray(MB))
+    success = True
+    while True:
+        op, offset, size = delta_struct.unpack(conn.recv_data(delta_struct.size))
+        if op == DELTA.END:
+            return success
+        if op == DELTA.ABORT:
+            return None
+        if op == DELTA.COPY:
+            try:
+                old_fp.seek(offset)
+                while size > 0:
+                    read_size = old_fp.readinto(view[:min(size, MB)])
+                    if not read_size:
+                        raise EOFError
+                    new_fp.write(view[:read_size])
+                    size -= read_size
+            except (OSError, EOFError):
+                success = False
+            continue
+        while size > 0:
+            received_size = conn.recv_into(view, min(size, MB))
+            size -= received_size
+            if success:
+                try:
+                    new_fp.write(view[:received_size])
+                except OSError:
+                    success = False
@@ -1,13 +1,20 @@
 import ssl
 import os.path
 import readline
+import concurrent.futures
 
 from pbar_manager import PbarManager
+from compressor import *
+from delta import *
 from utils import *
+from mux import *
+from tuner import ConnectionTuner
+from speedtest import SpeedTest
 from tqdm import tqdm
 from sys_info import *
 from pathlib import Path
 from collections import deque
+from dataclasses import dataclass
 from shutil import get_terminal_size
 
 
@@ -18,47 +25,50 @@ def print_history(nums=10):
         print(readline.get_history_item(i))
 
 
-def get_dir_file_name(filepath, desc_suffix='files', position=0):
+def read_files(base_dir, files_info, total_size: int) -> tuple[memoryview, list, list[str]]:
     """
-    获取某文件路径下的所有文件夹和文件的相对路径，并显示进度条。
-    :param desc_suffix: 描述后缀
-    :param position: 进度条位置
-    :param filepath: 文件路径
-    :return: 返回该文件路径下的所有文件夹、文件的相对路径
-    """
-    folders, files = {}, []
-    root_abs_path = os.path.abspath(filepath)
-    queue = deque([(root_abs_path, '.')])
-    processed_paths = set()
-
-    # 初始化进度显示
-    pbar = tqdm(desc=f"Scanning {desc_suffix}", unit=" files", position=position, dynamic_ncols=True)
+    将一批小文件依次读入同一个缓冲区，各文件按扫描时的大小占位，使对方按偏移拆分时不会错位
 
-    while queue:
-        current_abs_path, current_rel_path = queue.popleft()
-        if current_abs_path in processed_paths:
+    @return: 读入的数据，成功读入的文件信息，无法打开的文件
+    """
+    view = memoryview(bytearray(total_size))
+    read_files_info, failed_files, offset = [], [], 0
+    for info in files_info:
+        filename, file_size, _ = info
+        try:
+            with open(PurePath(base_dir, filename), 'rb') as fp:
+                fp.readinto(view[offset:offset + file_size])
+        except OSError:
+            failed_files.append(filename)
             continue
-        processed_paths.add(current_abs_path)
+        read_files_info.append(info)
+        offset += file_size
+    return view[:offset], read_files_info, failed_files
 
-        stat = os.stat(current_abs_path)
-        folders[current_rel_path] = (stat.st_atime, stat.st_mtime)
 
+def advise_read_ahead(fp, offset: int, count: int):
+    """
+    提示内核提前读入文件的指定区间，使磁盘寻道及网络文件系统的延迟与发送重叠；不支持的平台忽略
+    """
+    if hasattr(os, 'posix_fadvise') and count > 0:
         try:
-            with os.scandir(current_abs_path) as it:
-                for entry in it:
-                    entry_rel_path = f"{current_rel_path}/{entry.name}" if current_rel_path != '.' else entry.name
-                    if entry.is_dir(follow_symlinks=False):
-                        queue.append((entry.path, entry_rel_path))
-                    elif entry.is_file(follow_symlinks=False):
-                        files.append(entry_rel_path)
-                        pbar.update(1)
-        except PermissionError:
-            continue
+            os.posix_fadvise(fp.fileno(), offset, count, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+
 
-    # 更新进度条描述
-    pbar.set_postfix(folders=len(folders))
-    pbar.close()
-    return folders, files
+def adapt_batch_size(batch_size: int, elapsed: float) -> int:
+    """
+    按发送上一批小文件的耗时调整批次大小：耗时短说明每批的固定开销占比高，增大批次；
+    耗时长时减小批次，使各连接的负载更均衡
+
+    @param elapsed: 发送上一批所用的秒数
+    """
+    if elapsed < SMALL_BATCH_TIME / 4:
+        return min(batch_size * 2, 1 << SMALL_BATCH_MAX_SIZE)
+    if elapsed > SMALL_BATCH_TIME:
+        return max(batch_size // 2, 1 << SMALL_FILE_CHUNK_SIZE)
+    return batch_size
 
 
 def split_by_threshold(info):
@@ -75,6 +85,30 @@ def split_by_threshold(info):
     return result
 
 
+def split_into_ranges(start: int, end: int, parts: int) -> list[tuple[int, int]]:
+    """
+    将文件区间 [start, end) 尽量均匀地切分为至多 parts 段，段边界按续传的块大小对齐
+
+    @param start: 起始偏移
+    @param end: 结束偏移
+    @param parts: 最多切分的段数
+    @return: (偏移, 长度) 列表
+    """
+    chunk_size = 1 << RESUME_CHUNK_SIZE
+    step = max(-(-(end - start) // parts), chunk_size)
+    step = -(-step // chunk_size) * chunk_size
+    return [(offset, min(step, end - offset)) for offset in range(start, end, step)]
+
+
+def split_missing_ranges(missing_ranges: list[tuple[int, int]], parts: int) -> list[tuple[int, int]]:
+    """
+    将对方尚未接收的各个区间按大小比例切分，总共约 parts 段
+    """
+    total_size = sum(count for _, count in missing_ranges)
+    return [segment for offset, count in missing_ranges for segment in
+            split_into_ranges(offset, offset + count, -(-parts * count // total_size))]
+
+
 def alternate_first_last(input_list):
     """
     Place the first and last elements of input list alternatively
@@ -93,43 +127,82 @@ def alternate_first_last(input_list):
     return result
 
 
-def collect_files_info(logger: Logger, files: set[str], root: str):
+def collect_files_info(logger: Logger, files_info: list, root: str):
     # 将待发送的文件打印到日志，计算待发送的文件总大小
     msgs = [f'\n[INFO   ] {get_log_msg("Files to be sent: ")}\n']
-    # 统计待发送的文件信息
+    # 按扫描时得到的文件信息统计，不再重复 stat
     total_size = 0
     large_files_info, small_files_info = [], []
-    for file in tqdm(files, delay=0.1, desc='collect files info', unit='files', mininterval=0.2, leave=False):
-        real_path = Path(root, file)
-        file_size = (file_stat := real_path.stat()).st_size
-        info = file, file_size, (file_stat.st_ctime, file_stat.st_mtime, file_stat.st_atime)
+    for info in files_info:
+        file, file_size, _ = info
         # 记录每个文件大小
         large_files_info.append(info) if file_size >> LARGE_FILE_SIZE_THRESHOLD else small_files_info.append(info)
         total_size += file_size
-        msgs.append(f"{real_path}, {file_size}B\n")
+        msgs.append(f"{PurePath(root, file)}, {file_size}B\n")
     logger.silent_write(msgs)
     random.shuffle(small_files_info)
     large_files_info = deque(alternate_first_last(sorted(large_files_info, key=lambda item: item[1])))
     small_files_info = deque(split_by_threshold(small_files_info))
-    logger.info(f'Send files under {root}, number: {len(files)}')
+    logger.info(f'Send files under {root}, number: {len(files_info)}')
     # 初始化总进度条
     pbar = tqdm(total=total_size, desc='total', unit='bytes', unit_scale=True,
                 mininterval=1, position=0, colour='#01579B', unit_divisor=1024)
     return large_files_info, small_files_info, total_size, pbar
 
 
+class PeerBusyError(Exception):
+    pass
+
+
+# 源文件在发送过程中被截短，对方收不到该段剩余的数据，只能断开数据连接后重新连接
+class SourceTruncatedError(ConnectionError):
+    pass
+
+
+@dataclass
+class SendJob:
+    """
+    排队发送的文件或文件夹，同一时间只有一个任务使用所有数据连接发送
+    """
+    job_id: int
+    path: Path
+    status: JOB_STATUS = JOB_STATUS.QUEUED
+    pbar: PbarManager | None = None
+    elapsed: float = 0
+
+
 class FTC:
     def __init__(self, ftt):
         self.__ftt = ftt
         self.__pbar: PbarManager = ...
         self.__base_dir: Path = ...
-        self.__main_conn: ESocket = ftt.main_conn
+        self.__main_conn: Multiplexer = ftt.main_conn
         self.__connections: list[ESocket] = ftt.connections
         self.__command_prefix: str = 'powershell ' if ftt.peer_platform == WINDOWS else ''
         self.logger: Logger = ftt.logger
         self.__large_files_info: deque = deque()
         self.__small_files_info: deque = deque()
         self.__finished_files: deque = deque()
+        # 大文件切分出的待发送分段 (文件名, 偏移, 长度) 以及每个文件剩余未发送的分段数
+        self.__file_segments: deque = deque()
+        self.__segments_remained: dict[str, int] = {}
+        self.__segments_lock: threading.Lock = threading.Lock()
+        # 预先读取小文件批次的线程池
+        self.__reader = concurrent.futures.ThreadPoolExecutor(max_workers=READER_THREADS,
+                                                              thread_name_prefix='Reader')
+        # 扫描文件夹时，扫描线程与各数据连接通过发送队列协作
+        self.__scanning: bool = False
+        self.__files_ready: threading.Condition = threading.Condition()
+        # 参与发送的数据连接数，序号更大的连接暂停发送；无法继续发送的连接数，由暂停的连接接替
+        self.__active_connections: int = len(self.__connections)
+        self.__lost_workers: int = 0
+        # 上次自动调整得到的连接数
+        self.__tuned_connections: int = 0
+        # 发送任务依次由任务线程执行，执行期间仍可输入其他命令或继续添加任务
+        self.__jobs: list[SendJob] = []
+        self.__queued_jobs: deque[SendJob] = deque()
+        self.__jobs_changed: threading.Condition = threading.Condition()
+        threading.Thread(name='JobThread', target=self.__run_jobs, daemon=True).start()
 
     def __prepare_to_compare_or_sync(self, command, is_compare: bool):
         prefix_length = len(compare if is_compare else force_sync) + 1
@@ -145,25 +218,33 @@ class FTC:
             self.logger.warning('Local folder does not exist')
             return
 
-        self.__main_conn.send_head(peer_folder, COMMAND.COMPARE_FOLDER if is_compare else COMMAND.FORCE_SYNC_FOLDER, 0)
-        if self.__main_conn.recv_size() != CONTROL.CONTINUE:
+        conn = self.__main_conn.open_stream()
+        conn.send_head(peer_folder, COMMAND.COMPARE_FOLDER if is_compare else COMMAND.FORCE_SYNC_FOLDER, 0)
+        if conn.recv_size() != CONTROL.CONTINUE:
+            conn.close()
             self.logger.warning(f"Peer folder {peer_folder} does not exist")
             return
-        return folders
+        return conn, folders
 
     def __compare_or_sync_folder(self, command):
         is_compare = command.startswith(compare)
-        if folders := self.__prepare_to_compare_or_sync(command, is_compare):
-            if is_compare:
-                self.__compare_folder(*folders)
-            else:
-                self.__force_sync_folder(*folders)
+        if prepared := self.__prepare_to_compare_or_sync(command, is_compare):
+            conn, folders = prepared
+            with conn:
+                if is_compare:
+                    self.__compare_folder(conn, *folders)
+                    return
+                try:
+                    self.__force_sync_folder(conn, *folders)
+                except PeerBusyError:
+                    self.logger.warning('Peer is busy receiving/sending files, please try again later.', highlight=1)
 
-    def __compare_folder(self, local_folder, peer_folder):
-        conn: ESocket = self.__main_conn
+    def __compare_folder(self, conn: MuxStream, local_folder, peer_folder):
+        # 接收对方清单的同时扫描本地文件夹
+        thread = ThreadWithResult(lambda: dict(conn.recv_manifest(FILE_SIZE)))
+        thread.start()
         local_files_info = get_files_info_relative_to_basedir(local_folder)
-        # 将字符串转化为dict
-        peer_files_info: dict = conn.recv_with_decompress()
+        peer_files_info: dict = thread.get_result()
         # 求各种集合
         compare_result = compare_files_info(local_files_info, peer_files_info)
         msgs = print_compare_result(local_folder, peer_folder, compare_result)
@@ -178,20 +259,22 @@ class FTC:
             return
         conn.send_size(CONTROL.CONTINUE)
         # 发送相同的文件名称
-        conn.send_with_compress(files_info_equal)
-        results = FileHash.parallel_calc_hash(local_folder, files_info_equal, True)
-        peer_files_info = conn.recv_with_decompress()
+        conn.send_manifest(NAMES, ((filename,) for filename in files_info_equal))
+        results = FileHash.parallel_calc_hash(local_folder, files_info_equal, True,
+                                              self.__ftt.cache_dir, self.__ftt.hash_algorithm)
+        peer_files_info = {filename: digest.hex() for filename, digest in conn.recv_manifest(FILE_HASH)}
         hash_not_matching = [filename for filename in files_info_equal if
                              results[filename] != peer_files_info[filename]]
         msg = ["hash not matching: "] + [('\t' + file_name) for file_name in hash_not_matching]
         print('\n'.join(msg))
         files_hash_equal = [filename for filename in files_info_equal if os.path.getsize(
             PurePath(local_folder, filename)) >> SMALL_FILE_CHUNK_SIZE and filename not in hash_not_matching]
-        conn.send_with_compress(files_hash_equal)
+        conn.send_manifest(NAMES, ((filename,) for filename in files_hash_equal))
         if not files_hash_equal:
             return
-        results = FileHash.parallel_calc_hash(local_folder, files_info_equal, False)
-        peer_files_info = conn.recv_with_decompress()
+        results = FileHash.parallel_calc_hash(local_folder, files_info_equal, False,
+                                              self.__ftt.cache_dir, self.__ftt.hash_algorithm)
+        peer_files_info = {filename: digest.hex() for filename, digest in conn.recv_manifest(FILE_HASH)}
         for filename in files_hash_equal:
             if results[filename] != peer_files_info[filename]:
                 print('\t' + filename)
@@ -202,23 +285,24 @@ class FTC:
         msg.append('')
         self.logger.silent_write(['\n'.join(msg)])
 
-    def __force_sync_folder(self, local_folder, peer_folder):
+    def __force_sync_folder(self, conn: MuxStream, local_folder, peer_folder):
         """
         强制将本地文件夹的内容同步到对方文件夹，同步后双方文件夹中的文件内容一致
         """
-        conn: ESocket = self.__main_conn
+        # 接收对方清单的同时扫描本地文件夹
+        thread = ThreadWithResult(lambda: dict(conn.recv_manifest(FILE_SIZE)))
+        thread.start()
         local_files_info = get_files_info_relative_to_basedir(local_folder)
-        # 将字符串转化为dict
-        peer_files_info: dict = conn.recv_with_decompress()
+        peer_files_info: dict = thread.get_result()
         files_smaller_than_peer, files_smaller_than_local, files_info_equal, _, file_not_exists_in_local = compare_files_info(
-            local_files_info, peer_files_info)
+            local_files_info, peer_files_info.copy())
         # 传回文件名称、大小都相等的文件信息，用于后续的文件hash比较
-        conn.send_with_compress(files_info_equal)
-        # 进行快速hash比较
+        conn.send_manifest(NAMES, ((filename,) for filename in files_info_equal))
+        # 进行修改时间比较
         results = get_files_modified_time(local_folder, files_info_equal)
-        peer_files_info = conn.recv_with_decompress()
+        peer_mtimes = dict(conn.recv_manifest(FILE_MTIME))
         mtime_not_matching = [filename for filename in files_info_equal if
-                              int(results[filename]) != int(peer_files_info[filename])]
+                              int(results[filename]) != int(peer_mtimes[filename])]
         msgs = ['\n[INFO   ] ' + get_log_msg(
             f'Force sync files: local folder {local_folder} -> peer folder {peer_folder}\n')]
         for arg in [("files exist in peer but not in local: ", file_not_exists_in_local),
@@ -228,7 +312,7 @@ class FTC:
         msg = ["files modified time not matching: "]
         if mtime_not_matching:
             msg.extend([
-                f'\t{filename}: {format_timestamp(results[filename])} <-> {format_timestamp(peer_files_info[filename])}'
+                f'\t{filename}: {format_timestamp(results[filename])} <-> {format_timestamp(peer_mtimes[filename])}'
                 for filename in mtime_not_matching])
         else:
             msg.append('\tNone')
@@ -245,9 +329,47 @@ class FTC:
             if command not in ('y', 'yes'):
                 conn.send_size(CONTROL.CANCEL)
                 return
+        # 双方都较大的不一致文件只发送差异部分，其余文件在对方删除后重新发送
+        delta_files = [filename for filename in files_smaller_than_peer + files_smaller_than_local + mtime_not_matching
+                       if local_files_info[filename] >> DELTA_SYNC_SIZE_THRESHOLD and
+                       peer_files_info[filename] >> DELTA_SYNC_SIZE_THRESHOLD]
         conn.send_size(CONTROL.CONTINUE)
-        conn.send_with_compress(files_to_remove_in_peer)
-        self.__send_files_in_folder(local_folder, True)
+        conn.send_manifest(NAMES, ((filename,) for filename in set(files_to_remove_in_peer) - set(delta_files)))
+        conn.send_manifest(NAMES, ((filename,) for filename in delta_files))
+        for filename in delta_files:
+            self.__send_delta_file(conn, local_folder, filename)
+        self.__send_files_in_folder(local_folder, conn)
+
+    def __send_delta_file(self, conn: MuxStream, local_folder, filename: str):
+        """
+        根据对方旧文件的块签名，只发送本地文件中发生变化的块
+        """
+        real_path = PurePath(local_folder, filename)
+        if conn.recv_size() == CONTROL.FAIL2OPEN:
+            self.logger.warning(f'Peer failed to open {filename}, it will be sent entirely')
+            return
+        try:
+            fp = open(real_path, 'rb')
+        except OSError as error:
+            self.logger.error(f'Failed to open: {real_path}, {error}')
+            # 跳过对方的块签名并中止，对方保留旧文件
+            conn.recv_size()
+            conn.recv_data(conn.recv_size())
+            conn.sendall(delta_struct.pack(DELTA.ABORT, 0, 0))
+            conn.sendall(times_struct.pack(0, 0, 0))
+            conn.recv_size()
+            return
+        with fp:
+            file_size = (file_stat := os.fstat(fp.fileno())).st_size
+            pbar_width = get_terminal_size().columns / 4
+            with tqdm(total=file_size, desc=shorten_path(filename, pbar_width), unit='bytes', unit_scale=True,
+                      mininterval=1, leave=False, unit_divisor=1024) as pbar:
+                sent_size = send_delta(conn, fp, pbar)
+        conn.sendall(times_struct.pack(file_stat.st_ctime, file_stat.st_mtime, file_stat.st_atime))
+        if conn.recv_size() == CONTROL.CONTINUE:
+            self.logger.success(f'Delta synced: {filename}, sent {get_size(sent_size)} of {get_size(file_size)}')
+        else:
+            self.logger.warning(f'Peer failed to apply the delta of {filename}, it will be sent entirely')
 
     def __execute_command(self, command):
         if len(command) == 0:
@@ -261,51 +383,72 @@ class FTC:
                 self.__command_prefix = ''
             return
         command = self.__command_prefix + command
-        conn = self.__main_conn
-        conn.send_head(command, COMMAND.EXECUTE_COMMAND, 0)
-        msgs = [f'\n[INFO   ] {get_log_msg("Give command: ")}{command}']
-        # 接收返回结果
-        result, command, _ = conn.recv_head()
-        while command == COMMAND.EXECUTE_RESULT:
-            print(result, end='')
-            msgs.append(result)
+        with self.__main_conn.open_stream() as conn:
+            conn.send_head(command, COMMAND.EXECUTE_COMMAND, 0)
+            msgs = [f'\n[INFO   ] {get_log_msg("Give command: ")}{command}']
+            # 接收返回结果
             result, command, _ = conn.recv_head()
+            while command == COMMAND.EXECUTE_RESULT:
+                print(result, end='')
+                msgs.append(result)
+                result, command, _ = conn.recv_head()
         self.logger.silent_write(msgs)
 
     def __compare_sysinfo(self):
         # 发送比较系统信息的命令到FTS
-        self.__main_conn.send_head('', COMMAND.SYSINFO, 0)
-        # 异步获取自己的系统信息
-        thread = ThreadWithResult(get_sys_info)
-        thread.start()
-        # 接收对方的系统信息
-        peer_sysinfo = self.__main_conn.recv_with_decompress()
+        with self.__main_conn.open_stream(PRIORITY.HIGH) as conn:
+            conn.send_head('', COMMAND.SYSINFO, 0)
+            # 异步获取自己的系统信息
+            thread = ThreadWithResult(get_sys_info)
+            thread.start()
+            # 接收对方的系统信息
+            peer_sysinfo = conn.recv_with_decompress()
         msgs = [f'[INFO   ] {get_log_msg("Compare the system information of both parties: ")}\n',
                 print_sysinfo(peer_sysinfo), print_sysinfo(thread.get_result())]
         # 等待本机系统信息获取完成
         self.logger.silent_write(msgs)
 
-    def __speedtest(self, times):
-        times = '500' if times.isspace() or not times else times
+    def __speedtest(self, args):
+        """
+        @param args: 测速数据量 (MB，默认 500MB)，以及可选的 json，以 JSON 格式输出结果
+        """
+        args = args.split()
+        as_json = 'json' in args
+        args = [arg for arg in args if arg != 'json']
+        times = args[0] if args else '500'
         while not (times.isdigit() and int(times) > 0):
             times = input("Please re-enter the data amount (in MB): ")
-        times, data_unit = int(times), 1000 * 1000  # 1MB
-        data_size = times * data_unit
-        conn = self.__main_conn
-        conn.send_head('', COMMAND.SPEEDTEST, data_size)
-        start = time.time()
-        with tqdm(total=data_size, desc='upload speedtest', unit='bytes', unit_scale=True, mininterval=1) as pbar:
-            for i in range(times):
-                # 生产随机字节
-                conn.sendall(os.urandom(data_unit))
-                pbar.update(data_unit)
-        show_bandwidth('Upload speed test completed', data_size, time.time() - start, self.logger)
-        upload_over = time.time()
-        with tqdm(total=data_size, desc='download speedtest', unit='bytes', unit_scale=True, mininterval=1) as pbar:
-            for i in range(times):
-                conn.recv_data(data_unit)
-                pbar.update(data_unit)
-        show_bandwidth('Download speed test completed', data_size, time.time() - upload_over, self.logger)
+        data_size = int(times) * 1000 * 1000  # 1MB
+        # 测速占用全部数据连接，不能与文件收发同时进行
+        if not self.__ftt.busy_lock.acquire(blocking=False):
+            self.logger.warning('Files are being transferred, please try again later.', highlight=1)
+            return
+        try:
+            with self.__main_conn.open_stream(PRIORITY.LOW) as conn:
+                conn.send_head('', COMMAND.SPEEDTEST, data_size)
+                if conn.recv_size() != CONTROL.CONTINUE:
+                    self.logger.warning('Peer is busy receiving/sending files, please try again later.', highlight=1)
+                    return
+                connections = list(self.__connections)
+                conn.send_size(len(connections))
+                speedtest = SpeedTest(connections, self.__ftt.executor, data_size)
+                # 上传、下载及双向传输各阶段的总数据量
+                with tqdm(total=4 * data_size, desc='speedtest', unit='bytes', unit_scale=True,
+                          mininterval=1) as pbar:
+                    result = speedtest.run(pbar.update, conn.recv_with_decompress)
+        except CONNECTION_ERRORS as error:
+            self.logger.error(f'Speed test failed: {error}', highlight=1)
+            return
+        finally:
+            self.__ftt.busy_lock.release()
+        if as_json:
+            msg = json.dumps(result.to_dict(), ensure_ascii=False, indent=2)
+            print(msg)
+        else:
+            self.logger.success('Speed test completed')
+            msg = result.format()
+            print(msg, end='')
+        self.logger.silent_write([f'[INFO   ] {get_log_msg("Speed test result: ")}\n', msg + '\n'])
 
     def __exchange_clipboard(self, command):
         """
@@ -315,45 +458,233 @@ class FTC:
         @return:
         """
         func = get_clipboard if command == GET else send_clipboard
-        func(self.__main_conn, self.logger)
-
-    def __prepare_to_send(self, folder, is_sync):
-        self.__base_dir = folder
-        # 发送文件夹命令
-        if not is_sync:
-            self.__main_conn.send_head(PurePath(folder).name, COMMAND.SEND_FILES_IN_FOLDER, 0)
-        folders, files = get_dir_file_name(folder)
-        # 发送文件夹数据
-        self.__main_conn.send_with_compress(folders)
-        # 接收对方已有的文件名并计算出对方没有的文件
-        files = set(files) - set(self.__main_conn.recv_with_decompress())
-        if not files:
-            self.__main_conn.send_size(0)
-            self.logger.info('No files to send', highlight=1)
-            return None
-        large_files_info, small_files_info, total_size, pbar = collect_files_info(self.logger, files, folder)
-        self.__main_conn.send_size(total_size)
-        self.__large_files_info = large_files_info
-        self.__small_files_info = small_files_info
-        self.__pbar = PbarManager(pbar)
+        with self.__main_conn.open_stream(PRIORITY.HIGH) as conn:
+            func(conn, self.logger)
+
+    def __scan_files(self, conn: MuxStream, folder, futures: list) -> set[str]:
+        """
+        边扫描文件夹边按批与对方核对已存在的文件，对方没有的文件立即放入发送队列，由各数据连接同时发送
+
+        @param futures: 各数据连接的发送任务，全部结束时停止扫描
+        @return: 需要发送的文件
+        """
+        files, total_size = set(), 0
+        small_files_info, small_size = [], 0
+        msgs = [f'\n[INFO   ] {get_log_msg("Files to be sent: ")}\n']
+        try:
+            for result in scan_tree(folder):
+                conn.send_size(CONTROL.CONTINUE)
+                conn.send_manifest(FOLDER_TIMES, zip(result.folders, result.folder_atimes, result.folder_mtimes))
+                conn.send_manifest(NAMES, ((filename,) for filename in result.names))
+                # 接收本批中对方已有的文件名，只发送对方没有的文件
+                exist_files = set(name for name, in conn.recv_manifest(NAMES))
+                large_files_info, small_batches, batch_size = [], [], 0
+                for info in result.files_info():
+                    if (filename := info[0]) in exist_files:
+                        continue
+                    files.add(filename)
+                    batch_size += (file_size := info[1])
+                    msgs.append(f"{PurePath(folder, filename)}, {file_size}B\n")
+                    if file_size >> LARGE_FILE_SIZE_THRESHOLD:
+                        large_files_info.append(info)
+                        continue
+                    small_files_info.append(info)
+                    small_size += file_size
+                    if small_size >> SMALL_FILE_CHUNK_SIZE or len(small_files_info) >= SCAN_BATCH_SIZE:
+                        small_batches.append((small_size, len(small_files_info), small_files_info))
+                        small_files_info, small_size = [], 0
+                self.logger.silent_write(msgs)
+                msgs.clear()
+                total_size += batch_size
+                if not self.__put_files(alternate_first_last(sorted(large_files_info, key=lambda item: item[1])),
+                                        small_batches, batch_size, futures):
+                    break
+            else:
+                if small_files_info:
+                    self.__put_files([], [(small_size, len(small_files_info), small_files_info)], 0, futures)
+            # 扫描结束，告知对方本次发送的总大小
+            conn.send_size(CONTROL.CANCEL)
+            conn.send_size(total_size)
+        finally:
+            with self.__files_ready:
+                self.__scanning = False
+                self.__files_ready.notify_all()
         return files
 
-    def __send_files_in_folder(self, folder, is_sync=False):
+    def __put_files(self, large_files_info: list, small_batches: list, batch_size: int, futures: list) -> bool:
+        """
+        将一批待发送的文件放入发送队列，队列积压过多时等待数据连接发送
+
+        @return: 是否仍有数据连接在发送
+        """
+        with self.__files_ready:
+            # 发送任务结束时会通知该条件，不必定时检查
+            self.__files_ready.wait_for(lambda: len(self.__large_files_info) + len(
+                self.__small_files_info) < MAX_QUEUED_BATCHES or all(future.done() for future in futures))
+            if all(future.done() for future in futures):
+                return False
+            self.__large_files_info.extend(large_files_info)
+            self.__small_files_info.extend(small_batches)
+            self.__pbar.add_total(batch_size)
+            self.__files_ready.notify_all()
+        return True
+
+    def __notify_files_ready(self, _=None):
+        with self.__files_ready:
+            self.__files_ready.notify_all()
+
+    def __take_files(self, files_info: deque):
+        """
+        从发送队列中取出文件，并通知扫描线程队列已有空位
+        """
+        with self.__files_ready:
+            item = files_info.pop()
+            self.__files_ready.notify_all()
+        return item
+
+    def __has_files(self) -> bool:
+        return bool(len(self.__large_files_info) or len(self.__small_files_info) or len(self.__file_segments))
+
+    def __worker_active(self, position: int) -> bool:
+        return position <= self.__active_connections + self.__lost_workers
+
+    def __wait_for_files(self, position: int) -> bool:
+        """
+        等待发送队列中有文件或分段可以发送，暂停的连接等待重新参与发送或所有文件发送完毕
+
+        @return: 是否仍有文件需要发送
+        """
+        with self.__files_ready:
+            self.__files_ready.wait_for(lambda: self.__has_files() and self.__worker_active(position) or
+                                                not self.__scanning and not self.__has_files())
+            return self.__has_files()
+
+    def __start_workers(self) -> list[Future]:
+        """
+        在每个数据连接上开始发送，自动调整连接数时从上次调整的结果开始
+        """
+        with self.__files_ready:
+            self.__active_connections = len(self.__connections)
+            if self.__ftt.auto_tune and self.__tuned_connections:
+                self.__active_connections = min(self.__tuned_connections, len(self.__connections))
+            self.__lost_workers = 0
+        futures = [self.__ftt.executor.submit(self.__send_file, data_conn, position) for position, data_conn in
+                   enumerate(self.__connections, start=1)]
+        for future in futures:
+            future.add_done_callback(self.__notify_files_ready)
+        return futures
+
+    def __start_tuning(self, futures: list[Future]) -> tuple[threading.Thread, threading.Event] | None:
+        if not self.__ftt.auto_tune:
+            return None
+        stopped = threading.Event()
+        thread = threading.Thread(name='TuneThread', target=self.__tune_connections, args=(futures, stopped),
+                                  daemon=True)
+        thread.start()
+        return thread, stopped
+
+    def __wait_for_workers(self, futures: list[Future], tuning: tuple[threading.Thread, threading.Event] | None):
+        wait_for_workers(futures)
+        if tuning:
+            thread, stopped = tuning
+            stopped.set()
+            thread.join()
+            # 停止调整前可能刚增加了连接
+            wait_for_workers(futures)
+
+    def __measure_rtt(self, last_rtt: float | None = None) -> float | None:
+        """
+        @return: 各数据连接及之前测得的最小往返时延，发送时排队造成的时延不计入
+        """
+        rtts = [rtt for data_conn in self.__connections if (rtt := data_conn.rtt()) is not None]
+        return min(rtts + [last_rtt] if last_rtt is not None else rtts, default=None)
+
+    def __tune_connections(self, futures: list[Future], stopped: threading.Event):
+        """
+        发送过程中按吞吐量调整参与发送的数据连接数，连接不足时增加数据连接并在其上开始发送
+        """
+        tuner = ConnectionTuner(self.__active_connections)
+        rtt = self.__measure_rtt()
+        last_sent, last_time = self.__pbar.progress()[0], time.perf_counter()
+        # 高时延链路上新连接需要更长的时间才能达到稳定的速度
+        while not stopped.wait(max(TUNE_INTERVAL, 20 * (rtt or 0))):
+            sent, now = self.__pbar.progress()[0], time.perf_counter()
+            throughput = (sent - last_sent) / (now - last_time)
+            last_sent, last_time = sent, now
+            # 发送队列为空时速度受扫描速度限制，不据此调整
+            if not self.__has_files():
+                continue
+            rtt = self.__measure_rtt(rtt)
+            count = tuner.update(throughput, rtt)
+            while len(self.__connections) < count and not stopped.is_set():
+                if not self.__add_connection(futures):
+                    tuner.limit(len(self.__connections))
+                    break
+            if tuner.connections != self.__active_connections:
+                self.logger.info(f'Data connections: {self.__active_connections} -> {tuner.connections}, '
+                                 f'throughput: {get_size(throughput)}/s, rtt: '
+                                 f'{"unknown" if rtt is None else format(rtt * 1000, ".1f") + "ms"}')
+                with self.__files_ready:
+                    self.__active_connections = tuner.connections
+                    self.__files_ready.notify_all()
+        self.__tuned_connections = self.__active_connections
+
+    def __add_connection(self, futures: list[Future]) -> bool:
+        """
+        增加一个数据连接并在其上开始发送
+
+        @return: 是否增加成功
+        """
+        index = len(self.__connections)
+        try:
+            with self.__main_conn.open_stream(PRIORITY.HIGH) as conn:
+                conn.send_head('', COMMAND.ADD_CONNECTION, index)
+                if conn.recv_size() != CONTROL.CONTINUE or not (data_conn := self.__ftt.add_connection(conn, index)):
+                    return False
+        except CONNECTION_ERRORS:
+            return False
+        future = self.__ftt.executor.submit(self.__send_file, data_conn, index + 1)
+        future.add_done_callback(self.__notify_files_ready)
+        futures.append(future)
+        return True
+
+    def __send_files_in_folder(self, folder, sync_conn: MuxStream = None, job: SendJob = None) -> bool:
+        """
+        @param sync_conn: 强制同步时沿用同步命令所在的流，否则新开一路流发送文件夹
+        @return: 是否全部发送成功
+        """
         if self.__ftt.busy_lock.locked():
-            self.logger.warning('Currently receiving/sending folder, please try again later.', highlight=1)
-            return
-        with self.__ftt.busy_lock:
-            if not (files := self.__prepare_to_send(folder, is_sync)):
-                return
-            # 发送文件
-            futures = [self.__ftt.executor.submit(self.__send_file, conn, position) for position, conn in
-                       enumerate(self.__connections, start=1)]
-            for future in futures:
-                while not future.done():
-                    time.sleep(0.2)
+            self.logger.info('Waiting for the current transfer to finish')
+        with self.__ftt.busy_lock, sync_conn or self.__main_conn.open_stream() as conn:
+            self.__base_dir = folder
+            # 发送文件夹命令
+            if not sync_conn:
+                conn.send_head(PurePath(folder).name, COMMAND.SEND_FILES_IN_FOLDER, 0)
+            if conn.recv_size() != CONTROL.CONTINUE:
+                raise PeerBusyError
+            # 初始化总进度条，总大小随扫描逐步增加
+            self.__pbar = PbarManager(tqdm(total=0, desc='total', unit='bytes', unit_scale=True, mininterval=1,
+                                           position=0, colour='#01579B', unit_divisor=1024))
+            if job:
+                job.pbar = self.__pbar
+            self.__scanning = True
+            # 发送文件，各数据连接在扫描的同时开始发送
+            futures = self.__start_workers()
+            tuning = self.__start_tuning(futures)
+            files = self.__scan_files(conn, folder, futures)
+            self.__wait_for_workers(futures, tuning)
+            # 无法重新连接时放回队列的文件不再发送
+            self.__large_files_info.clear()
+            self.__small_files_info.clear()
+            if not files:
+                self.__pbar.set_status(False)
+                self.logger.info('No files to send', highlight=1)
+                return True
+            self.logger.info(f'Send files under {folder}, number: {len(files)}')
 
             fails = files - set(self.__finished_files)
             self.__finished_files.clear()
+            self.__clear_segments()
             # 比对发送失败的文件
             self.__pbar.set_status(len(fails) > 0)
             if fails:
@@ -364,97 +695,462 @@ class FTC:
             if errors.count(None) != len(errors):
                 errors = '\n'.join([f'Thread-{idx}: {exception}' for idx, exception in enumerate(errors) if exception])
                 self.logger.error(f"Exceptions occurred during this sending: \n{errors}", highlight=1)
+                return False
+            return not fails
 
-    def __send_single_file(self, file: Path):
+    def __send_single_file(self, file: Path, job: SendJob = None) -> bool:
         self.logger.silent_write([f'\n[INFO   ] {get_log_msg(f"Send a single file: {file}")}\n'])
         self.__base_dir = file.parent
         file_size = (file_stat := file.stat()).st_size
         time_info = file_stat.st_ctime, file_stat.st_mtime, file_stat.st_atime
-        self.__large_files_info.append((file.name, file_size, time_info))
         pbar_width = get_terminal_size().columns / 4
         self.__pbar = PbarManager(tqdm(total=file_size, desc=shorten_path(file.name, pbar_width), unit='bytes',
                            unit_scale=True, mininterval=1, position=0, colour='#01579B', unit_divisor=1024))
+        if job:
+            job.pbar = self.__pbar
+        # 大文件且有多个数据连接空闲时，将文件切分后在所有连接上并行发送
+        striped = file_size >> STRIPE_FILE_SIZE_THRESHOLD and len(self.__connections) > 1 and \
+            self.__ftt.busy_lock.acquire(blocking=False)
+        is_success = peer_busy = False
+        conn = self.__main_conn.open_stream()
         try:
-            self.__send_large_files(self.__main_conn, 0)
+            if striped:
+                is_success = self.__send_striped_file(conn, file.name, file_size, time_info)
+            else:
+                self.__large_files_info.append((file.name, file_size, time_info))
+                self.__send_large_files(conn, 0)
+                is_success = len(self.__finished_files) and self.__finished_files.pop() == file.name
+        except PeerBusyError:
+            peer_busy = True
+            raise
         except (ssl.SSLError, ConnectionError) as error:
             self.logger.error(error)
         finally:
-            is_success = len(self.__finished_files) and self.__finished_files.pop() == file.name
-            self.__pbar.set_status(not is_success)
-            self.logger.success(f"{file} sent successfully") if is_success else self.logger.error(f"{file} failed to send")
+            conn.close()
+            self.__large_files_info.clear()
+            self.__clear_segments()
+            if striped:
+                self.__ftt.busy_lock.release()
+            if peer_busy:
+                self.__pbar.discard()
+            else:
+                self.__pbar.set_status(not is_success)
+                self.logger.success(f"{file} sent successfully") if is_success else self.logger.error(f"{file} failed to send")
+        return is_success
+
+    def __send_striped_file(self, conn: MuxStream, filename: str, file_size: int, time_info: tuple) -> bool:
+        """
+        将单个大文件按偏移切分为多段，由所有数据连接并行领取发送，对方按偏移写入预分配的文件
+
+        @return: 对方是否完整接收
+        """
+        conn.send_head(filename, COMMAND.SEND_STRIPED_FILE, file_size)
+        if conn.recv_size() != CONTROL.CONTINUE:
+            raise PeerBusyError
+        if (missing_ranges := self.__recv_missing_ranges(conn, filename, time_info)) is None:
+            return False
+        parts = max(len(self.__connections), -(-sum(count for _, count in missing_ranges) >> FILE_SEGMENT_SIZE))
+        self.__add_segments(filename, split_missing_ranges(missing_ranges, parts))
+        futures = self.__start_workers()
+        self.__wait_for_workers(futures, self.__start_tuning(futures))
+        self.__clear_segments()
+        self.__finished_files.clear()
+        for idx, exception in enumerate([future.exception() for future in futures]):
+            if exception:
+                self.logger.error(f'Thread-{idx}: {exception}', highlight=1)
+        return conn.recv_size() == CONTROL.CONTINUE
+
+    def __recv_missing_ranges(self, conn: ESocket, filename: str, time_info: tuple) -> list[tuple[int, int]] | None:
+        """
+        发送文件的创建、修改、访问时间，对方以修改时间识别可续传的数据，接收对方尚未接收的数据区间
+
+        @return: 尚未接收的区间 [(偏移, 长度)]，对方无法接收该文件时为 None
+        """
+        conn.sendall(times_struct.pack(*time_info))
+        if (flag := conn.recv_size()) == CONTROL.FAIL2OPEN:
+            self.logger.error(f'Peer failed to receive the file: {PurePath(self.__base_dir, filename)}', highlight=1)
+            return None
+        missing_ranges = list(range_struct.iter_unpack(conn.recv_data(conn.recv_size())))
+        conn.check_mac()
+        # 服务端已有的数据大小
+        self.__pbar.update(flag, decrease=True)
+        return missing_ranges
+
+    def __add_segments(self, filename: str, segments: list[tuple[int, int]], claimed=0):
+        """
+        将文件分段放入待发送队列
+
+        @param claimed: 已由当前连接领取、不放入队列的分段数
+        """
+        with self.__segments_lock:
+            self.__segments_remained[filename] = len(segments) + claimed
+        with self.__files_ready:
+            self.__file_segments.extend([(filename, offset, count) for offset, count in segments])
+            self.__files_ready.notify_all()
+
+    def __requeue_segments(self, filename: str, segments: list[tuple[int, int]], claimed: int):
+        """
+        连接断开时将未发送完成的分段放回队列的最前面，重新连接后由任意连接发送
+
+        @param claimed: 这些分段原先计入的剩余分段数
+        """
+        with self.__segments_lock:
+            if filename not in self.__segments_remained:
+                return
+            self.__segments_remained[filename] += len(segments) - claimed
+        with self.__files_ready:
+            self.__file_segments.extendleft((filename, offset, count) for offset, count in reversed(segments))
+            self.__files_ready.notify_all()
+
+    def __finish_segment(self, filename: str):
+        with self.__segments_lock:
+            if filename not in self.__segments_remained:
+                # 已放弃发送的文件
+                return
+            self.__segments_remained[filename] -= 1
+            if self.__segments_remained[filename]:
+                return
+            del self.__segments_remained[filename]
+        self.__finished_files.append(filename)
+
+    def __abandon_file(self, filename: str, reason: str = 'Failed to open'):
+        """
+        源文件无法读取时放弃发送该文件，队列中剩余的分段不再发送，该文件计为发送失败
+        """
+        self.logger.error(f'{reason}: {PurePath(self.__base_dir, filename)}', highlight=1)
+        with self.__segments_lock:
+            self.__segments_remained.pop(filename, None)
+
+    def __clear_segments(self):
+        self.__file_segments.clear()
+        with self.__segments_lock:
+            self.__segments_remained.clear()
+
+    def __send_file_data(self, conn: ESocket, fp, filename: str, offset: int, count: int, desc: str, position: int):
+        view, codec = None, self.__ftt.codec if self.__ftt.compress else None
+        # 开启校验时在数据发出的同时计算摘要，附在数据之后由对方校验
+        file_hash = new_hash(self.__ftt.hash_algorithm) if self.__ftt.verify else None
+        block_ready = bool(codec and count)
+        if block_ready:
+            # 读取首块作为样本，判断该段数据是否值得压缩
+            view = memoryview(bytearray(min(count, COMPRESS_BLOCK_SIZE)))
+            fp.seek(offset)
+            fp.readinto(view)
+            if not codec.compressible(filename, view):
+                # 不压缩且无需计算摘要时不再经过缓冲区，由 sendfile 直接发送
+                codec, block_ready = None, False
+                view = view if file_hash else None
+        if file_hash and view is None:
+            view = memoryview(bytearray(min(count, COMPRESS_BLOCK_SIZE)))
+        if not block_ready:
+            # 读取样本后回到该段的起点，sendfile 在偏移为 0 时从文件的当前位置读取
+            fp.seek(offset)
+        conn.send_size((DATA_FLAG.COMPRESSED if codec else 0) | (DATA_FLAG.DIGEST if file_hash else 0))
+        pbar_width = get_terminal_size().columns / 4
+        with tqdm(total=count, desc=shorten_path(desc, pbar_width), unit='bytes', unit_scale=True,
+                  mininterval=1, position=position, leave=False, disable=position == 0, unit_divisor=1024) as pbar:
+            end = offset + count
+            # 始终提前一个预读窗口提示内核读入，已发送过半时再提示下一个窗口
+            read_ahead = offset + min(count, 1 << READ_AHEAD_SIZE)
+            advise_read_ahead(fp, offset, read_ahead - offset)
+            try:
+                while offset < end:
+                    if read_ahead < end and read_ahead - offset < 1 << READ_AHEAD_SIZE - 1:
+                        advise_read_ahead(fp, read_ahead, min(1 << READ_AHEAD_SIZE, end - read_ahead))
+                        read_ahead = min(read_ahead + (1 << READ_AHEAD_SIZE), end)
+                    if view is not None:
+                        sent_size = min(len(view), end - offset)
+                        if not block_ready:
+                            fp.readinto(view[:sent_size])
+                        if file_hash:
+                            file_hash.update(view[:sent_size])
+                        if codec:
+                            codec.send(conn, view[:sent_size])
+                        else:
+                            conn.sendall(view[:sent_size])
+                        block_ready = False
+                    else:
+                        sent_size = conn.sendfile(fp, offset=offset, count=min(5 * MB, end - offset))
+                        if not sent_size:
+                            self.__abandon_file(filename, 'Source file was truncated while sending')
+                            raise SourceTruncatedError(f'{filename} was truncated at offset {offset}')
+                    offset += sent_size
+                    pbar.update(sent_size)
+                    self.__pbar.update(sent_size)
+            except CONNECTION_ERRORS:
+                # 该段会重新发送，撤销已计入总进度的大小
+                self.__pbar.update(-pbar.n)
+                raise
+        if file_hash:
+            conn.sendall(digest_bytes(file_hash))
+
+    def __send_file_segment(self, conn: ESocket, position: int, filename: str, offset: int, count: int):
+        with self.__segments_lock:
+            if filename not in self.__segments_remained:
+                return
+        try:
+            fp = open(PurePath(self.__base_dir, filename), 'rb')
+        except FileNotFoundError:
+            self.__abandon_file(filename)
+            return
+        with fp:
+            try:
+                conn.send_head(filename, COMMAND.SEND_FILE_RANGE, count)
+                conn.send_size(offset)
+                self.__send_file_data(conn, fp, filename, offset, count, f'{filename}@{get_size(offset)}', position)
+                conn.send_mac()
+            except CONNECTION_ERRORS:
+                self.__requeue_segments(filename, [(offset, count)], claimed=1)
+                raise
+        self.__finish_segment(filename)
+
+    def __send_large_file(self, conn: ESocket, position: int, filename: str, file_size: int, time_info: tuple):
+        try:
+            fp = open(PurePath(self.__base_dir, filename), 'rb')
+        except FileNotFoundError:
+            self.__abandon_file(filename)
+            return
+        with fp:
+            claimed = None
+            try:
+                conn.send_head(filename, COMMAND.SEND_LARGE_FILE, file_size)
+                if (missing_ranges := self.__recv_missing_ranges(conn, filename, time_info)) is None:
+                    return
+                # 数据连接上的超大文件切分为多段，首段由当前连接发送，其余分段可由任意空闲连接领取；
+                # 主连接上不切分，所有未接收的区间都由主连接发送
+                if position:
+                    parts = -(-sum(count for _, count in missing_ranges) >> FILE_SEGMENT_SIZE)
+                    first, *segments = split_missing_ranges(missing_ranges, parts) or [(file_size, 0)]
+                    claimed = deque([first])
+                else:
+                    claimed, segments = deque(missing_ranges or [(file_size, 0)]), []
+                self.__add_segments(filename, segments, claimed=1)
+                conn.send_size(len(claimed))
+                while claimed:
+                    offset, count = claimed[0]
+                    conn.send_size(offset)
+                    conn.send_size(count)
+                    self.__send_file_data(conn, fp, filename, offset, count, filename, position)
+                    conn.send_mac()
+                    claimed.popleft()
+            except CONNECTION_ERRORS:
+                # 对方回复前断开时重新发送整个文件，否则只重新发送未发送完成的分段
+                if claimed is None:
+                    self.__large_files_info.append((filename, file_size, time_info))
+                else:
+                    self.__requeue_segments(filename, list(claimed), claimed=1)
+                raise
+        self.__finish_segment(filename)
 
     def __send_large_files(self, conn: ESocket, position: int):
-        while len(self.__large_files_info):
-            filename, file_size, time_info = self.__large_files_info.pop()
-            real_path = PurePath(self.__base_dir, filename)
+        while (len(self.__file_segments) or len(self.__large_files_info)) and self.__worker_active(position):
+            # 优先发送已开始传输的文件的剩余分段
             try:
-                fp = open(real_path, 'rb')
-            except FileNotFoundError:
-                self.logger.error(f'Failed to open: {real_path}')
+                segment = self.__file_segments.popleft()
+            except IndexError:
+                segment = None
+            if segment:
+                self.__send_file_segment(conn, position, *segment)
                 continue
-            conn.send_head(filename, COMMAND.SEND_LARGE_FILE, file_size)
-            if (flag := conn.recv_size()) == CONTROL.FAIL2OPEN:
-                self.logger.error(f'Peer failed to receive the file: {real_path}', highlight=1)
+            try:
+                file_info = self.__take_files(self.__large_files_info)
+            except IndexError:
+                break
+            self.__send_large_file(conn, position, *file_info)
+
+    def __take_small_files(self, batch_size: int) -> tuple[int, int, list]:
+        """
+        从发送队列中取出若干批小文件，合并为不超过 batch_size 的一批
+        """
+        total_size, num, files_info = self.__take_files(self.__small_files_info)
+        while total_size < batch_size:
+            try:
+                size, count, info = self.__take_files(self.__small_files_info)
+            except IndexError:
+                break
+            total_size, num, files_info = total_size + size, num + count, files_info + info
+        return total_size, num, files_info
+
+    def __prefetch_small_files(self, prefetched: deque, batch_size: int):
+        """
+        从发送队列中取出小文件批次交给读取线程预先读入，使磁盘读取与网络发送重叠进行
+
+        @param prefetched: 已取出的批次及其读取任务
+        """
+        while len(prefetched) < PREFETCH_BATCHES:
+            try:
+                total_size, num, files_info = self.__take_small_files(batch_size)
+            except IndexError:
                 return
-            # 服务端已有的文件大小
-            fp.seek(peer_exist_size := flag, 0)
-            rest_size = file_size - peer_exist_size
-            pbar_width = get_terminal_size().columns / 4
-            with tqdm(total=rest_size, desc=shorten_path(filename, pbar_width), unit='bytes', unit_scale=True,
-                      mininterval=1, position=position, leave=False, disable=position == 0, unit_divisor=1024) as pbar:
-                while rest_size > 0:
-                    sent_size = conn.sendfile(fp, offset=fp.tell(), count=5 * MB)
-                    rest_size -= sent_size
-                    pbar.update(sent_size)
-                    self.__pbar.update(sent_size)
-            fp.close()
-            # 发送文件的创建、访问、修改时间戳
-            conn.sendall(times_struct.pack(*time_info))
-            self.__pbar.update(peer_exist_size, decrease=True)
-            self.__finished_files.append(filename)
+            reading = self.__reader.submit(read_files, self.__base_dir, files_info, total_size)
+            prefetched.append(((total_size, num, files_info), reading))
 
     def __send_small_files(self, conn: ESocket, position: int):
-        idx, real_path, files_info = 0, Path(""), []
-        while len(self.__small_files_info):
-            try:
-                total_size, num, files_info = self.__small_files_info.pop()
-                conn.send_head('', COMMAND.SEND_SMALL_FILE, total_size)
-                conn.send_with_compress(files_info)
-                with tqdm(total=total_size, desc=f'{num} small files', unit='bytes', unit_scale=True,
-                          mininterval=0.2, position=position, leave=False, unit_divisor=1024) as pbar:
-                    for idx, (filename, file_size, _) in enumerate(files_info):
-                        real_path = Path(self.__base_dir, filename)
-                        with real_path.open('rb') as fp:
-                            conn.sendfile(fp)
-                        pbar.update(file_size)
+        codec: BlockCodec | None = self.__ftt.codec if self.__ftt.compress else None
+        batch_size = 1 << SMALL_FILE_CHUNK_SIZE
+        prefetched: deque = deque()
+        try:
+            while self.__worker_active(position):
+                self.__prefetch_small_files(prefetched, batch_size)
+                if not prefetched:
+                    break
+                (total_size, num, files_info), reading = prefetched.popleft()
+                # 整批文件先读入同一个缓冲区，一次写入连接，避免逐个文件发送的开销
+                buffer, files_info, failed_files = reading.result()
+                for filename in failed_files:
+                    self.logger.error(f'Failed to open: {PurePath(self.__base_dir, filename)}')
+                self.__pbar.update(total_size - len(buffer), decrease=True)
+                if not files_info:
+                    continue
+                # 发送当前批的同时读取之后的批次
+                self.__prefetch_small_files(prefetched, batch_size)
+                start = time.perf_counter()
+                total_size, num = len(buffer), len(files_info)
+                try:
+                    conn.send_head('', COMMAND.SEND_SMALL_FILE, total_size)
+                    conn.send_manifest(FILE_INFO, ((filename, size, *times) for filename, size, times in files_info))
+                    with tqdm(total=total_size, desc=f'{num} small files', unit='bytes', unit_scale=True,
+                              mininterval=0.2, position=position, leave=False, unit_divisor=1024) as pbar:
+                        # 由首块样本判断是否压缩，整批都是已压缩格式的文件时不再尝试
+                        compressed = codec is not None and not all(
+                            filename[filename.rfind('.'):].lower() in COMPRESSED_SUFFIXES for filename, _, _ in
+                            files_info) and codec.compressible('', buffer)
+                        conn.send_size((DATA_FLAG.COMPRESSED if compressed else 0) |
+                                       (DATA_FLAG.DIGEST if self.__ftt.verify else 0))
+                        if compressed:
+                            codec.send(conn, buffer)
+                        else:
+                            conn.sendall(buffer)
+                        if self.__ftt.verify:
+                            file_hash = new_hash(self.__ftt.hash_algorithm)
+                            file_hash.update(buffer)
+                            conn.sendall(digest_bytes(file_hash))
+                        pbar.update(total_size)
+                    conn.send_mac()
+                except CONNECTION_ERRORS:
+                    # 整批放回队列，重新连接后再发送
+                    self.__small_files_info.append((total_size, num, files_info))
+                    raise
                 self.__pbar.update(total_size)
-            except FileNotFoundError:
-                self.logger.error(f'Failed to open: {real_path}')
-            finally:
-                self.__finished_files.extend([filename for filename, _, _ in files_info[:idx + 1]])
+                self.__finished_files.extend([filename for filename, _, _ in files_info])
+                batch_size = adapt_batch_size(batch_size, time.perf_counter() - start)
+        finally:
+            # 已预读但未发送的批次放回队列，由其他连接或重新连接后发送
+            for batch, reading in prefetched:
+                reading.cancel()
+                self.__small_files_info.append(batch)
 
     def __send_file(self, conn: ESocket, position: int):
+        # 当前使用的数据连接，无法重新连接时为 None
+        data_conn = conn
         try:
-            if position < 3:
-                self.__send_large_files(conn, position)
-                self.__send_small_files(conn, position)
-            else:
-                self.__send_small_files(conn, position)
-                self.__send_large_files(conn, position)
-        finally:
-            conn.send_head('', COMMAND.FINISH, 0)
+            while True:
+                try:
+                    while self.__wait_for_files(position):
+                        if position < 3:
+                            self.__send_large_files(data_conn, position)
+                            self.__send_small_files(data_conn, position)
+                        else:
+                            self.__send_small_files(data_conn, position)
+                            self.__send_large_files(data_conn, position)
+                    data_conn.send_head('', COMMAND.FINISH, 0)
+                    return
+                except CONNECTION_ERRORS as error:
+                    # 未发送完成的文件已放回队列，数据连接重新建立后继续发送；
+                    # 发送结束标记时才发现连接断开的，对方正在等待重新连接，在新连接上重新发送结束标记
+                    self.logger.warning(f'Data connection {position} was lost: {error}')
+                    if not (data_conn := self.__ftt.reconnect(data_conn)):
+                        raise
+        except Exception:
+            # 该连接无法继续发送，由一个暂停的连接接替
+            with self.__files_ready:
+                self.__lost_workers += 1
+                self.__files_ready.notify_all()
+            # 连接仍可用时通知对方该连接上的发送已结束，已断开的连接上不再发送
+            if data_conn:
+                try:
+                    data_conn.send_head('', COMMAND.FINISH, 0)
+                except OSError as error:
+                    self.logger.warning(f'Failed to finish sending on data connection {position}: {error}')
+            raise
+
+    def __unfinished_jobs(self) -> int:
+        return sum(job.status in (JOB_STATUS.QUEUED, JOB_STATUS.RUNNING) for job in self.__jobs)
+
+    def __add_job(self, path: Path):
+        with self.__jobs_changed:
+            job, waiting = SendJob(len(self.__jobs) + 1, path), self.__unfinished_jobs()
+            self.__jobs.append(job)
+            self.__queued_jobs.append(job)
+            self.__jobs_changed.notify_all()
+        if waiting:
+            self.logger.info(f'Job {job.job_id} queued: {path}, {waiting} job(s) ahead')
+
+    def __run_jobs(self):
+        while True:
+            with self.__jobs_changed:
+                self.__jobs_changed.wait_for(lambda: len(self.__queued_jobs))
+                job = self.__queued_jobs.popleft()
+                job.status = JOB_STATUS.RUNNING
+            start, success, notified = time.time(), False, False
+            while True:
+                try:
+                    success = self.__send_files_in_folder(job.path, job=job) if job.path.is_dir() else \
+                        self.__send_single_file(job.path, job)
+                    break
+                except PeerBusyError:
+                    # 对方正在收发其他文件，稍后重试；双方同时开始发送时随机等待，避免再次冲突
+                    if not notified:
+                        self.logger.info(f'Peer is busy, job {job.job_id} will be retried')
+                        notified = True
+                    time.sleep(random.uniform(1, BUSY_RETRY_INTERVAL))
+                except Exception as error:
+                    self.logger.error(f'Job {job.job_id} failed: {error}', highlight=1)
+                    break
+            with self.__jobs_changed:
+                job.status = JOB_STATUS.DONE if success else JOB_STATUS.FAILED
+                job.elapsed = time.time() - start
+                self.__jobs_changed.notify_all()
+
+    def __list_jobs(self):
+        with self.__jobs_changed:
+            send_jobs = list(self.__jobs)
+        if not send_jobs:
+            self.logger.info('No jobs')
+            return
+        for job in send_jobs:
+            progress = ''
+            if job.pbar:
+                sent, total = job.pbar.progress()
+                progress = f'{get_size(sent)}/{get_size(total)}'
+                progress += f', takes {format_time(job.elapsed)}' if job.elapsed else ''
+            print(f'{job.job_id:>4}  {job.status:<8} {job.path}  {progress}')
+
+    def wait_for_jobs(self):
+        """
+        退出前等待已添加的发送任务完成
+        """
+        with self.__jobs_changed:
+            if unfinished := self.__unfinished_jobs():
+                self.logger.info(f'Waiting for {unfinished} job(s) to finish, press Ctrl+C to quit immediately')
+            # 分段等待，使主线程能响应 Ctrl+C
+            while self.__unfinished_jobs():
+                self.__jobs_changed.wait(1)
 
     def execute(self, command):
         if command == sysinfo:
             self.__compare_sysinfo()
         elif command.startswith(speedtest):
-            self.__speedtest(times=command[10:])
+            self.__speedtest(command[10:])
         elif command.startswith((compare, force_sync)):
             self.__compare_or_sync_folder(command)
         elif command.startswith(say):
-            self.__main_conn.send_head(command[4:], COMMAND.CHAT, 0)
+            with self.__main_conn.open_stream(PRIORITY.HIGH) as conn:
+                conn.send_head(command[4:], COMMAND.CHAT, 0)
         elif command.endswith('clipboard'):
             self.__exchange_clipboard(command.split()[0])
+        elif command == jobs:
+            self.__list_jobs()
         elif command.startswith(history):
             print_history(int(command.split()[1])) if len(command.split()) > 1 and command.split()[
                 1].isdigit() else print_history()
@@ -466,10 +1162,7 @@ class FTC:
             for path in paths:
                 if os.path.exists(path):
                     flag = False
-                    if os.path.isdir(path):
-                        self.__send_files_in_folder(path)
-                    else:
-                        self.__send_single_file(Path(path))
+                    self.__add_job(Path(path))
                 else:
                     path_not_exists.append(path)
             if flag:
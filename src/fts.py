@@ -5,8 +5,14 @@ import concurrent.futures
 import send2trash
 
 from utils import *
+from mux import *
 from sys_info import *
+from compressor import *
+from delta import *
+from journal import *
+from speedtest import SpeedTest
 from pathlib import Path
+from dataclasses import dataclass
 
 
 def avoid_filename_duplication(filename: str):
@@ -25,96 +31,220 @@ def avoid_filename_duplication(filename: str):
     return filename
 
 
+@dataclass
+class ReceivingFile:
+    """
+    正在接收的大文件，其分段可能由多个连接并行写入
+    """
+    original_file: str
+    download_file: str
+    file_size: int
+    received_size: int
+    # 记录已接收的块，用于续传
+    journal: ResumeJournal
+    # 源文件的 (创建时间, 修改时间, 访问时间)
+    timestamps: tuple
+    finished: bool = False
+
+
 class FTS:
     def __init__(self, ftt):
         self.__ftt = ftt
-        self.__main_conn: ESocket = ftt.main_conn_recv
         self.logger: Logger = ftt.logger
+        self.__receiving_lock: threading.Lock = threading.Lock()
+        # 小文件由写入线程创建并修改时间，接收线程只负责读取连接；等待写入的批数有上限
+        self.__writer = concurrent.futures.ThreadPoolExecutor(max_workers=WRITER_THREADS,
+                                                              thread_name_prefix='Writer')
+        self.__write_slots: threading.BoundedSemaphore = threading.BoundedSemaphore(MAX_PENDING_WRITES)
+        self.__write_buffers: BufferPool = BufferPool(MAX_WRITE_BUFFERS, buf_size)
+        self.__pending_writes: list[concurrent.futures.Future] = []
+        # 正在接收的文件夹或文件 (保存目录, 尚未完成的大文件)，以及对方在接收过程中增加的数据连接上的接收任务
+        self.__receiving: tuple[Path, dict[str, ReceivingFile]] | None = None
+        self.__added_slaves: list[concurrent.futures.Future] = []
+        self.__slaves_lock: threading.Lock = threading.Lock()
 
-    def __compare_folder(self, folder):
+    def __compare_folder(self, conn: MuxStream, folder):
         # self.logger.info(f"Client request to compare folder: {folder}")
         if not os.path.exists(folder):
             # 发送目录不存在
-            self.__main_conn.send_size(CONTROL.CANCEL)
+            conn.send_size(CONTROL.CANCEL)
             return
-        self.__main_conn.send_size(CONTROL.CONTINUE)
-        # 将数组拼接成字符串发送到客户端
-        self.__main_conn.send_with_compress(get_files_info_relative_to_basedir(folder))
-        if self.__main_conn.recv_size() != CONTROL.CONTINUE:
+        conn.send_size(CONTROL.CONTINUE)
+        # 边扫描边发送文件清单
+        conn.send_manifest(FILE_SIZE, iter_files_info(folder))
+        if conn.recv_size() != CONTROL.CONTINUE:
             return
-        file_size_and_name_both_equal = self.__main_conn.recv_with_decompress()
+        file_size_and_name_both_equal = [name for name, in conn.recv_manifest(NAMES)]
         # 得到文件相对路径名: hash值字典
-        results = FileHash.parallel_calc_hash(folder, file_size_and_name_both_equal, True)
-        self.__main_conn.send_with_compress(results)
-        files_hash_equal = self.__main_conn.recv_with_decompress()
+        results = FileHash.parallel_calc_hash(folder, file_size_and_name_both_equal, True,
+                                              self.__ftt.cache_dir, self.__ftt.hash_algorithm)
+        conn.send_manifest(FILE_HASH, ((name, bytes.fromhex(value)) for name, value in results.items()))
+        files_hash_equal = [name for name, in conn.recv_manifest(NAMES)]
         if not files_hash_equal:
             return
-        results = FileHash.parallel_calc_hash(folder, file_size_and_name_both_equal, False)
-        self.__main_conn.send_with_compress(results)
+        results = FileHash.parallel_calc_hash(folder, file_size_and_name_both_equal, False,
+                                              self.__ftt.cache_dir, self.__ftt.hash_algorithm)
+        conn.send_manifest(FILE_HASH, ((name, bytes.fromhex(value)) for name, value in results.items()))
 
-    def __force_sync_folder(self, folder):
+    def __force_sync_folder(self, conn: MuxStream, folder):
         if not os.path.exists(folder):
             # 发送目录不存在
-            self.__main_conn.send_size(CONTROL.CANCEL)
+            conn.send_size(CONTROL.CANCEL)
             return
-        self.__main_conn.send_size(CONTROL.CONTINUE)
+        conn.send_size(CONTROL.CONTINUE)
         self.logger.info(f"Peer request to force sync folder: {folder}")
-        # 将数组拼接成字符串发送到客户端
-        self.__main_conn.send_with_compress(get_files_info_relative_to_basedir(folder))
-        # 得到文件相对路径名: hash值字典
-        file_info_equal = self.__main_conn.recv_with_decompress()
-        self.__main_conn.send_with_compress(get_files_modified_time(folder, file_info_equal))
-        if self.__main_conn.recv_size() != CONTROL.CONTINUE:
+        # 边扫描边发送文件清单
+        conn.send_manifest(FILE_SIZE, iter_files_info(folder))
+        # 得到文件相对路径名: 修改时间字典
+        file_info_equal = [name for name, in conn.recv_manifest(NAMES)]
+        conn.send_manifest(FILE_MTIME, get_files_modified_time(folder, file_info_equal).items())
+        if conn.recv_size() != CONTROL.CONTINUE:
             self.logger.info("Peer canceled the sync.")
             return
-        files_to_remove: list = self.__main_conn.recv_with_decompress()
+        files_to_remove = [name for name, in conn.recv_manifest(NAMES)]
+        delta_files = [name for name, in conn.recv_manifest(NAMES)]
         self.logger.silent_write([print_filename_if_exists('Files to be removed:', files_to_remove, False)])
         for file_rel_path in files_to_remove:
             try:
                 send2trash.send2trash(PurePath(folder, file_rel_path))
             except Exception as e:
                 self.logger.warning(f'Failed to remove {file_rel_path}, reason: {e}')
-        self.__recv_files_in_folder(Path(folder))
+        for file_rel_path in delta_files:
+            self.__recv_delta_file(conn, PurePath(folder, file_rel_path))
+        self.__recv_files_in_folder(conn, Path(folder))
 
-    def __execute_command(self, command):
+    def __recv_delta_file(self, conn: MuxStream, real_path: PurePath):
+        """
+        发送旧文件的块签名，再按对方的差量指令生成新文件；失败时删除旧文件，由之后的文件夹发送整体重传。
+        对方无法读取其文件而中止时保留旧文件
+        """
+        temp_file = f'{real_path}.ftsdelta'
+        old_fp = new_fp = None
+        try:
+            old_fp = open(real_path, 'rb')
+            new_fp = open(temp_file, 'wb')
+        except OSError as error:
+            self.logger.warning(f'Failed to open {real_path} for delta sync, {error}')
+            if old_fp:
+                old_fp.close()
+            conn.send_size(CONTROL.FAIL2OPEN)
+            self.__trash_file(real_path)
+            return
+        with old_fp, new_fp:
+            conn.send_size(CONTROL.CONTINUE)
+            send_signatures(conn, old_fp, os.fstat(old_fp.fileno()).st_size)
+            success = recv_delta(conn, old_fp, new_fp)
+        time_info = times_struct.unpack(conn.recv_data(times_struct.size))
+        if success is None:
+            self.logger.warning(f'Peer aborted the delta sync of {real_path}, the file is kept')
+            try:
+                os.remove(temp_file)
+            except OSError as error:
+                self.logger.warning(f'Failed to remove {temp_file}, {error}')
+            conn.send_size(CONTROL.CANCEL)
+            return
+        try:
+            if success:
+                os.replace(temp_file, real_path)
+                modify_file_time(self.logger, str(real_path), *time_info)
+                self.logger.success(f'Delta synced: {real_path}')
+            else:
+                os.remove(temp_file)
+        except OSError as error:
+            self.logger.warning(f'Failed to apply the delta of {real_path}, {error}')
+            success = False
+        if not success:
+            self.__trash_file(real_path)
+        conn.send_size(CONTROL.CONTINUE if success else CONTROL.FAIL2OPEN)
+
+    def __trash_file(self, real_path):
+        try:
+            send2trash.send2trash(real_path)
+        except Exception as e:
+            self.logger.warning(f'Failed to remove {real_path}, reason: {e}')
+
+    def __execute_command(self, conn: MuxStream, command):
         out = subprocess.Popen(args=command, shell=True, text=True, stdout=subprocess.PIPE,
                                stderr=subprocess.STDOUT).stdout
         output = [f'[LOG    ] {get_log_msg("Execute command")}: {command}']
         while result := out.readline():
-            self.__main_conn.send_head(result, COMMAND.EXECUTE_RESULT, 0)
+            conn.send_head(result, COMMAND.EXECUTE_RESULT, 0)
             output.append(result)
         # 命令执行结束
-        self.__main_conn.send_head('', COMMAND.FINISH, 0)
+        conn.send_head('', COMMAND.FINISH, 0)
         self.logger.silent_write(output)
 
-    def __speedtest(self, data_size):
-        self.logger.info(f"Client request speed test, size: {get_size(2 * data_size, factor=1000)}")
-        start = time.time()
-        data_unit = 1000 * 1000
-        for i in range(0, int(data_size / data_unit)):
-            self.__main_conn.recv_data(data_unit)
-        show_bandwidth('Download speed test completed', data_size, time.time() - start, self.logger)
-        download_over = time.time()
-        for i in range(0, int(data_size / data_unit)):
-            self.__main_conn.sendall(os.urandom(data_unit))
-        show_bandwidth('Upload speed test completed', data_size, time.time() - download_over, self.logger)
-
-    def __recv_files_in_folder(self, cur_dir: Path):
-        with self.__ftt.busy_lock:
-            files = []
-            if cur_dir.exists():
-                for path, _, file_list in os.walk(cur_dir):
-                    files += [PurePath(PurePath(path).relative_to(cur_dir), file).as_posix() for file in file_list]
-            dirs_info: dict = self.__main_conn.recv_with_decompress()
-            makedirs(self.logger, list(dirs_info.keys()), cur_dir)
-            # 发送已存在的文件名
-            self.__main_conn.send_with_compress(files)
-            start, total_size = time.time(), self.__main_conn.recv_size()
-            if not total_size:
-                self.logger.info('No files to receive')
+    def __speedtest(self, conn: MuxStream, data_size):
+        with acquire_within(self.__ftt.busy_lock, BUSY_TIMEOUT) as acquired:
+            if not self.__reply_busy(conn, acquired):
                 return
-            futures = [self.__ftt.executor.submit(self.__slave_work, conn, cur_dir) for conn in self.__ftt.connections]
+            connections = self.__ftt.connections[:conn.recv_size()]
+            self.logger.info(f"Client request speed test, size: {get_size(data_size, factor=1000)} each direction, "
+                             f"connections: {len(connections)}")
+            conn.send_with_compress(SpeedTest(connections, self.__ftt.executor, data_size).respond())
+            self.logger.success('Speed test completed')
+
+    def __reply_busy(self, conn: MuxStream, acquired: bool) -> bool:
+        """
+        告知对方本方能否开始接收；本方正在收发其他文件时，对方稍后重试
+
+        @return: 能否开始接收
+        """
+        conn.send_size(CONTROL.CONTINUE if acquired else CONTROL.CANCEL)
+        if not acquired:
+            self.logger.info('Currently receiving/sending files, peer will retry later')
+        return acquired
+
+    def __start_receiving(self, cur_dir: Path, receiving_files: dict[str, ReceivingFile]):
+        with self.__slaves_lock:
+            self.__receiving = cur_dir, receiving_files
+
+    def __wait_for_added_slaves(self):
+        """
+        停止接受新增的数据连接，等待已增加的连接接收完成
+        """
+        with self.__slaves_lock:
+            self.__receiving, added_slaves, self.__added_slaves = None, self.__added_slaves, []
+        concurrent.futures.wait(added_slaves)
+
+    def __add_connection(self, conn: MuxStream, index: int):
+        """
+        对方在发送过程中增加数据连接，本方在新连接上参与接收；接收已结束时拒绝
+        """
+        slave = concurrent.futures.Future()
+        with self.__slaves_lock:
+            if receiving := self.__receiving:
+                self.__added_slaves.append(slave)
+        conn.send_size(CONTROL.CONTINUE if receiving else CONTROL.CANCEL)
+        if not receiving:
+            return
+        try:
+            if data_conn := self.__ftt.add_connection(conn, index):
+                self.__slave_work(data_conn, *receiving)
+        finally:
+            slave.set_result(None)
+
+    def __recv_files_in_folder(self, conn: MuxStream, cur_dir: Path):
+        with acquire_within(self.__ftt.busy_lock, BUSY_TIMEOUT) as acquired:
+            if not self.__reply_busy(conn, acquired):
+                return
+            start, receiving_files, dirs_info = time.time(), {}, {}
+            # 对方边扫描边发送，各数据连接立即开始接收
+            futures = [self.__ftt.executor.submit(self.__slave_work, data_conn, cur_dir, receiving_files)
+                       for data_conn in self.__ftt.connections]
+            self.__start_receiving(cur_dir, receiving_files)
+            # 按批接收对方的扫描结果，创建文件夹并告知对方本批中已存在的文件
+            while conn.recv_size() == CONTROL.CONTINUE:
+                folders = {name: (atime, mtime) for name, atime, mtime in conn.recv_manifest(FOLDER_TIMES)}
+                makedirs(self.logger, list(folders.keys()), cur_dir)
+                dirs_info.update(folders)
+                files = [name for name, in conn.recv_manifest(NAMES)]
+                conn.send_manifest(NAMES, ((name,) for name in files if os.path.exists(PurePath(cur_dir, name))))
+            total_size = conn.recv_size()
             concurrent.futures.wait(futures)
+            self.__wait_for_added_slaves()
+            self.__wait_for_writes()
+            self.__discard_unfinished_files(receiving_files)
 
             for dir_name, times in dirs_info.items():
                 folder = PurePath(cur_dir, dir_name)
@@ -122,93 +252,326 @@ class FTS:
                     os.utime(path=folder, times=times)
                 except Exception as error:
                     self.logger.warning(f'Folder {cur_dir} time modification failed, {error}', highlight=1)
+            if not total_size:
+                self.logger.info('No files to receive')
+                return
             show_bandwidth('Received folder', total_size, time.time() - start, self.logger, LEVEL.INFO)
 
-    def __recv_small_files(self, conn: ESocket, cur_dir, files_info):
-        real_path = Path("")
+    def __recv_small_files(self, conn: ESocket, cur_dir, files_info, total_size):
+        # 写入线程积压过多时暂停接收，由 TCP 流量控制使对方放慢发送
+        self.__write_slots.acquire()
+        submitted = False
+        try:
+            # 整批小文件一次性接收到同一个缓冲区中，交给写入线程按偏移写入各个文件
+            view = memoryview(bytearray(total_size))
+            codec, file_hash = self.__recv_data_flags(conn)
+            if codec:
+                for offset in range(0, total_size, COMPRESS_BLOCK_SIZE):
+                    codec.recv_into(conn, view[offset:], min(COMPRESS_BLOCK_SIZE, total_size - offset))
+            else:
+                conn.recv_into(view, total_size)
+            if file_hash:
+                file_hash.update(view)
+                digest_matched = hmac.compare_digest(digest_bytes(file_hash), conn.recv_data(DIGEST_SIZE))
+            conn.check_mac()
+            if file_hash and not digest_matched:
+                self.logger.error(f'Checksum mismatch, {len(files_info)} small files under {cur_dir} were '
+                                  f'discarded: {", ".join(name for name, _, _ in files_info[:3])}...', highlight=1)
+                return
+            future = self.__writer.submit(self.__write_small_files, cur_dir, files_info, view)
+            submitted = True
+            with self.__receiving_lock:
+                self.__pending_writes.append(future)
+        except ConnectionDisappearedError:
+            self.logger.warning(f'Connection was terminated unexpectedly and reception failed: '
+                                f'{len(files_info)} small files under {cur_dir}')
+        finally:
+            if not submitted:
+                self.__write_slots.release()
+
+    def __write_small_files(self, cur_dir, files_info, view: memoryview):
+        """
+        写入线程的工作，将一批小文件写入磁盘并修改文件时间
+        """
+        real_path, msgs, offset = Path(""), [], 0
         try:
-            msgs = []
             for filename, file_size, time_info in files_info:
                 real_path = Path(cur_dir, filename)
-                real_path.write_bytes(conn.recv_data(file_size))
+                real_path.write_bytes(view[offset:offset + file_size])
+                offset += file_size
                 modify_file_time(self.logger, str(real_path), *time_info)
                 msgs.append(f'[SUCCESS] {get_log_msg("Received")}: {real_path}\n')
             self.logger.success(f'Received: {len(files_info)} small files')
-            self.logger.silent_write(msgs)
-        except ConnectionDisappearedError:
-            self.logger.warning(f'Connection was terminated unexpectedly and reception failed: {real_path}')
-        except FileNotFoundError:
+        except OSError:
             self.logger.warning(f'File creation/opening failed that cannot be received: {real_path}', highlight=1)
+        finally:
+            self.logger.silent_write(msgs)
+            self.__write_slots.release()
+
+    def __wait_for_writes(self):
+        """
+        等待已接收的小文件全部写入磁盘
+        """
+        with self.__receiving_lock:
+            pending, self.__pending_writes = self.__pending_writes, []
+        concurrent.futures.wait(pending)
 
-    def __recv_large_file(self, conn: ESocket, cur_dir, filename, file_size):
-        original_file = avoid_filename_duplication(str(PurePath(cur_dir, filename)))
+    def __recv_data_flags(self, conn: ESocket):
+        """
+        接收对方发送的数据标记
+
+        @return: 解压所用的算法，校验数据所用的哈希对象，不需要时为 None
+        """
+        flags = DATA_FLAG(conn.recv_size())
+        if DATA_FLAG.COMPRESSED in flags and not self.__ftt.codec:
+            raise ValueError('Peer sent compressed data without a negotiated codec')
+        return (self.__ftt.codec if DATA_FLAG.COMPRESSED in flags else None,
+                new_hash(self.__ftt.hash_algorithm) if DATA_FLAG.DIGEST in flags else None)
+
+    def __prepare_receiving_file(self, conn: ESocket, cur_dir, filename, file_size,
+                                 receiving_files: dict[str, ReceivingFile]) -> ReceivingFile | None:
+        """
+        创建并预分配临时文件，登记到本次接收的文件表中，并告知对方尚未接收的数据区间
+
+        源文件的大小和修改时间与续传日志一致时，校验并保留临时文件中已接收的块
+        """
+        timestamps = times_struct.unpack(conn.recv_data(times_struct.size))
+        mtime = timestamps[1]
+        # 对方在回复前断开后重新发送该文件时，之前登记的文件不会再有数据写入
+        if previous := receiving_files.pop(filename, None):
+            previous.journal.close()
+        original_file = find_resume_file(str(PurePath(cur_dir, filename)), file_size, mtime)
         cur_download_file = f'{original_file}.ftsdownload'
         try:
+            journal = ResumeJournal.open(f'{original_file}.ftsjournal', cur_download_file, file_size, mtime)
             with open(cur_download_file, 'ab') as fp:
-                conn.send_size(size := os.path.getsize(cur_download_file))
-                rest_size = file_size - size
-                while rest_size >> 12:
-                    data, size = conn.recv()
-                    fp.write(data)
-                    rest_size -= size
-                fp.write(conn.recv_data(rest_size))
-            os.rename(cur_download_file, original_file)
-            self.logger.success(f'Received: {original_file}')
-            timestamps = times_struct.unpack(conn.recv_data(times_struct.size))
-            modify_file_time(self.logger, original_file, *timestamps)
-        except ConnectionDisappearedError:
-            self.logger.warning(f'Connection was terminated unexpectedly and reception failed: {original_file}')
-        except PermissionError as err:
-            self.logger.warning(f'Failed to rename: {cur_download_file} -> {original_file}, {err}')
-        except FileNotFoundError:
+                # 预分配文件大小，各分段直接按偏移写入
+                fp.truncate(file_size)
+        except OSError:
             self.logger.warning(f'File creation/opening failed that cannot be received: {original_file}', highlight=1)
-            conn.sendall(size_struct.pack(CONTROL.FAIL2OPEN))
+            conn.send_size(CONTROL.FAIL2OPEN)
+            return None
+        exist_size, missing_ranges = journal.received_size, journal.missing_ranges()
+        if exist_size:
+            self.logger.info(f'Resume {original_file}, {get_size(exist_size)} already received')
+        receiving_files[filename] = receiving = ReceivingFile(original_file, cur_download_file, file_size, exist_size,
+                                                              journal, timestamps)
+        conn.send_size(exist_size)
+        conn.send_data_with_size(b''.join(range_struct.pack(*missing_range) for missing_range in missing_ranges))
+        conn.send_mac()
+        return receiving
+
+    def __recv_file_range(self, conn: ESocket, receiving: ReceivingFile, offset: int, count: int):
+        """
+        接收文件的一段数据，由写入线程按偏移写入临时文件，接收与写入磁盘同时进行
+
+        缓冲区用完时暂停接收，直到写入线程归还缓冲区；续传日志记录的块在续传时会重新校验，
+        因此块可以在数据写入磁盘前记入日志
+        """
+        codec, file_hash = self.__recv_data_flags(conn)
+        # 该段数据之后还有摘要或 MAC 校验时，校验通过后才将接收完整的块记入续传日志
+        tracker = ChunkTracker(receiving.journal, offset, deferred=bool(file_hash) or isinstance(conn, MacSocket))
+        fp_lock, writes = threading.Lock(), []
+        with open(receiving.download_file, 'r+b') as fp:
+            try:
+                # 以 MB 级的块直接接收到缓冲区，需要校验时同时计算摘要
+                received = 0
+                while received < count:
+                    view = memoryview(buffer := self.__write_buffers.acquire())
+                    try:
+                        size = codec.recv_into(conn, view, min(count - received, COMPRESS_BLOCK_SIZE)) if codec \
+                            else conn.recv_into(view, min(count - received, buf_size))
+                    except BaseException:
+                        self.__write_buffers.release(buffer)
+                        raise
+                    if file_hash:
+                        file_hash.update(view[:size])
+                    tracker.update(view[:size])
+                    writes.append(self.__writer.submit(self.__write_range, fp, fp_lock, offset + received, buffer, size))
+                    received += size
+            finally:
+                concurrent.futures.wait(writes)
+        for write in writes:
+            write.result()
+        digest_matched = not file_hash or hmac.compare_digest(digest_bytes(file_hash), conn.recv_data(DIGEST_SIZE))
+        conn.check_mac()
+        if not digest_matched:
+            # 该段作废，文件不会完成，下次续传时重新接收该段
+            self.logger.error(f'Checksum mismatch at offset {offset} of {receiving.original_file}, '
+                              f'the file was not completed', highlight=1)
+            return
+        tracker.commit()
+        with self.__receiving_lock:
+            receiving.received_size += count
+
+    def __skip_file_range(self, conn: ESocket, filename, count: int):
+        """
+        丢弃不在接收中的文件的一段数据，如打开失败或已放弃接收的文件，使连接上后续的数据保持同步
+        """
+        codec, file_hash = self.__recv_data_flags(conn)
+        buffer = self.__write_buffers.acquire()
+        try:
+            with memoryview(buffer) as view:
+                received = 0
+                while received < count:
+                    received += codec.recv_into(conn, view, min(count - received, COMPRESS_BLOCK_SIZE)) if codec \
+                        else conn.recv_into(view, min(count - received, buf_size))
+        finally:
+            self.__write_buffers.release(buffer)
+        if file_hash:
+            conn.recv_data(DIGEST_SIZE)
+        conn.check_mac()
+        self.logger.warning(f'Discarded {get_size(count)} of {filename}, the file is not being received')
+
+    def __write_range(self, fp, fp_lock: threading.Lock, offset: int, buffer: bytearray, size: int):
+        """
+        写入线程的工作，将接收的一块数据写入文件的指定偏移，并归还缓冲区
+        """
+        try:
+            with fp_lock, memoryview(buffer) as view:
+                fp.seek(offset)
+                fp.write(view[:size])
+        finally:
+            self.__write_buffers.release(buffer)
+
+    def __finish_file(self, filename, receiving_files: dict[str, ReceivingFile]) -> bool:
+        """
+        文件所有分段都已接收时，重命名临时文件并修改文件时间
+
+        @return: 文件是否接收完成
+        """
+        with self.__receiving_lock:
+            receiving = receiving_files.get(filename)
+            if not receiving or receiving.received_size != receiving.file_size:
+                return False
+            del receiving_files[filename]
+        try:
+            os.rename(receiving.download_file, receiving.original_file)
+        except PermissionError as err:
+            self.logger.warning(f'Failed to rename: {receiving.download_file} -> {receiving.original_file}, {err}')
+            return False
+        receiving.journal.remove()
+        modify_file_time(self.logger, receiving.original_file, *receiving.timestamps)
+        self.logger.success(f'Received: {receiving.original_file}')
+        receiving.finished = True
+        return True
+
+    def __discard_unfinished_files(self, receiving_files: dict[str, ReceivingFile]):
+        """
+        保留未接收完成的临时文件及其续传日志，下次续传时只接收缺少的块
+        """
+        for receiving in receiving_files.values():
+            receiving.journal.close()
+            self.logger.warning(f'Connection was terminated unexpectedly and reception failed: '
+                                f'{receiving.original_file}')
+        receiving_files.clear()
+
+    def __recv_large_file(self, conn: ESocket, cur_dir, filename, file_size,
+                          receiving_files: dict[str, ReceivingFile]):
+        if not (receiving := self.__prepare_receiving_file(conn, cur_dir, filename, file_size, receiving_files)):
+            return
+        # 对方本次在该连接上发送的分段，其余分段可能由其他连接发送
+        for _ in range(conn.recv_size()):
+            offset = conn.recv_size()
+            self.__recv_file_range(conn, receiving, offset, conn.recv_size())
+        self.__finish_file(filename, receiving_files)
+
+    def __recv_single_file(self, conn: MuxStream, filename, file_size):
+        receiving_files = {}
+        try:
+            self.__recv_large_file(conn, self.__ftt.base_dir, filename, file_size, receiving_files)
+        finally:
+            self.__discard_unfinished_files(receiving_files)
 
-    def __slave_work(self, conn: ESocket, cur_dir):
+    def __recv_striped_file(self, conn: MuxStream, filename, file_size):
+        """
+        接收在所有数据连接上并行发送的单个大文件，各连接按偏移写入预分配的临时文件
+        """
+        with acquire_within(self.__ftt.busy_lock, BUSY_TIMEOUT) as acquired:
+            if not self.__reply_busy(conn, acquired):
+                return
+            receiving_files = {}
+            if not (receiving := self.__prepare_receiving_file(conn, self.__ftt.base_dir, filename, file_size,
+                                                               receiving_files)):
+                return
+            futures = [self.__ftt.executor.submit(self.__slave_work, data_conn, self.__ftt.base_dir,
+                                                  receiving_files) for data_conn in self.__ftt.connections]
+            self.__start_receiving(self.__ftt.base_dir, receiving_files)
+            concurrent.futures.wait(futures)
+            self.__wait_for_added_slaves()
+            # 通常已由接收最后一段的连接完成，没有需要接收的数据时在此完成
+            self.__finish_file(filename, receiving_files)
+            self.__discard_unfinished_files(receiving_files)
+            conn.send_size(CONTROL.CONTINUE if receiving.finished else CONTROL.CANCEL)
+
+    def __slave_work(self, conn: ESocket, cur_dir, receiving_files: dict[str, ReceivingFile]):
         """
         从连接的工作，只用于处理多文件接收
 
         @param conn: 从连接
+        @param receiving_files: 本次接收中尚未完成的大文件
         """
-        try:
-            while True:
+        while True:
+            try:
                 filename, command, file_size = conn.recv_head()
                 if command == COMMAND.SEND_LARGE_FILE:
-                    self.__recv_large_file(conn, cur_dir, filename, file_size)
+                    self.__recv_large_file(conn, cur_dir, filename, file_size, receiving_files)
+                elif command == COMMAND.SEND_FILE_RANGE:
+                    offset = conn.recv_size()
+                    if receiving := receiving_files.get(filename):
+                        self.__recv_file_range(conn, receiving, offset, file_size)
+                        self.__finish_file(filename, receiving_files)
+                    else:
+                        self.__skip_file_range(conn, filename, file_size)
                 elif command == COMMAND.SEND_SMALL_FILE:
-                    self.__recv_small_files(conn, cur_dir, conn.recv_with_decompress())
+                    files_info = [(name, size, (ctime, mtime, atime)) for name, size, ctime, mtime, atime in
+                                  conn.recv_manifest(FILE_INFO)]
+                    self.__recv_small_files(conn, cur_dir, files_info, file_size)
                 elif command == COMMAND.FINISH:
                     break
-        except ConnectionError:
-            return
-        except Exception as e:
-            msg = 'Peer data flow abnormality, connection disconnected' if isinstance(e, UnicodeDecodeError) else str(e)
-            self.logger.error(msg, highlight=1)
+            except Exception as e:
+                if not self.__ftt.connection_lost(conn, e):
+                    msg = 'Peer data flow abnormality, connection disconnected' if isinstance(e, UnicodeDecodeError) \
+                        else str(e)
+                    self.logger.error(msg, highlight=1)
+                    return
+                if isinstance(e, IntegrityError):
+                    self.logger.error(f'{e}, connection disconnected: {conn.getpeername()}', highlight=1)
+                # 数据连接断开后等待重新连接，对方会在新连接上重新发送未完成的文件
+                if not (conn := self.__ftt.reconnect(conn)):
+                    return
 
-    def execute(self, filename, command, file_size):
+    def execute(self, conn: MuxStream, filename, command, file_size):
         """
-        主连接的工作
+        执行对方在主连接的一路流上发来的命令
+
+        @param conn: 该命令所在的流
         """
         match command:
             case COMMAND.SEND_FILES_IN_FOLDER:
                 self.logger.info(f'Receiving folder: {filename}')
-                self.__recv_files_in_folder(Path(self.__ftt.base_dir, filename))
+                self.__recv_files_in_folder(conn, Path(self.__ftt.base_dir, filename))
             case COMMAND.SEND_LARGE_FILE:
                 self.logger.info(f'Receiving single file: {filename}, size: {get_size(file_size)}')
-                self.__recv_large_file(self.__main_conn, self.__ftt.base_dir, filename, file_size)
+                self.__recv_single_file(conn, filename, file_size)
+            case COMMAND.SEND_STRIPED_FILE:
+                self.logger.info(f'Receiving single file in parallel: {filename}, size: {get_size(file_size)}')
+                self.__recv_striped_file(conn, filename, file_size)
             case COMMAND.COMPARE_FOLDER:
-                self.__compare_folder(filename)
+                self.__compare_folder(conn, filename)
             case COMMAND.FORCE_SYNC_FOLDER:
-                self.__force_sync_folder(filename)
+                self.__force_sync_folder(conn, filename)
             case COMMAND.EXECUTE_COMMAND:
-                self.__execute_command(filename)
+                self.__execute_command(conn, filename)
             case COMMAND.SYSINFO:
-                self.__main_conn.send_with_compress(get_sys_info())
+                conn.send_with_compress(get_sys_info())
             case COMMAND.SPEEDTEST:
-                self.__speedtest(file_size)
+                self.__speedtest(conn, file_size)
             case COMMAND.CHAT:
                 self.logger.log(f'{self.__ftt.peer_username} said: {filename}')
             case COMMAND.PULL_CLIPBOARD:
-                send_clipboard(self.__main_conn, self.logger, ftc=False)
+                send_clipboard(conn, self.logger, ftc=False)
+            case COMMAND.ADD_CONNECTION:
+                self.__add_connection(conn, file_size)
             case COMMAND.PUSH_CLIPBOARD:
-                get_clipboard(self.__main_conn, self.logger, filename, command, file_size, ftc=False)
+                get_clipboard(conn, self.logger, filename, command, file_size, ftc=False)
@@ -1,6 +1,7 @@
 import signal
 import struct
 import select
+import multiprocessing
 
 from ftt_lib import *
 from ftt_base import FTTBase
@@ -8,20 +9,44 @@ from ftt_sn import FTTSn
 
 
 class FTT(FTTBase):
-    def __init__(self, password, host, base_dir, threads):
-        super().__init__(threads, False)
+    def __init__(self, password, host, base_dir, threads, data_channel=DATA_CHANNEL.TLS, compress=False,
+                 hash_algorithm=None, verify=False, auto_tune=False):
+        super().__init__(threads, False, hash_algorithm)
         self.peer_username: str = ...
         self.peer_platform: str = ...
         self.base_dir: Path = base_dir.expanduser().absolute()
-        self.main_conn_recv: ESocket = ...
-        self.main_conn: ESocket = ...
+        # 主连接上复用多路命令流，main_conn 上由本方打开流发送命令，main_conn_recv 上接收对方的命令
+        self.main_conn_recv: Multiplexer = ...
+        self.main_conn: Multiplexer = ...
         self.busy_lock: threading.Lock = threading.Lock()
         self.connections: list[ESocket] = []
+        # 双方协商的压缩算法，以及本方发送文件时是否压缩
+        self.codec: BlockCodec | None = None
+        self.compress: bool = compress
+        # 本方发送文件数据时是否附带摘要，由对方边接收边校验
+        self.verify: bool = verify
+        # 本方发送文件时是否按吞吐量自动调整数据连接数
+        self.auto_tune: bool = auto_tune
         self.__ftc: FTC = ...
         self.__fts: FTS = ...
         self.__host: str = host
+        self.__port: int = config.server_port
         self.__alive: bool = True
         self.__password: str = password
+        self.__data_channel: DATA_CHANNEL = data_channel
+        # 重新建立数据连接所需的会话凭证及 SSLContext，只由发起连接的一方重新连接
+        self.__voucher: bytes = ...
+        self.__data_context: ssl.SSLContext = ...
+        # kTLS 模式下内核是否接管了数据连接的加密，变化时记录日志
+        self.__ktls_send: bool | None = None
+        self.__is_client: bool = False
+        # 数据连接的缓冲区及拥塞控制算法，主连接只传输命令，关闭 Nagle 算法
+        self.__socket_profile: SocketProfile = SocketProfile()
+        # 已断开的数据连接及替换它的新连接
+        self.__replaced: dict[ESocket, ESocket] = {}
+        self.__reconnected: threading.Condition = threading.Condition()
+        # 正在执行对方命令的线程
+        self.__command_threads: list[threading.Thread] = []
 
     def __change_base_dir(self, new_base_dir: str):
         """
@@ -37,37 +62,250 @@ class FTT(FTTBase):
             self.base_dir = new_base_dir
             self.logger.success(f'File save location changed to: {new_base_dir}')
 
+    def __create_data_context(self, purpose: ssl.Purpose, cert_path=None) -> ssl.SSLContext:
+        """
+        创建数据连接所用的 SSLContext，kTLS 模式下尝试开启内核 TLS 卸载
+        """
+        context = ssl.create_default_context(purpose)
+        if purpose == ssl.Purpose.SERVER_AUTH:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        else:
+            context.load_cert_chain(cert_path)
+        if self.__data_channel == DATA_CHANNEL.KTLS:
+            context.options |= ssl.OP_ENABLE_KTLS
+        return context
+
+    def __agree_data_channel(self, peer_data_channel: str):
+        """
+        双方选择相同的数据通道时才使用该通道，否则使用 TLS
+        """
+        if peer_data_channel != self.__data_channel:
+            if self.__data_channel != DATA_CHANNEL.TLS:
+                self.logger.warning(f'Peer uses data channel {peer_data_channel or DATA_CHANNEL.TLS}, '
+                                    f'fall back to {DATA_CHANNEL.TLS}')
+            self.__data_channel = DATA_CHANNEL.TLS
+        if self.__data_channel == DATA_CHANNEL.KTLS and not hasattr(ssl, 'OP_ENABLE_KTLS'):
+            self.logger.warning('Kernel TLS is not supported by this Python/OpenSSL build, use tls instead')
+            self.__data_channel = DATA_CHANNEL.TLS
+        if self.__data_channel != DATA_CHANNEL.TLS:
+            self.logger.info(f'Data channel: {self.__data_channel}')
+
+    def __agree_codec(self, codec: str | None):
+        self.codec = BlockCodec(codec) if codec else None
+        if self.compress:
+            if self.codec:
+                self.logger.info(f'Compress file data with {codec}')
+            else:
+                self.logger.warning('No compression codec supported by both sides, send file data uncompressed')
+
     def __connect(self):
         try:
             context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
             context.check_hostname = False
             context.verify_mode = ssl.CERT_NONE
-            voucher = self.__password.encode() + self.__first_connect(context, self.__host)
-            for i in range(0, self.threads + 1):
-                client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                client_socket.connect((self.__host, config.server_port))
-                client_socket = ESocket(context.wrap_socket(client_socket, server_hostname='FTS'))
-                client_socket.sendall(voucher)
-                self.connections.append(client_socket)
-            self.main_conn_recv = self.connections.pop()
+            self.__voucher = self.__password.encode() + self.__first_connect(context, self.__host)
+            self.__data_context = self.__create_data_context(ssl.Purpose.SERVER_AUTH)
+            self.__is_client = True
+            # 按握手时测得的往返时延确定数据连接的参数
+            self.__socket_profile = derive_socket_profile(self.logger, self.main_conn.rtt(),
+                                                          self.main_conn.getsockname()[0])
+            # 先建立数据连接，最后建立用于接收命令的主连接
+            for _ in range(self.threads):
+                self.connections.append(self.__open_data_connection())
+            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            tune_control_socket(client_socket)
+            client_socket.connect((self.__host, self.__port))
+            self.main_conn_recv = ESocket(context.wrap_socket(client_socket, server_hostname='FTS'))
+            self.main_conn_recv.sendall(self.__voucher)
         except (ssl.SSLError, OSError) as msg:
             self.logger.error(f'Failed to connect to the server {self.__host}, {msg}')
             pause_before_exit(-1)
 
+    def __open_data_connection(self) -> ESocket:
+        """
+        建立一个数据连接并以会话凭证认证
+        """
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        apply_socket_profile(client_socket, self.__socket_profile)
+        client_socket.connect((self.__host, self.__port))
+        enable_keepalive(client_socket)
+        if self.__data_channel == DATA_CHANNEL.PLAIN:
+            return create_mac_socket(client_socket, self.__voucher, is_client=True)
+        client_socket = self.__wrap_tls_connection(self.__data_context.wrap_socket(client_socket,
+                                                                                  server_hostname='FTS'))
+        client_socket.sendall(self.__voucher)
+        return client_socket
+
+    def __accept_data_connection(self, conn: socket.socket) -> ESocket | None:
+        """
+        接受一个数据连接，会话凭证不正确时返回 None
+        """
+        enable_keepalive(conn)
+        if self.__data_channel == DATA_CHANNEL.PLAIN:
+            return create_mac_socket(conn, self.__voucher, is_client=False)
+        conn = self.__wrap_tls_connection(self.__data_context.wrap_socket(conn, server_side=True))
+        return conn if conn.recv_data(len(self.__voucher)) == self.__voucher else None
+
+    def __wrap_tls_connection(self, conn: ssl.SSLSocket) -> ESocket:
+        """
+        kTLS 模式下确认内核已接管发送方向的加密后才由内核直接发送文件数据，否则与 TLS 模式相同
+        """
+        if self.__data_channel != DATA_CHANNEL.KTLS:
+            return ESocket(conn)
+        enabled = ktls_send_enabled(conn)
+        if enabled != self.__ktls_send:
+            self.__ktls_send = enabled
+            if enabled:
+                self.logger.info('Kernel TLS is enabled on data connections, file data is sent with sendfile')
+            else:
+                self.logger.warning('Kernel TLS is not enabled by the kernel (is the tls module loaded?), '
+                                    'file data is encrypted in user space')
+        return KtlsSocket(conn) if enabled else ESocket(conn)
+
+    def __replace_connection(self, index: int, conn: ESocket):
+        # 旧连接可能仍有线程在读取其中剩余的数据，由使用它的线程在 reconnect 中关闭
+        with self.__reconnected:
+            self.__replaced[self.connections[index]] = conn
+            self.connections[index] = conn
+            self.__reconnected.notify_all()
+
+    def connection_lost(self, conn: ESocket, error: Exception) -> bool:
+        """
+        判断数据连接上出现的异常是否由连接断开引起，已被替换的连接上出现的任何 OSError (如 EBADF) 也视为断开
+        """
+        if isinstance(error, CONNECTION_ERRORS):
+            return True
+        with self.__reconnected:
+            return isinstance(error, OSError) and conn in self.__replaced
+
+    def reconnect(self, conn: ESocket) -> ESocket | None:
+        """
+        数据连接断开后重新建立连接，发起连接的一方重新连接并认证，另一方等待对方重新连接；
+        对方已重新连接时直接返回新连接，正在进行的传输可在新连接上继续
+
+        @param conn: 已断开的数据连接
+        @return: 替换它的新连接，无法重新连接时为 None
+        """
+        with self.__reconnected:
+            new_conn = conn
+            while new_conn in self.__replaced:
+                new_conn = self.__replaced[new_conn]
+            if new_conn is conn and conn not in self.connections:
+                return None
+            index = self.connections.index(new_conn)
+        # 旧连接只由使用它的线程关闭，对方可能仍阻塞在旧连接上，直接重置使其立即发现连接已断开
+        try:
+            conn.abort()
+        except OSError:
+            pass
+        if new_conn is not conn:
+            return new_conn
+        if not self.__is_client:
+            deadline = time.time() + RECONNECT_TIMEOUT
+            with self.__reconnected:
+                while conn not in self.__replaced and self.__alive and time.time() < deadline:
+                    self.__reconnected.wait(1)
+                if conn not in self.__replaced:
+                    self.logger.error(f'Peer did not reconnect data connection {index + 1}', highlight=1)
+                return self.__replaced.get(conn)
+        for attempt in range(1, RECONNECT_ATTEMPTS + 1):
+            if not self.__alive:
+                return None
+            try:
+                new_conn = self.__open_data_connection()
+                new_conn.send_size(index)
+                break
+            except (ssl.SSLError, OSError) as error:
+                self.logger.warning(f'Failed to reconnect data connection {index + 1} '
+                                    f'({attempt}/{RECONNECT_ATTEMPTS}): {error}')
+                time.sleep(RECONNECT_INTERVAL * attempt)
+        else:
+            return None
+        self.__replace_connection(index, new_conn)
+        self.logger.info(f'Data connection {index + 1} reconnected')
+        return new_conn
+
+    def add_connection(self, conn: MuxStream, index: int) -> ESocket | None:
+        """
+        传输过程中增加一个数据连接：发起连接的一方建立连接并认证，再在流上告知对方结果；另一方等待接受该连接
+
+        @param conn: 双方协商增加连接所用的流
+        @param index: 新连接的序号，即当前的连接数
+        @return: 新的数据连接，无法建立时为 None
+        """
+        if self.__is_client:
+            try:
+                new_conn = self.__open_data_connection()
+                new_conn.send_size(index)
+            except (ssl.SSLError, OSError) as error:
+                self.logger.warning(f'Failed to open data connection {index + 1}: {error}')
+                conn.send_size(CONTROL.CANCEL)
+                return None
+            with self.__reconnected:
+                self.connections.append(new_conn)
+            conn.send_size(CONTROL.CONTINUE)
+            return new_conn
+        if conn.recv_size() != CONTROL.CONTINUE:
+            return None
+        with self.__reconnected:
+            if not self.__reconnected.wait_for(lambda: len(self.connections) > index, RECONNECT_INTERVAL * 5):
+                self.logger.warning(f'Peer did not open data connection {index + 1}')
+                return None
+            return self.connections[index]
+
+    def __accept_reconnections(self, server_socket: socket.socket, peer_ip):
+        """
+        接受对方重新建立的数据连接，替换已断开的数据连接
+        """
+        with server_socket:
+            while self.__alive:
+                if not select.select([server_socket], [], [], 0.5)[0]:
+                    continue
+                conn, (ip, _) = server_socket.accept()
+                if ip != peer_ip:
+                    conn.close()
+                    continue
+                conn.settimeout(4)
+                try:
+                    if not (conn := self.__accept_data_connection(conn)):
+                        continue
+                    conn.settimeout(4)
+                    index = conn.recv_size()
+                    conn.settimeout(None)
+                except (ssl.SSLError, OSError) as error:
+                    self.logger.warning(f'Failed to accept data connection from {ip}: {error}')
+                    continue
+                if 0 <= index < len(self.connections):
+                    self.__replace_connection(index, conn)
+                    self.logger.info(f'Data connection {index + 1} reconnected')
+                elif index == len(self.connections):
+                    # 对方在传输过程中增加的数据连接
+                    with self.__reconnected:
+                        self.connections.append(conn)
+                        self.__reconnected.notify_all()
+
     def __first_connect(self, context, host):
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tune_control_socket(client_socket)
         # 连接至服务器
-        client_socket.connect((host, config.server_port))
+        client_socket.connect((host, self.__port))
         # 将socket包装为securitySocket
         client_socket = ESocket(context.wrap_socket(client_socket, server_hostname='FTS'))
         client_socket.send_head(f'{self.__password}', COMMAND.BEFORE_WORKING, self.threads)
         client_socket.send_head(f'{cur_platform}_{username}', COMMAND.BEFORE_WORKING, 0)
+        client_socket.send_head(pack_options(data_channel=self.__data_channel, codecs=','.join(available_codecs()),
+                                             hashes=','.join(self.hash_algorithms)), COMMAND.BEFORE_WORKING, 0)
         client_socket.sendall(connect_id := os.urandom(64))
         msg, _, threads = client_socket.recv_head()
         if msg == FAIL:
             self.logger.error('Wrong password to connect to server', highlight=1)
             client_socket.close()
             pause_before_exit(-1)
+        options = parse_options(client_socket.recv_head()[0])
+        self.__agree_data_channel(options.get('data_channel'))
+        self.__agree_codec(options.get('codec'))
+        self.hash_algorithm = options.get('hash', 'md5')
         # self.logger.info(f'服务器所在平台: {msg}\n')
         self.peer_platform, *peer_username = msg.split('_')
         if self.threads != threads:
@@ -80,7 +318,7 @@ class FTT(FTTBase):
     def _shutdown(self, send_info=True):
         try:
             if send_info:
-                self.main_conn.send_head('', COMMAND.CLOSE, 0)
+                self.main_conn.open_stream(PRIORITY.HIGH).send_head('', COMMAND.CLOSE, 0)
             for conn in self.connections + [self.main_conn_recv, self.main_conn]:
                 if conn is not ...:
                     conn.close()
@@ -93,12 +331,13 @@ class FTT(FTTBase):
                 os.system('pause')
             os.kill(os.getpid(), signal.SIGINT)
 
-    def __verify_connection(self, conn: ESocket):
+    def __verify_connection(self, conn: ESocket, server_socket: socket.socket):
         peer_ip, peer_port = conn.getpeername()
         conn.settimeout(4)
         try:
             password, command, threads = conn.recv_head()
             info, _, _ = conn.recv_head()
+            options, _, _ = conn.recv_head()
             peer_platform, *peer_username = info.split('_')
         except (TimeoutError, struct.error) as error:
             conn.close()
@@ -116,13 +355,27 @@ class FTT(FTTBase):
             conn.close()
             self.logger.warning(f'Client {peer_ip}:{peer_port} password("{password}") is wrong')
             return
+        # 对方收到回复后立即建立数据连接，接受的连接沿用监听套接字的设置，因此在回复前设置
+        self.__socket_profile = derive_socket_profile(self.logger, conn.rtt(), conn.getsockname()[0])
+        apply_socket_profile(server_socket, self.__socket_profile)
+        options = parse_options(options)
+        self.__agree_data_channel(options.get('data_channel'))
+        # 选择对方优先级最高且本方也支持的压缩算法
+        self.__agree_codec(next((codec for codec in options.get('codecs', '').split(',')
+                                 if codec in available_codecs()), None))
+        # 选择对方优先级最高且本方也支持的哈希算法，旧版本的对方只支持 md5
+        self.hash_algorithm = next((algorithm for algorithm in options.get('hashes', 'md5').split(',')
+                                    if algorithm in self.hash_algorithms), 'md5')
+        conn.send_head(pack_options(data_channel=self.__data_channel, codec=self.codec.name if self.codec else '',
+                                    hash=self.hash_algorithm), COMMAND.BEFORE_WORKING, 0)
 
         self.peer_platform = peer_platform
         self.peer_username = '_'.join(peer_username)
         if self.threads != threads:
             self.logger.info(f"Thread count mismatch, use a lower value: {min(self.threads, threads)}")
         self.threads = min(self.threads, threads)
-        return self.__password.encode() + conn.recv_data(64)
+        self.__voucher = self.__password.encode() + conn.recv_data(64)
+        return self.__voucher
 
     def __waiting_connect(self, ip):
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -135,28 +388,41 @@ class FTT(FTTBase):
         # 加载服务器所用证书和私钥
         context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
         context.load_cert_chain(cert_path := generate_cert())
-        os.remove(cert_path)
         peer_ip, voucher = None, None
         while True:
             try:
                 if not select.select([server_socket], [], [], 0.2)[0]:
                     continue
                 conn, (peer_ip, _) = server_socket.accept()
+                tune_control_socket(conn)
                 conn = ESocket(context.wrap_socket(conn, server_side=True))
-                if voucher := self.__verify_connection(conn):
+                if voucher := self.__verify_connection(conn, server_socket):
                     self.main_conn_recv = conn
                     self.__host = peer_ip
                     break
             except KeyboardInterrupt:
+                os.remove(cert_path)
                 self._shutdown(send_info=False)
+        # 数据通道已协商完成
+        self.__data_context = self.__create_data_context(ssl.Purpose.CLIENT_AUTH, cert_path)
+        os.remove(cert_path)
         while len(self.connections) < self.threads + 1:
             try:
                 if not select.select([server_socket], [], [], 0.1)[0]:
                     continue
                 conn, (ip, port) = server_socket.accept()
-                conn = ESocket(context.wrap_socket(conn, server_side=True))
-                if ip != peer_ip or conn.recv_data(len(voucher)) != voucher:
+                if ip != peer_ip:
+                    conn.close()
                     continue
+                # 先接受数据连接，最后一个为用于发送命令的主连接
+                if len(self.connections) < self.threads:
+                    if not (conn := self.__accept_data_connection(conn)):
+                        continue
+                else:
+                    tune_control_socket(conn)
+                    conn = ESocket(context.wrap_socket(conn, server_side=True))
+                    if conn.recv_data(len(voucher)) != voucher:
+                        continue
                 self.connections.append(conn)
             except ssl.SSLError as e:
                 self.logger.warning(f'SSLError: {e.reason}')
@@ -164,8 +430,10 @@ class FTT(FTTBase):
                 self.logger.warning(f'Connection timeout')
             except KeyboardInterrupt:
                 self._shutdown(send_info=False)
-        server_socket.close()
         self.main_conn = self.connections.pop()
+        # 继续监听，以便对方重新建立断开的数据连接
+        threading.Thread(name='ReconnectThread', target=self.__accept_reconnections, args=(server_socket, peer_ip),
+                         daemon=True).start()
 
     def __find_server(self, ip):
         sk = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
@@ -209,7 +477,7 @@ class FTT(FTTBase):
         if self.__host:
             # 处理ip和端口
             if len(splits := self.__host.split(":")) == 2:
-                self.__host, config.server_port = splits[0], int(splits[1])
+                self.__host, self.__port = splits[0], int(splits[1])
             self.__connect()
         else:
             ip = get_ip()
@@ -218,35 +486,71 @@ class FTT(FTTBase):
                 self.__waiting_connect(ip)
             else:
                 self.__find_server(ip)
-        self.logger.success(f'Connected to peer {self.peer_username}({self.__host}:{config.server_port})')
-        self.executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix=compact_ip(self.__host))
+        self.logger.success(f'Connected to peer {self.peer_username}({self.__host}:{self.__port})')
+        self.main_conn, self.main_conn_recv = Multiplexer(self.main_conn), Multiplexer(self.main_conn_recv)
+        # 每个数据连接在收发文件时各占一个线程，自动调整时连接数最多增加到 MAX_CONNECTIONS
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(self.threads, MAX_CONNECTIONS),
+                                                              thread_name_prefix=compact_ip(self.__host))
         self.__ftc, self.__fts = FTC(ftt=self), FTS(ftt=self)
         threading.Thread(name='SeverThread', target=self.__server, daemon=True).start()
         self.logger.info(f'Current threads: {self.threads}')
         self.logger.log(f'Current file storage location: {os.path.normcase(self.base_dir)}')
 
+    def __serve_command(self, conn: MuxStream):
+        """
+        执行对方在一路流上发来的命令，各命令在各自的线程中执行，互不阻塞
+        """
+        with conn:
+            try:
+                filename, command, file_size = conn.recv_head()
+            except ConnectionDisappearedError:
+                # 对方未发送命令就关闭了流
+                return
+            if command == COMMAND.CLOSE:
+                # 对方在之前的命令结束后才关闭，等待本方执行完这些命令 (如写完已接收的文件)
+                for thread in self.__command_threads:
+                    if thread is not threading.current_thread():
+                        thread.join()
+                self.logger.info(f'Peer closed connections')
+                self.__alive = False
+                self.main_conn_recv.close()
+                return
+            try:
+                self.__fts.execute(conn, filename, command, file_size)
+            except (ConnectionError, ssl.SSLError) as e:
+                if self.__alive:
+                    self.logger.error(f'{e.strerror or e}')
+            except UnicodeDecodeError:
+                self.logger.error(f'Peer data flow abnormality, connection disconnected')
+
     def __server(self):
         try:
             while self.__alive:
-                filename, command, file_size = self.main_conn_recv.recv_head()
-                if command == COMMAND.CLOSE:
-                    self.logger.info(f'Peer closed connections')
-                    break
-                self.__fts.execute(filename, command, file_size)
-        except (ConnectionDisappearedError, ssl.SSLEOFError) as e:
+                conn = self.main_conn_recv.accept_stream()
+                thread = threading.Thread(name='CommandThread', target=self.__serve_command, args=(conn,), daemon=True)
+                self.__command_threads = [thread for thread in self.__command_threads if thread.is_alive()] + [thread]
+                thread.start()
+        except ConnectionDisappearedError as e:
             if self.__alive:
                 self.logger.error(f'{e}')
-        except ConnectionResetError as e:
-            if self.__alive:
-                self.logger.error(f'{e.strerror}')
-        except UnicodeDecodeError:
-            self.logger.error(f'Peer data flow abnormality, connection disconnected')
         finally:
             if not self.busy_lock.locked():
                 self._shutdown(send_info=False)
             else:
                 self.__alive = False
 
+    def execute(self, command: str):
+        """
+        执行一条命令，发送文件或文件夹时加入发送队列后立即返回
+        """
+        if command.startswith(setbase):
+            self.__change_base_dir(command[8:])
+        else:
+            self.__ftc.execute(command)
+
+    def wait_for_jobs(self):
+        self.__ftc.wait_for_jobs()
+
     def start(self):
         self._boot()
         try:
@@ -256,12 +560,10 @@ class FTT(FTTBase):
                     continue
                 self._add_history(command)
                 if command in ['q', 'quit', 'exit']:
+                    self.wait_for_jobs()
                     self.__alive = False
                     break
-                elif command.startswith(setbase):
-                    self.__change_base_dir(command[8:])
-                    continue
-                self.__ftc.execute(command)
+                self.execute(command)
         except (ssl.SSLError, ConnectionError) as e:
             self.logger.error(e.strerror if e.strerror else e, highlight=1)
         finally:
@@ -269,7 +571,12 @@ class FTT(FTTBase):
 
 
 if __name__ == '__main__':
+    # 打包后计算哈希的进程池需要
+    multiprocessing.freeze_support()
     args = get_args()
-    ftt: FTTBase = FTT(password=args.password, host=args.host, base_dir=args.dest,
-                       threads=args.t) if not args.single else FTTSn(threads=args.t)
+    ftt: FTTBase = FTT(password=args.password, host=args.host, base_dir=args.dest, threads=args.t,
+                       data_channel=args.data_channel, compress=args.compress,
+                       hash_algorithm=args.hash_algorithm, verify=args.verify,
+                       auto_tune=args.auto_tune) if not args.single else FTTSn(
+        threads=args.t, hash_algorithm=args.hash_algorithm)
     ftt.start()
@@ -5,11 +5,17 @@ from send2trash import send2trash
 
 
 class FTTBase:
-    def __init__(self, threads: int, single_mode: bool):
+    def __init__(self, threads: int, single_mode: bool, hash_algorithm: str | None = None):
         self.threads: int = threads
+        # 本方支持的文件哈希算法，指定算法时保留 md5 以兼容对方
+        self.hash_algorithms: list[str] = list(dict.fromkeys([hash_algorithm, 'md5'])) if hash_algorithm \
+            else available_hashes()
+        self.hash_algorithm: str = self.hash_algorithms[0]
         self.executor: concurrent.futures.ThreadPoolExecutor = ...
         self._history_file: TextIO = open(read_line_setup(single_mode), 'a', encoding=utf8)
         self.logger: Logger = Logger(PurePath(config.log_dir, f'{datetime.now():%Y_%m_%d}_ftt.log'))
+        # 比较文件夹时使用的哈希缓存
+        self.cache_dir: PurePath = PurePath(config.log_dir, 'hash_cache')
 
     def _add_history(self, command: str):
         readline.add_history(command)
@@ -18,12 +18,14 @@ def get_args() -> Namespace:
     """
     epilog = """
 commands:
-  > file/folder:        Send single file or entire folder to peer.
+  > file/folder:        Send single file or entire folder to peer, it is queued as a job and sent in order.
     example:            D:\\test.txt
+  > jobs:               List queued, running and finished send jobs.
   > [command]:          Execute command on peer.
     example:            ipconfig
-  > speedtest [size]:   Test the network speed between two sides, size is optional in MB, default is 500MB. 
-    example:            speedtest 1000
+  > speedtest [size] [json]: Test latency, upload, download and bidirectional speed on all data connections,
+                        size is optional in MB per direction, default is 500MB. json prints the result as JSON.
+    example:            speedtest 1000 json
   > sysinfo:            Get system information in both side.
   > history:            Get the command history.
   > say [message]:      Send a message to peer.
@@ -51,6 +53,26 @@ commands:
     parser.add_argument('-d', '--dest', metavar='base_dir', type=Path,
                         help='File save location (default: {})'.format(config.default_path),
                         default=config.default_path)
+    parser.add_argument('-dc', '--data-channel', metavar='mode', type=DATA_CHANNEL, dest='data_channel',
+                        choices=list(DATA_CHANNEL), default=DATA_CHANNEL.TLS,
+                        help='Data connection mode, both sides must choose the same mode, otherwise tls is used: '
+                             'tls, ktls (kernel TLS offload; file data is sent zero-copy only when the kernel accepts it, '
+                             'otherwise the same as tls), plain (unencrypted but authenticated, zero-copy, '
+                             'only for trusted networks). The main connection always uses TLS. (default: tls)')
+    parser.add_argument('-c', '--compress', action='store_true', dest='compress',
+                        help='Compress file data when sending (zstd or lz4 if installed, otherwise zlib), '
+                             'files that are already compressed are sent as is.')
+    parser.add_argument('--hash', metavar='algorithm', dest='hash_algorithm', choices=available_hashes(),
+                        help='Hash algorithm used to compare files: xxh3 and blake3 if installed, blake2b, md5. '
+                             'The fastest one supported by both sides is used by default, md5 is kept for '
+                             'compatibility.')
+    parser.add_argument('--verify', action='store_true', dest='verify',
+                        help='Hash file data while sending with the negotiated algorithm, the receiver checks it '
+                             'while writing and discards the data on mismatch.')
+    parser.add_argument('--auto-tune', action='store_true', dest='auto_tune',
+                        help='Adjust the number of data connections while sending files by the measured throughput '
+                             'and RTT, -t sets the initial number. Connections are added up to '
+                             f'{MAX_CONNECTIONS}.')
     return parser.parse_args()
 
 complete_commands = []
@@ -120,6 +142,157 @@ def generate_cert():
     return path
 
 
+def pack_options(**options) -> str:
+    """
+    将握手时协商的会话选项打包为 key=value;key=value 形式的字符串
+    """
+    return ';'.join(f'{key}={value}' for key, value in options.items())
+
+
+def parse_options(options: str) -> dict[str, str]:
+    return dict(option.split('=', 1) for option in options.split(';') if '=' in option)
+
+
+def enable_keepalive(sock: socket.socket):
+    """
+    开启数据连接的 TCP 保活，使网络中断后双方都能较快发现连接已失效，以便重新连接
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (('TCP_KEEPIDLE', 30), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 3), ('TCP_USER_TIMEOUT', 60000)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+def tune_control_socket(sock: socket.socket):
+    """
+    主连接上传输命令及多路复用的小帧，关闭 Nagle 算法，避免小帧等待对方确认后才发送
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+@dataclass
+class SocketProfile:
+    """
+    数据连接的套接字参数，0 或空字符串表示使用系统默认值
+    """
+    send_buffer: int = 0
+    recv_buffer: int = 0
+    congestion_control: str = ''
+
+
+def link_speed(local_ip: str) -> int:
+    """
+    @return: 本机地址所在网卡的速率 (Mbps)，未知时为 0
+    """
+    stats = psutil.net_if_stats()
+    for interface, addresses in psutil.net_if_addrs().items():
+        if any(addr.family == socket.AF_INET and addr.address == local_ip for addr in addresses):
+            return stats[interface].speed if interface in stats else 0
+    return 0
+
+
+def net_sysctl(name: str) -> int:
+    """
+    读取 Linux 网络参数的最后一个值，如 ipv4/tcp_rmem 的最大值，其他平台为 0
+    """
+    try:
+        with open(f'/proc/sys/net/{name}') as f:
+            return int(f.read().split()[-1])
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def congestion_control_available(name: str) -> bool:
+    if not hasattr(socket, 'TCP_CONGESTION'):
+        return False
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CONGESTION, name.encode())
+            return True
+        except OSError:
+            return False
+
+
+def derive_socket_profile(logger: Logger, rtt: float | None, local_ip: str) -> SocketProfile:
+    """
+    按配置文件及带宽时延积确定数据连接的套接字参数：缓冲区为带宽时延积的两倍，
+    系统自动调整能达到该大小时不设置，以免关闭系统的自动调整
+
+    @param rtt: 主连接测得的往返时延(秒)
+    @param local_ip: 本机连接对方所用的地址，用于查找网卡速率
+    """
+    bandwidth = config.bandwidth or link_speed(local_ip)
+    bdp = int(bandwidth * 1000 * 1000 / 8 * rtt) if bandwidth and rtt else 0
+    buffer = min(2 * bdp, 1 << MAX_SOCKET_BUFFER)
+    profile = SocketProfile(
+        config.socket_buffer_size or
+        (buffer if buffer > (net_sysctl('ipv4/tcp_wmem') or 1 << SOCKET_BUFFER_AUTOTUNE) else 0),
+        config.socket_buffer_size or
+        (buffer if buffer > (net_sysctl('ipv4/tcp_rmem') or 1 << SOCKET_BUFFER_AUTOTUNE) else 0),
+        config.congestion_control)
+    # Linux 上手动设置的缓冲区不能超过系统上限
+    for size, name in ((profile.send_buffer, 'core/wmem_max'), (profile.recv_buffer, 'core/rmem_max')):
+        if size > (limit := net_sysctl(name) or size):
+            logger.warning(f'Socket buffer is limited to {get_size(limit)} by net.{name.replace("/", ".")}, '
+                           f'raise it to {size} for this link')
+    if profile.congestion_control and not congestion_control_available(profile.congestion_control):
+        logger.warning(f'Congestion control {profile.congestion_control} is not available, use the system default')
+        profile.congestion_control = ''
+    if bdp:
+        logger.info(f'Bandwidth-delay product: {get_size(bdp)} ({bandwidth}Mbps x {rtt * 1000:.1f}ms)')
+    if profile.send_buffer or profile.recv_buffer or profile.congestion_control:
+        logger.info(f'Data connections: send buffer {get_size(profile.send_buffer) if profile.send_buffer else "auto"}'
+                    f', receive buffer {get_size(profile.recv_buffer) if profile.recv_buffer else "auto"}'
+                    f', congestion control {profile.congestion_control or "default"}')
+    return profile
+
+
+def apply_socket_profile(sock: socket.socket, profile: SocketProfile):
+    """
+    设置数据连接的缓冲区及拥塞控制算法，须在建立连接或监听前设置，使窗口缩放因子按缓冲区大小协商；
+    接受的连接沿用监听套接字的设置
+    """
+    if profile.send_buffer:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, profile.send_buffer)
+    if profile.recv_buffer:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, profile.recv_buffer)
+    if profile.congestion_control:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CONGESTION, profile.congestion_control.encode())
+
+
+def create_mac_socket(sock: socket.socket, voucher: bytes, is_client: bool) -> MacSocket | None:
+    """
+    明文数据连接的认证：服务端发送随机数，客户端返回以会话凭证为密钥的摘要，
+    认证通过后以该随机数派生出双向的数据校验密钥
+
+    @param sock: 未加密的连接
+    @param voucher: 会话凭证，仅经由 TLS 主连接交换过
+    @param is_client: 是否为发起连接的一方
+    @return: 认证失败时返回 None
+    """
+    session_key = blake2b(voucher).digest()
+    sock.settimeout(4)
+    try:
+        if is_client:
+            nonce = ESocket(sock).recv_data(32)
+            sock.sendall(blake2b(nonce, key=session_key, person=b'ftt-auth').digest())
+        else:
+            sock.sendall(nonce := os.urandom(32))
+            if not hmac.compare_digest(ESocket(sock).recv_data(64),
+                                       blake2b(nonce, key=session_key, person=b'ftt-auth').digest()):
+                sock.close()
+                return None
+    except (TimeoutError, ConnectionError):
+        if is_client:
+            raise
+        sock.close()
+        return None
+    sock.settimeout(None)
+    c2s = blake2b(nonce, key=session_key, person=b'ftt-c2s').digest()
+    s2c = blake2b(nonce, key=session_key, person=b'ftt-s2c').digest()
+    return MacSocket(sock, c2s, s2c) if is_client else MacSocket(sock, s2c, c2s)
+
+
 def compact_ip(ip, appendix=''):
     return str(socket.inet_aton(ip).hex()) + appendix
 
@@ -172,6 +345,11 @@ class ConfigOption(StrEnum):
     server_port = '2023'
     signal_port = '2022'
 
+    section_Network = 'Network'
+    socket_buffer_size = 'auto'
+    congestion_control = ''
+    bandwidth = '0'
+
     @property
     def name_and_value(self):
         return self.name, self
@@ -186,6 +364,10 @@ class Configration:
     log_file_archive_size: int
     server_port: int
     signal_port: int
+    # 数据连接的收发缓冲区大小(字节)，0 为按带宽时延积自动确定；拥塞控制算法；链路带宽(Mbps)，0 为使用网卡速率
+    socket_buffer_size: int = 0
+    congestion_control: str = ConfigOption.congestion_control.value
+    bandwidth: int = int(ConfigOption.bandwidth)
 
 
 # 配置文件相关
@@ -254,6 +436,14 @@ class Config:
             log_file_archive_size = cnf.getint(ConfigOption.section_Log, ConfigOption.log_file_archive_size.name)
             server_port = cnf.getint(ConfigOption.section_Port, ConfigOption.server_port.name)
             signal_port = cnf.getint(ConfigOption.section_Port, ConfigOption.signal_port.name)
+            # 旧的配置文件中没有网络参数，使用默认值
+            socket_buffer_size = cnf.get(ConfigOption.section_Network, ConfigOption.socket_buffer_size.name,
+                                         fallback=ConfigOption.socket_buffer_size)
+            socket_buffer_size = 0 if socket_buffer_size == ConfigOption.socket_buffer_size else int(socket_buffer_size)
+            congestion_control = cnf.get(ConfigOption.section_Network, ConfigOption.congestion_control.name,
+                                         fallback=ConfigOption.congestion_control)
+            bandwidth = cnf.getint(ConfigOption.section_Network, ConfigOption.bandwidth.name,
+                                   fallback=int(ConfigOption.bandwidth))
         except OSError as e:
             print_color(f'Failed to create {cur_folder}, {e}', level=LEVEL.ERROR, highlight=1)
             pause_before_exit(-1)
@@ -263,7 +453,8 @@ class Config:
         else:
             return Configration(default_path=default_path, log_dir=log_dir, server_port=server_port,
                                 log_file_archive_count=log_file_archive_count, signal_port=signal_port,
-                                log_file_archive_size=log_file_archive_size)
+                                log_file_archive_size=log_file_archive_size, socket_buffer_size=socket_buffer_size,
+                                congestion_control=str(congestion_control), bandwidth=bandwidth)
 
 
 # 加载配置
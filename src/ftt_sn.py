@@ -4,23 +4,43 @@ import shutil
 import signal
 from ftt_lib import *
 from concurrent.futures import ThreadPoolExecutor
+from dataclasses import field
+from copier import CopyEngine
 from ftt_base import FTTBase
 
 
+@dataclass
+class LargeFileCopy:
+    """
+    正在拷贝的大文件，按区间切分后由多个线程并行拷贝
+    """
+    filename: str
+    file_size: int
+    target_file: str
+    # 尚未完成的区间数
+    remained: int
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    created: bool = False
+    cloned: bool = False
+    failed: bool = False
+
+
 @dataclass
 class CopyFolderMeta:
     source: str
     target: str
     pbar: PbarManager
-    large_files_info: deque[list]
+    # 待拷贝的大文件区间 (文件, 偏移, 长度)
+    segments: deque[tuple[LargeFileCopy, int, int]]
     small_files_info: deque[list]
     finished_files: list[str]
 
 
 class FTTSn(FTTBase):
-    def __init__(self, threads):
-        super().__init__(threads, True)
+    def __init__(self, threads, hash_algorithm=None):
+        super().__init__(threads, True, hash_algorithm)
         self.__meta: CopyFolderMeta = ...
+        self.__engine = CopyEngine()
 
     def _boot(self):
         self.logger.info('In Single Node Mode')
@@ -48,8 +68,10 @@ class FTTSn(FTTBase):
         command = input("Continue to compare hash for filename and size both equal set?(y/n): ").lower()
         if command not in ('y', 'yes'):
             return
-        source_results = FileHash.parallel_calc_hash(source, files_info_equal, True)
-        target_results = FileHash.parallel_calc_hash(target, files_info_equal, True)
+        source_results = FileHash.parallel_calc_hash(source, files_info_equal, True,
+                                                     self.cache_dir, self.hash_algorithm)
+        target_results = FileHash.parallel_calc_hash(target, files_info_equal, True,
+                                                     self.cache_dir, self.hash_algorithm)
         hash_not_matching = [filename for filename in files_info_equal if
                              source_results[filename] != target_results[filename]]
         msg = ["hash not matching: "] + [('\t' + file_name) for file_name in hash_not_matching]
@@ -59,8 +81,10 @@ class FTTSn(FTTBase):
             PurePath(source, filename)) >> SMALL_FILE_CHUNK_SIZE and filename not in hash_not_matching]
         if not files_hash_equal:
             return
-        source_results = FileHash.parallel_calc_hash(source, files_info_equal, False)
-        target_results = FileHash.parallel_calc_hash(target, files_info_equal, False)
+        source_results = FileHash.parallel_calc_hash(source, files_info_equal, False,
+                                                     self.cache_dir, self.hash_algorithm)
+        target_results = FileHash.parallel_calc_hash(target, files_info_equal, False,
+                                                     self.cache_dir, self.hash_algorithm)
         for filename in files_hash_equal:
             if source_results[filename] != target_results[filename]:
                 print('\t' + filename)
@@ -72,60 +96,93 @@ class FTTSn(FTTBase):
         self.logger.silent_write(['\n'.join(msg)])
 
     def __prepare_to_send(self, source: str, target: str):
-        source_folders, source_files = get_dir_file_name(source, desc_suffix='source')
-        target_folders, target_files = get_dir_file_name(target, desc_suffix='target') if os.path.exists(
-            target) else ({}, [])
+        source_result = scan_all(source, desc='Scanning source')
+        target_result = scan_all(target, desc='Scanning target') if os.path.exists(target) else ScanResult()
 
-        makedirs(self.logger, set(source_folders.keys()) - set(target_folders.keys()), target)
+        makedirs(self.logger, set(source_result.folders) - set(target_result.folders), target)
         # 接收对方已有的文件名并计算出对方没有的文件
-        files = set(source_files) - set(target_files)
-        self.logger.info(f"{len(source_files) - len(files)} files already exists in target")
+        files = set(source_result.names) - set(target_result.names)
+        self.logger.info(f"{len(source_result.names) - len(files)} files already exists in target")
         if not files:
             self.logger.info('No files to send', highlight=1)
             return None
-        large_files_info, small_files_info, _, pbar = collect_files_info(self.logger, files, source)
-        self.__meta = CopyFolderMeta(source, target, PbarManager(pbar), large_files_info, small_files_info, [])
+        large_files_info, small_files_info, _, pbar = collect_files_info(self.logger, source_result.files_info(files),
+                                                                         source)
+        segments = deque()
+        for filename, file_size, _ in large_files_info:
+            # 大文件切分为不超过 64MB 的区间，足够大时至少切分为线程数个区间，使单个大文件也能并行拷贝
+            parts = max(-(-file_size >> FILE_SEGMENT_SIZE), min(self.threads, file_size >> STRIPE_FILE_SIZE_THRESHOLD))
+            ranges = split_into_ranges(0, file_size, parts)
+            target_file = avoid_filename_duplication(str(PurePath(target, filename)))
+            large_file = LargeFileCopy(filename, file_size, target_file, len(ranges))
+            segments.extend((large_file, offset, count) for offset, count in ranges)
+        self.__meta = CopyFolderMeta(source, target, PbarManager(pbar), segments, small_files_info, [])
         return files
 
     def __send_large_files(self, position: int):
-        view = memoryview(buf := bytearray(4096))
-        while len(self.__meta.large_files_info):
-            filename, file_size, time_info = self.__meta.large_files_info.pop()
-            source_file = PurePath(self.__meta.source, filename)
-            target_file = avoid_filename_duplication(str(PurePath(self.__meta.target, filename)))
-            target_temp = f'{target_file}.ftsdownload'
+        """
+        领取大文件的区间并拷贝，最后完成某文件区间的线程负责重命名并复制文件属性
+        """
+        while True:
             try:
-                with open(source_file, 'rb') as sfp, open(target_temp, 'wb') as tfp:
-                    # 服务端已有的文件大小
-                    target_size = os.path.getsize(target_temp)
-                    sfp.seek(target_size, 0)
-                    pbar_width = get_terminal_size().columns / 4
-                    with tqdm(total=file_size - target_size, desc=shorten_path(filename, pbar_width), unit='bytes',
-                              unit_scale=True, mininterval=0.3, position=position, leave=False, disable=position == 0,
-                              unit_divisor=1024) as pbar:
-                        copied_size = 0
-                        while size := sfp.readinto(buf):
-                            tfp.write(view[:size])
-                            copied_size += size
-                            # 4MB
-                            if copied_size >> 22:
-                                pbar.update(copied_size)
-                                self.__meta.pbar.update(copied_size)
-                                copied_size = 0
-                        pbar.update(copied_size)
-                        self.__meta.pbar.update(copied_size)
-                os.rename(target_temp, target_file)
-                shutil.copystat(source_file, target_file)
-                self.__meta.pbar.update(target_size, decrease=True)
-                self.__meta.finished_files.append(filename)
+                large_file, offset, count = self.__meta.segments.popleft()
+            except IndexError:
+                return
+            source_file = os.path.join(self.__meta.source, large_file.filename)
+            target_temp = f'{large_file.target_file}.ftsdownload'
+            try:
+                if self.__create_large_file(large_file, source_file, target_temp):
+                    self.__copy_segment(large_file, source_file, target_temp, offset, count, position)
             except FileNotFoundError as e:
+                large_file.failed = True
                 self.logger.error(f'Failed to open: {e.filename}')
-                continue
+            except Exception as e:
+                large_file.failed = True
+                self.logger.error(f"Failed to copy large file: {e}", highlight=1)
+            with large_file.lock:
+                large_file.remained -= 1
+                if large_file.remained or large_file.failed:
+                    continue
+            try:
+                os.rename(target_temp, large_file.target_file)
+                shutil.copystat(source_file, large_file.target_file)
+                self.__meta.finished_files.append(large_file.filename)
             except PermissionError as err:
-                self.logger.warning(f'Failed to rename: {target_temp} -> {target_file}, {err}')
+                self.logger.warning(f'Failed to rename: {target_temp} -> {large_file.target_file}, {err}')
             except Exception as e:
                 self.logger.error(f"Failed to copy large file: {e}", highlight=1)
 
+    def __create_large_file(self, large_file: LargeFileCopy, source_file: str, target_temp: str) -> bool:
+        """
+        首个领取该文件区间的线程创建临时文件，能克隆时整个文件一次完成，否则预分配文件大小
+
+        @return: 是否还需拷贝区间的数据
+        """
+        with large_file.lock:
+            if large_file.failed:
+                return False
+            if not large_file.created:
+                with open(source_file, 'rb') as sfp, open(target_temp, 'wb') as tfp:
+                    large_file.cloned = self.__engine.clone(sfp.fileno(), tfp.fileno())
+                    if large_file.cloned:
+                        self.__meta.pbar.update(large_file.file_size)
+                    else:
+                        tfp.truncate(large_file.file_size)
+                large_file.created = True
+            return not large_file.cloned
+
+    def __copy_segment(self, large_file: LargeFileCopy, source_file: str, target_temp: str, offset: int,
+                       count: int, position: int):
+        pbar_width = get_terminal_size().columns / 4
+        with tqdm(total=count, desc=shorten_path(large_file.filename, pbar_width), unit='bytes', unit_scale=True,
+                  mininterval=0.3, position=position, leave=False, unit_divisor=1024) as pbar:
+            def update(size: int):
+                pbar.update(size)
+                self.__meta.pbar.update(size)
+
+            with open(source_file, 'rb', buffering=0) as sfp, open(target_temp, 'r+b', buffering=0) as tfp:
+                self.__engine.copy_range(sfp.fileno(), tfp.fileno(), offset, count, update)
+
     def __send_small_files(self, position: int):
         idx, files_info = 0, []
         while len(self.__meta.small_files_info):
@@ -134,8 +191,10 @@ class FTTSn(FTTBase):
                 with tqdm(total=total_size, desc=f'{num} small files', unit='bytes', unit_scale=True,
                           mininterval=0.2, position=position, leave=False, unit_divisor=1024) as pbar:
                     for idx, (filename, file_size, _) in enumerate(files_info):
-                        shutil.copy2(os.path.join(self.__meta.source, filename),
-                                     os.path.join(self.__meta.target, filename))
+                        source_file = os.path.join(self.__meta.source, filename)
+                        target_file = os.path.join(self.__meta.target, filename)
+                        self.__engine.copy_file(source_file, target_file, file_size)
+                        shutil.copystat(source_file, target_file)
                         pbar.update(file_size)
                 self.__meta.pbar.update(total_size)
             except Exception as e:
@@ -202,9 +261,7 @@ class FTTSn(FTTBase):
             return
         # 发送文件
         futures = [self.executor.submit(self.__send_file, position) for position in range(1, self.threads + 1)]
-        for future in futures:
-            while not future.done():
-                time.sleep(0.2)
+        wait_for_workers(futures)
 
         fails = files - set(self.__meta.finished_files)
         self.__meta.finished_files.clear()
@@ -0,0 +1,50 @@
+from hashlib import md5, blake2b
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+
+class Blake3Hash:
+    """
+    blake3 的摘要长度截取为 16 字节，与其他算法一致
+    """
+
+    def __init__(self):
+        self.__hash = blake3.blake3()
+
+    def update(self, data):
+        self.__hash.update(data)
+
+    def hexdigest(self) -> str:
+        return self.__hash.hexdigest(length=16)
+
+
+# 文件哈希算法，按速度优先级排列，摘要均为 16 字节；md5 用于兼容
+DIGEST_SIZE = 16
+HASH_ALGORITHMS = {
+    'xxh3': xxhash.xxh3_128 if xxhash else None,
+    'blake3': Blake3Hash if blake3 else None,
+    'blake2b': lambda: blake2b(digest_size=16),
+    'md5': md5,
+}
+
+
+def available_hashes() -> list[str]:
+    """
+    本机可用的文件哈希算法，按优先级排列
+    """
+    return [name for name, constructor in HASH_ALGORITHMS.items() if constructor]
+
+
+def new_hash(algorithm: str):
+    return HASH_ALGORITHMS[algorithm]()
+
+
+def digest_bytes(file_hash) -> bytes:
+    return bytes.fromhex(file_hash.hexdigest())
@@ -0,0 +1,187 @@
+import os
+import threading
+from struct import Struct
+
+from constants import RESUME_CHUNK_SIZE
+from hash_engine import DIGEST_SIZE, available_hashes, new_hash, digest_bytes
+
+# 续传日志头：哈希算法，源文件大小，源文件修改时间，块大小
+journal_head_struct = Struct('>8sqdq')
+# 每块一个槽位：是否已接收，块摘要
+journal_slot_struct = Struct(f'>?{DIGEST_SIZE}s')
+
+
+class ResumeJournal:
+    """
+    正在接收的大文件的续传日志，记录源文件的大小和修改时间，以及每块的接收状态和摘要
+
+    续传时重新计算已接收块的摘要，只保留校验通过的块，各连接乱序接收的块也能保留
+    """
+
+    def __init__(self, journal_file: str, file_size: int, mtime: float):
+        self.journal_file = journal_file
+        self.file_size = file_size
+        self.mtime = mtime
+        self.algorithm = available_hashes()[0]
+        self.chunk_size = 1 << RESUME_CHUNK_SIZE
+        self.received = bytearray(-(-file_size // self.chunk_size))
+        self.__digests = [bytes(DIGEST_SIZE)] * len(self.received)
+        self.__lock = threading.Lock()
+        self.__fp = None
+
+    def __head(self) -> bytes:
+        return journal_head_struct.pack(self.algorithm.encode(), self.file_size, self.mtime, self.chunk_size)
+
+    @staticmethod
+    def matches(journal_file: str, file_size: int, mtime: float) -> bool:
+        """
+        续传日志记录的源文件是否与本次发送的文件一致
+        """
+        try:
+            with open(journal_file, 'rb') as fp:
+                head = fp.read(journal_head_struct.size)
+        except OSError:
+            return False
+        return head == ResumeJournal(journal_file, file_size, mtime).__head()
+
+    @classmethod
+    def open(cls, journal_file: str, download_file: str, file_size: int, mtime: float) -> 'ResumeJournal':
+        """
+        打开续传日志，源文件一致时校验临时文件中已接收的块，否则重新开始记录
+        """
+        journal = cls(journal_file, file_size, mtime)
+        if cls.matches(journal_file, file_size, mtime):
+            with open(journal_file, 'rb') as fp:
+                fp.seek(journal_head_struct.size)
+                slots = fp.read(journal_slot_struct.size * len(journal.received))
+            for index, (received, digest) in enumerate(journal_slot_struct.iter_unpack(
+                    slots[:len(slots) - len(slots) % journal_slot_struct.size])):
+                if received:
+                    journal.received[index], journal.__digests[index] = 1, digest
+            journal.__verify(download_file)
+        journal.__fp = open(journal_file, 'wb+', buffering=0)
+        journal.__fp.write(journal.__head() + b''.join(
+            journal_slot_struct.pack(received, digest) for received, digest in zip(journal.received, journal.__digests)))
+        return journal
+
+    def __verify(self, download_file: str):
+        """
+        重新计算临时文件中已接收块的摘要，丢弃不一致的块
+        """
+        try:
+            fp = open(download_file, 'rb')
+        except OSError:
+            self.received = bytearray(len(self.received))
+            return
+        view = memoryview(bytearray(self.chunk_size))
+        with fp:
+            for index in range(len(self.received)):
+                if not self.received[index]:
+                    continue
+                fp.seek(index * self.chunk_size)
+                size = fp.readinto(view[:self.chunk_length(index)])
+                file_hash = new_hash(self.algorithm)
+                file_hash.update(view[:size])
+                if size != self.chunk_length(index) or digest_bytes(file_hash) != self.__digests[index]:
+                    self.received[index] = 0
+
+    def chunk_length(self, index: int) -> int:
+        return max(min(self.chunk_size, self.file_size - index * self.chunk_size), 0)
+
+    @property
+    def received_size(self) -> int:
+        return sum(self.chunk_length(index) for index, received in enumerate(self.received) if received)
+
+    def missing_ranges(self) -> list[tuple[int, int]]:
+        """
+        @return: 尚未接收的数据区间，相邻的块合并为一个区间 [(偏移, 长度)]
+        """
+        ranges = []
+        for index, received in enumerate(self.received):
+            if received:
+                continue
+            offset = index * self.chunk_size
+            if ranges and sum(ranges[-1]) == offset:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + self.chunk_length(index))
+            else:
+                ranges.append((offset, self.chunk_length(index)))
+        return ranges
+
+    def commit(self, index: int, digest: bytes):
+        """
+        记录已完整写入临时文件的块
+        """
+        with self.__lock:
+            self.received[index], self.__digests[index] = 1, digest
+            if self.__fp:
+                self.__fp.seek(journal_head_struct.size + index * journal_slot_struct.size)
+                self.__fp.write(journal_slot_struct.pack(True, digest))
+
+    def close(self):
+        with self.__lock:
+            if self.__fp:
+                self.__fp.close()
+                self.__fp = None
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.journal_file)
+        except OSError:
+            pass
+
+
+class ChunkTracker:
+    """
+    按块计算一段接收数据的摘要，块接收完整后提交到续传日志
+
+    分段的起始偏移按块对齐；deferred 时由调用方在该段数据校验通过后再提交
+    """
+
+    def __init__(self, journal: ResumeJournal, offset: int, deferred: bool):
+        self.__journal = journal
+        self.__index = offset // journal.chunk_size
+        self.__remained = journal.chunk_length(self.__index)
+        self.__hash = new_hash(journal.algorithm)
+        self.__deferred = deferred
+        self.__completed: list[tuple[int, bytes]] = []
+
+    def update(self, data):
+        view = memoryview(data)
+        while view and self.__remained:
+            part = view[:self.__remained]
+            self.__hash.update(part)
+            self.__remained -= len(part)
+            view = view[len(part):]
+            if self.__remained:
+                break
+            self.__completed.append((self.__index, digest_bytes(self.__hash)))
+            if not self.__deferred:
+                self.commit()
+            self.__index += 1
+            self.__remained = self.__journal.chunk_length(self.__index)
+            self.__hash = new_hash(self.__journal.algorithm)
+
+    def commit(self):
+        for index, digest in self.__completed:
+            self.__journal.commit(index, digest)
+        self.__completed.clear()
+
+
+def find_resume_file(filename: str, file_size: int, mtime: float) -> str:
+    """
+    为接收的文件选择文件名：已有同一源文件的未完成临时文件时沿用其文件名，
+    否则与 avoid_filename_duplication 相同，选择第一个不存在的文件名
+
+    @return: 目标文件名
+    """
+    base, extension = os.path.splitext(filename)
+    candidate, fallback, i = filename, None, 0
+    while os.path.exists(candidate) or os.path.exists(f'{candidate}.ftsdownload'):
+        if not os.path.exists(candidate):
+            if ResumeJournal.matches(f'{candidate}.ftsjournal', file_size, mtime):
+                return candidate
+            fallback = fallback or candidate
+        i += 1
+        candidate = f"{base}({i}){extension}"
+    return fallback or candidate
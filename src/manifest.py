@@ -0,0 +1,68 @@
+import os
+import zlib
+from struct import Struct
+from typing import Iterator
+
+from constants import KB, utf8
+
+# 文件清单的字段格式，每条记录为 文件相对路径 + 对应字段
+NAMES = Struct('>')
+FILE_SIZE = Struct('>q')
+FILE_MTIME = Struct('>d')
+FILE_HASH = Struct('>16s')
+FOLDER_TIMES = Struct('>dd')
+FILE_INFO = Struct('>qddd')
+
+# 每条记录的头部：与上一条路径相同的前缀长度，剩余路径的长度
+record_head = Struct('>HH')
+# 清单按帧压缩发送，帧的大小达到该值时即发送，接收方可边接收边解析
+MANIFEST_FRAME_SIZE = 256 * KB
+
+
+class ManifestEncoder:
+    """
+    文件清单编码器，路径只记录与上一条路径不同的部分，编码后的数据按帧压缩
+    """
+
+    def __init__(self, schema: Struct):
+        self.__record = Struct(record_head.format + schema.format.lstrip('>'))
+        self.__buffer = bytearray()
+        self.__prev_path = self.__prev_dir = b''
+
+    def encode(self, path: str, *fields):
+        path = path.encode(utf8)
+        # 扫描结果按目录聚集，绝大多数情况下只需比较上一条记录的目录
+        prefix = len(self.__prev_dir) if path.startswith(self.__prev_dir) else len(
+            os.path.commonprefix([self.__prev_path, path]))
+        self.__buffer += self.__record.pack(prefix, len(path) - prefix, *fields)
+        self.__buffer += path[prefix:]
+        self.__prev_path, self.__prev_dir = path, path[:path.rfind(b'/') + 1]
+
+    def __len__(self):
+        return len(self.__buffer)
+
+    def flush(self) -> bytes:
+        frame, self.__buffer = zlib.compress(self.__buffer, 1), bytearray()
+        return frame
+
+
+class ManifestDecoder:
+    def __init__(self, schema: Struct):
+        self.__record = Struct(record_head.format + schema.format.lstrip('>'))
+        self.__prev_path = b''
+
+    def decode(self, frame: bytes) -> Iterator[tuple]:
+        """
+        解析一帧清单数据
+
+        @return: (文件相对路径, *字段)
+        """
+        view = memoryview(zlib.decompress(frame))
+        offset, record_size = 0, self.__record.size
+        while offset < len(view):
+            prefix, suffix_size, *fields = self.__record.unpack_from(view, offset)
+            offset += record_size
+            path = self.__prev_path[:prefix] + view[offset:offset + suffix_size]
+            offset += suffix_size
+            self.__prev_path = path
+            yield path.decode(utf8), *fields
@@ -0,0 +1,271 @@
+import itertools
+import queue
+import threading
+from collections import deque
+from enum import IntEnum
+from struct import Struct
+
+from utils import ESocket, ConnectionDisappearedError
+from constants import size_struct
+
+# 帧头：流编号，帧类型，负载长度
+frame_struct = Struct('>IBI')
+# 每帧负载的最大长度，大的消息被切分为多帧，使其他流的帧可以穿插发送
+MUX_FRAME_SIZE = 16  # 1024 * 64
+# 每路流的接收窗口，对方最多发送这么多尚未被读取的数据
+MUX_WINDOW_SIZE = 22  # 1024 * 1024 * 4
+
+
+class FRAME(IntEnum):
+    OPEN = 0  # 新开一路流，负载为流的优先级
+    DATA = 1
+    WINDOW = 2  # 归还接收窗口，负载为已读取的字节数
+    CLOSE = 3  # 本方不再收发该流的数据
+
+
+# 流的优先级，值越小越先发送
+class PRIORITY(IntEnum):
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+class MuxStream(ESocket):
+    """
+    主连接上的一路逻辑流，接口与 ESocket 相同；每条命令在各自的流上交互，互不阻塞
+    """
+
+    def __init__(self, mux: 'Multiplexer', stream_id: int, priority: int):
+        # 不直接持有套接字，数据经由复用器分帧收发
+        self.__mux = mux
+        self.stream_id = stream_id
+        self.priority = priority
+        self.__chunks: deque[memoryview] = deque()
+        self.__credit = 1 << MUX_WINDOW_SIZE
+        self.__consumed = 0
+        self.__peer_closed = False
+        self.__closed = False
+        self.__broken = False
+        self.__timeout: float | None = None
+        self.__ready = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def sendall(self, data):
+        view = memoryview(data).cast('B')
+        while view:
+            with self.__ready:
+                if not self.__ready.wait_for(lambda: self.__credit > 0 or self.__peer_closed or self.__broken,
+                                             self.__timeout):
+                    raise TimeoutError('Stream timed out')
+                if self.__broken:
+                    raise ConnectionDisappearedError('Connection Disappeared')
+                # 对方已关闭的流不会再读取数据，也不会再归还窗口
+                if self.__peer_closed:
+                    raise ConnectionDisappearedError('Stream closed by peer')
+                size = min(len(view), self.__credit, 1 << MUX_FRAME_SIZE)
+                self.__credit -= size
+            self.__mux.send_frame(self, FRAME.DATA, view[:size])
+            view = view[size:]
+
+    def sendfile(self, file, offset=0, count=None):
+        # 数据需要分帧发送，无法由内核直接发送文件；按帧的大小逐块读取，不把整段数据读入内存
+        file.seek(offset)
+        sent = 0
+        while count is None or sent < count:
+            size = 1 << MUX_FRAME_SIZE if count is None else min(1 << MUX_FRAME_SIZE, count - sent)
+            if not (data := file.read(size)):
+                break
+            self.sendall(data)
+            sent += len(data)
+        return sent
+
+    def __read_some(self, view: memoryview) -> int:
+        """
+        等待并读取已接收的数据，最多填满 view，读取过半个窗口时归还给对方
+        """
+        with self.__ready:
+            if not self.__ready.wait_for(lambda: self.__chunks or self.__peer_closed or self.__broken,
+                                         self.__timeout):
+                raise TimeoutError('Stream timed out')
+            if not self.__chunks:
+                raise ConnectionDisappearedError('Connection Disappeared')
+            chunk = self.__chunks[0]
+            size = min(len(chunk), len(view))
+            view[:size] = chunk[:size]
+            if size == len(chunk):
+                self.__chunks.popleft()
+            else:
+                self.__chunks[0] = chunk[size:]
+            self.__consumed += size
+            credit = 0
+            if self.__consumed >> MUX_WINDOW_SIZE - 1:
+                credit, self.__consumed = self.__consumed, 0
+        if credit and not self.__closed:
+            self.__mux.send_frame(self, FRAME.WINDOW, size_struct.pack(credit))
+        return size
+
+    def recv(self, size=ESocket.MAX_BUFFER_SIZE):
+        view = memoryview(bytearray(size))
+        size = self.__read_some(view)
+        return view[:size], size
+
+    def recv_into(self, buffer, size: int = 0) -> int:
+        view = memoryview(buffer).cast('B')
+        size = size or len(view)
+        received = 0
+        while received < size:
+            received += self.__read_some(view[received:size])
+        return size
+
+    def getpeername(self):
+        return self.__mux.getpeername()
+
+    def settimeout(self, value: float | None):
+        self.__timeout = value
+
+    def close(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        self.__mux.remove(self)
+        if not self.__broken:
+            try:
+                self.__mux.send_frame(self, FRAME.CLOSE, b'')
+            except ConnectionError:
+                pass
+
+    def feed(self, data: bytearray):
+        with self.__ready:
+            self.__chunks.append(memoryview(data))
+            self.__ready.notify_all()
+
+    def grant(self, credit: int):
+        with self.__ready:
+            self.__credit += credit
+            self.__ready.notify_all()
+
+    def peer_close(self):
+        with self.__ready:
+            self.__peer_closed = True
+            self.__ready.notify_all()
+
+    def abort(self):
+        with self.__ready:
+            self.__broken = True
+            self.__ready.notify_all()
+
+
+class Multiplexer:
+    """
+    在一个连接上复用多路逻辑流：消息按流切分为不超过 64KB 的帧，按流的优先级发送；
+    每路流有独立的接收窗口，读取慢的流不会阻塞其他流。流只由发送命令的一方打开
+    """
+
+    def __init__(self, conn: ESocket):
+        self.__conn = conn
+        self.__streams: dict[int, MuxStream] = {}
+        self.__lock = threading.Lock()
+        self.__stream_ids = itertools.count(1)
+        # 待发送的帧 (优先级, 序号, 帧)，同一优先级按先后顺序发送
+        self.__frames = queue.PriorityQueue()
+        self.__sequence = itertools.count()
+        self.__accepted: queue.Queue[MuxStream | None] = queue.Queue()
+        self.__error: Exception | None = None
+        threading.Thread(name='MuxReader', target=self.__read_frames, daemon=True).start()
+        self.__writer = threading.Thread(name='MuxWriter', target=self.__write_frames, daemon=True)
+        self.__writer.start()
+
+    def open_stream(self, priority: int = PRIORITY.NORMAL) -> MuxStream:
+        stream = MuxStream(self, next(self.__stream_ids), priority)
+        with self.__lock:
+            self.__streams[stream.stream_id] = stream
+        self.send_frame(stream, FRAME.OPEN, bytes([priority]))
+        return stream
+
+    def accept_stream(self) -> MuxStream:
+        """
+        等待对方打开的下一路流，连接断开时抛出 ConnectionDisappearedError
+        """
+        if (stream := self.__accepted.get()) is None:
+            self.__accepted.put(None)
+            raise ConnectionDisappearedError(f'Connection Disappeared: {self.__error}')
+        return stream
+
+    def send_frame(self, stream: MuxStream, frame_type: FRAME, payload):
+        self.__put_frame(stream.stream_id, stream.priority, frame_type, payload)
+
+    def __put_frame(self, stream_id: int, priority: int, frame_type: FRAME, payload):
+        if self.__error:
+            raise ConnectionDisappearedError(f'Connection Disappeared: {self.__error}')
+        # 归还窗口的帧最先发送，以免对方等待
+        priority = -1 if frame_type == FRAME.WINDOW else priority
+        frame = frame_struct.pack(stream_id, frame_type, len(payload)) + payload
+        self.__frames.put((priority, next(self.__sequence), frame))
+
+    def remove(self, stream: MuxStream):
+        with self.__lock:
+            self.__streams.pop(stream.stream_id, None)
+
+    def getpeername(self):
+        return self.__conn.getpeername()
+
+    def __read_frames(self):
+        try:
+            while True:
+                stream_id, frame_type, size = frame_struct.unpack(self.__conn.recv_data(frame_struct.size))
+                payload = self.__conn.recv_data(size) if size else bytearray()
+                if frame_type == FRAME.OPEN:
+                    stream = MuxStream(self, stream_id, payload[0])
+                    with self.__lock:
+                        self.__streams[stream_id] = stream
+                    self.__accepted.put(stream)
+                    continue
+                with self.__lock:
+                    stream = self.__streams.get(stream_id)
+                # 本方已关闭的流，忽略其余的帧；丢弃的数据仍归还窗口，对方尚未收到关闭时不会因窗口耗尽而阻塞
+                if stream is None:
+                    if frame_type == FRAME.DATA:
+                        self.__put_frame(stream_id, PRIORITY.HIGH, FRAME.WINDOW, size_struct.pack(size))
+                    continue
+                match frame_type:
+                    case FRAME.DATA:
+                        stream.feed(payload)
+                    case FRAME.WINDOW:
+                        stream.grant(size_struct.unpack(payload)[0])
+                    case FRAME.CLOSE:
+                        stream.peer_close()
+        except Exception as error:
+            self.__fail(error)
+
+    def __write_frames(self):
+        while (frame := self.__frames.get()[2]) is not None:
+            try:
+                self.__conn.sendall(frame)
+            except Exception as error:
+                self.__fail(error)
+                return
+
+    def __fail(self, error: Exception):
+        """
+        连接断开，所有流上等待的收发都以 ConnectionDisappearedError 结束
+        """
+        self.__error = self.__error or error
+        with self.__lock:
+            streams = list(self.__streams.values())
+        for stream in streams:
+            stream.abort()
+        self.__accepted.put(None)
+
+    def close(self):
+        # 先发出已排队的帧 (如关闭命令)，再关闭连接
+        self.__frames.put((len(PRIORITY), next(self.__sequence), None))
+        self.__writer.join(timeout=2)
+        try:
+            self.__conn.close()
+        except OSError:
+            pass
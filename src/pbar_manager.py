@@ -13,6 +13,24 @@ class PbarManager:
             else:
                 self.__pbar.total -= size
 
+    def add_total(self, size: int):
+        with self.__lock:
+            self.__pbar.total += size
+
+    def progress(self) -> tuple[int, int]:
+        """
+        @return: 已完成的大小，总大小
+        """
+        with self.__lock:
+            return self.__pbar.n, self.__pbar.total
+
+    def discard(self):
+        """
+        关闭并清除进度条，用于未能开始的发送
+        """
+        self.__pbar.leave = False
+        self.__pbar.close()
+
     def set_status(self, fail: bool):
         self.__pbar.colour = '#F44336' if fail else '#98c379'
         self.__pbar.close()
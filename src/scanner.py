@@ -0,0 +1,131 @@
+import os
+import queue
+from array import array
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass, field
+from typing import Iterator
+
+from tqdm import tqdm
+
+from constants import SCAN_BATCH_SIZE, SCAN_WORKERS
+
+
+@dataclass
+class ScanResult:
+    """
+    目录扫描结果，按列存储，文件数量很多时占用的内存更少
+    """
+    folders: list[str] = field(default_factory=list)
+    folder_atimes: array = field(default_factory=lambda: array('d'))
+    folder_mtimes: array = field(default_factory=lambda: array('d'))
+    names: list[str] = field(default_factory=list)
+    sizes: array = field(default_factory=lambda: array('q'))
+    ctimes: array = field(default_factory=lambda: array('d'))
+    mtimes: array = field(default_factory=lambda: array('d'))
+    atimes: array = field(default_factory=lambda: array('d'))
+    modes: array = field(default_factory=lambda: array('L'))
+
+    def __len__(self):
+        return len(self.folders) + len(self.names)
+
+    def add_folder(self, rel_path: str, stat: os.stat_result):
+        self.folders.append(rel_path)
+        self.folder_atimes.append(stat.st_atime)
+        self.folder_mtimes.append(stat.st_mtime)
+
+    def add_file(self, rel_path: str, stat: os.stat_result):
+        self.names.append(rel_path)
+        self.sizes.append(stat.st_size)
+        self.ctimes.append(stat.st_ctime)
+        self.mtimes.append(stat.st_mtime)
+        self.atimes.append(stat.st_atime)
+        self.modes.append(stat.st_mode)
+
+    def extend(self, other: 'ScanResult'):
+        for name, column in vars(other).items():
+            getattr(self, name).extend(column)
+
+    def folders_info(self) -> dict[str, tuple[float, float]]:
+        """
+        @return: 文件夹相对路径: (访问时间, 修改时间)
+        """
+        return dict(zip(self.folders, zip(self.folder_atimes, self.folder_mtimes)))
+
+    def files_info(self, selected: set[str] = None) -> list[tuple[str, int, tuple[float, float, float]]]:
+        """
+        @param selected: 只返回其中的文件，为空时返回全部文件
+        @return: [(文件相对路径, 文件大小, (创建时间, 修改时间, 访问时间))]
+        """
+        return [(name, size, (ctime, mtime, atime)) for name, size, ctime, mtime, atime in
+                zip(self.names, self.sizes, self.ctimes, self.mtimes, self.atimes) if
+                selected is None or name in selected]
+
+
+def scan_dir(abs_path: str, rel_path: str) -> tuple[ScanResult, list[tuple[str, str]]]:
+    """
+    扫描单个文件夹，文件信息取自 scandir 的同一次 stat
+
+    @return: 该文件夹的扫描结果，子文件夹的 (绝对路径, 相对路径)
+    """
+    result, sub_folders = ScanResult(), []
+    try:
+        result.add_folder(rel_path, os.stat(abs_path))
+        with os.scandir(abs_path) as it:
+            for entry in it:
+                entry_rel_path = f"{rel_path}/{entry.name}" if rel_path != '.' else entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        sub_folders.append((entry.path, entry_rel_path))
+                    elif entry.is_file(follow_symlinks=False):
+                        result.add_file(entry_rel_path, entry.stat(follow_symlinks=False))
+                except FileNotFoundError:
+                    continue
+    except (PermissionError, FileNotFoundError):
+        pass
+    return result, sub_folders
+
+
+def scan_tree(base_dir: str, desc='Scanning files', position=0,
+              batch_size=SCAN_BATCH_SIZE) -> Iterator[ScanResult]:
+    """
+    由多个线程并行遍历目录树，边扫描边按批产生结果，并显示进度条
+
+    @param batch_size: 每批至少包含的文件及文件夹数
+    """
+    results, pending = queue.Queue(), 1
+    folders = total_size = 0
+    pbar = tqdm(desc=desc, unit=" files", position=position, dynamic_ncols=True)
+    executor = ThreadPoolExecutor(max_workers=SCAN_WORKERS)
+    try:
+        executor.submit(scan_dir, os.path.abspath(base_dir), '.').add_done_callback(results.put)
+        batch = ScanResult()
+        while pending:
+            future: Future = results.get()
+            pending -= 1
+            result, sub_folders = future.result()
+            for sub_folder in sub_folders:
+                executor.submit(scan_dir, *sub_folder).add_done_callback(results.put)
+            pending += len(sub_folders)
+            batch.extend(result)
+            folders += len(result.folders)
+            total_size += sum(result.sizes)
+            pbar.update(len(result.names))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = ScanResult()
+        if len(batch):
+            yield batch
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        pbar.set_postfix(folders=folders, size=tqdm.format_sizeof(total_size, 'B', 1024))
+        pbar.close()
+
+
+def scan_all(base_dir: str, desc='Scanning files', position=0) -> ScanResult:
+    """
+    并行扫描整个目录树并合并结果
+    """
+    result = ScanResult()
+    for batch in scan_tree(base_dir, desc, position):
+        result.extend(batch)
+    return result
@@ -0,0 +1,236 @@
+import os
+import threading
+import time
+from concurrent.futures import Executor
+from dataclasses import dataclass, field, asdict
+from typing import Callable
+
+from constants import SPEEDTEST_CHUNK_SIZE, PING_COUNT
+from utils import ESocket, ThreadWithResult, get_size, format_time
+
+
+def split_size(size: int, parts: int) -> list[int]:
+    """
+    将测速数据量尽量均分到各数据连接上
+    """
+    return [size // parts + (i < size % parts) for i in range(parts)]
+
+
+def jitter(rtts: list[float]) -> float:
+    """
+    相邻两次往返时延之差的平均值
+    """
+    return sum(abs(b - a) for a, b in zip(rtts, rtts[1:])) / (len(rtts) - 1) if len(rtts) > 1 else 0.0
+
+
+def ping(conn: ESocket, count: int = PING_COUNT) -> list[float]:
+    """
+    在数据连接上往返发送序号，对方原样返回
+
+    @return: 每次往返的时延(秒)
+    """
+    rtts = []
+    for i in range(count):
+        start = time.perf_counter()
+        conn.send_size(i)
+        conn.recv_size()
+        rtts.append(time.perf_counter() - start)
+    return rtts
+
+
+def echo(conn: ESocket, count: int = PING_COUNT):
+    for _ in range(count):
+        conn.send_size(conn.recv_size())
+
+
+def send_stream(conn: ESocket, size: int, payload: memoryview, update: Callable[[int], None] = None):
+    """
+    反复发送预先生成的数据块，直到发送满 size 字节
+    """
+    chunk = len(payload)
+    for offset in range(0, size, chunk):
+        length = min(chunk, size - offset)
+        conn.sendall(payload[:length])
+        if update:
+            update(length)
+    conn.send_mac()
+
+
+def recv_stream(conn: ESocket, size: int, update: Callable[[int], None] = None) -> tuple[float, float]:
+    """
+    接收 size 字节并丢弃；从收到第一个字节开始计时，排除双方开始时刻的差异
+
+    @return: 开始及结束的时刻，计时的数据量为 size - 1
+    """
+    view = memoryview(bytearray(1 << SPEEDTEST_CHUNK_SIZE))
+    conn.recv_into(view, 1)
+    start, received = time.perf_counter(), 1
+    while received < size:
+        length = conn.recv_into(view, min(len(view), size - received))
+        received += length
+        if update:
+            update(length)
+    conn.check_mac()
+    return start, time.perf_counter()
+
+
+def exchange_stream(conn: ESocket, size: int, payload: memoryview,
+                    update: Callable[[int], None] = None) -> tuple[float, float]:
+    """
+    同时发送及接收 size 字节，发送在另一个线程中进行
+
+    @return: 接收的开始及结束时刻
+    """
+    sender = ThreadWithResult(send_stream, (conn, size, payload, update))
+    sender.start()
+    try:
+        return recv_stream(conn, size, update)
+    finally:
+        sender.join()
+
+
+def bandwidth(size: int, timings: list[tuple[float, float]]) -> float:
+    """
+    @return: 从最早开始到最晚结束期间的平均带宽 (比特/秒)
+    """
+    interval = max(end for _, end in timings) - min(start for start, _ in timings)
+    return size * 8 / interval if interval > 0 else 0.0
+
+
+def format_bandwidth(bps: float) -> str:
+    return get_size(bps, factor=1000, suffix='bps')
+
+
+@dataclass
+class StreamResult:
+    """
+    单个数据连接的测速结果，时延单位为毫秒，带宽单位为比特/秒
+    """
+    stream: int
+    rtt: float = 0.0
+    jitter: float = 0.0
+    upload: float = 0.0
+    download: float = 0.0
+    bidirectional_upload: float = 0.0
+    bidirectional_download: float = 0.0
+
+
+@dataclass
+class SpeedTestResult:
+    """
+    全部数据连接的测速结果；总带宽按所有连接的数据量及从最早开始到最晚结束的时间计算
+    """
+    connections: int
+    size: int
+    rtt_min: float = 0.0
+    rtt_avg: float = 0.0
+    rtt_max: float = 0.0
+    jitter: float = 0.0
+    upload: float = 0.0
+    upload_time: float = 0.0
+    download: float = 0.0
+    download_time: float = 0.0
+    bidirectional_upload: float = 0.0
+    bidirectional_download: float = 0.0
+    streams: list[StreamResult] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def format(self) -> str:
+        blank = '      '
+        lines = [f"Speed test over {self.connections} data connections, {get_size(self.size, factor=1000)} each direction:",
+                 f"{blank}RTT          : min {self.rtt_min:.3f}ms, avg {self.rtt_avg:.3f}ms, "
+                 f"max {self.rtt_max:.3f}ms, jitter {self.jitter:.3f}ms",
+                 f"{blank}Upload       : {format_bandwidth(self.upload)}, takes {format_time(self.upload_time)}",
+                 f"{blank}Download     : {format_bandwidth(self.download)}, takes {format_time(self.download_time)}",
+                 f"{blank}Bidirectional: {format_bandwidth(self.bidirectional_upload)}↑ "
+                 f"{format_bandwidth(self.bidirectional_download)}↓, total "
+                 f"{format_bandwidth(self.bidirectional_upload + self.bidirectional_download)}"]
+        for stream in self.streams:
+            lines.append(f"{blank}Stream {stream.stream:<6}: rtt {stream.rtt:.3f}ms, jitter {stream.jitter:.3f}ms, "
+                         f"upload {format_bandwidth(stream.upload)}, download {format_bandwidth(stream.download)}, "
+                         f"bidirectional {format_bandwidth(stream.bidirectional_upload)}↑ "
+                         f"{format_bandwidth(stream.bidirectional_download)}↓")
+        return '\n'.join(lines) + '\n'
+
+
+class SpeedTest:
+    """
+    在所有数据连接上同时测速，依次测量往返时延、上传、下载以及双向同时传输的吞吐量。
+    发起方与响应方各阶段一一对应，每个阶段所有连接都结束后才开始下一阶段；
+    测速数据预先生成一次后反复发送，不受生成随机数据的速度限制
+    """
+
+    def __init__(self, connections: list[ESocket], executor: Executor, data_size: int):
+        if data_size <= 0:
+            raise ValueError('Data Size Must Be Positive')
+        # 每个连接至少分到 1 字节，否则接收方会一直等待首个字节；双方按相同的数据量得到相同的连接数
+        self.__connections = connections[:data_size]
+        self.__executor = executor
+        self.__sizes = split_size(data_size, len(self.__connections))
+        self.__payload = memoryview(os.urandom(1 << SPEEDTEST_CHUNK_SIZE))
+
+    def __run(self, func, *args) -> list:
+        """
+        在每个数据连接上并行执行同一阶段，等待全部结束
+
+        @return: 各连接的结果，任一连接出错时抛出其异常
+        """
+        futures = [self.__executor.submit(func, conn, size, *args)
+                   for conn, size in zip(self.__connections, self.__sizes)]
+        return [future.result() for future in futures]
+
+    def __timed_sizes(self) -> int:
+        return sum(size - 1 for size in self.__sizes)
+
+    def run(self, update: Callable[[int], None] = None, peer_timings: Callable[[], dict] = None) -> SpeedTestResult:
+        """
+        发起方执行测速
+
+        @param update: 收发数据时更新进度
+        @param peer_timings: 获取响应方记录的上传及双向传输阶段的接收时刻
+        """
+        lock = threading.Lock()
+
+        def locked_update(size: int):
+            if update:
+                with lock:
+                    update(size)
+
+        rtts = self.__run(lambda conn, _: ping(conn))
+        self.__run(send_stream, self.__payload, locked_update)
+        download = self.__run(recv_stream, locked_update)
+        bidirectional_download = self.__run(exchange_stream, self.__payload, locked_update)
+        timings = peer_timings()
+        upload, bidirectional_upload = timings['upload'], timings['bidirectional']
+
+        all_rtts = [rtt * 1000 for stream in rtts for rtt in stream]
+        result = SpeedTestResult(len(self.__connections), sum(self.__sizes), min(all_rtts),
+                                 sum(all_rtts) / len(all_rtts), max(all_rtts),
+                                 sum(jitter(stream) for stream in rtts) * 1000 / len(rtts))
+        timed = self.__timed_sizes()
+        result.upload, result.download = bandwidth(timed, upload), bandwidth(timed, download)
+        result.upload_time = max(end for _, end in upload) - min(start for start, _ in upload)
+        result.download_time = max(end for _, end in download) - min(start for start, _ in download)
+        result.bidirectional_upload = bandwidth(timed, bidirectional_upload)
+        result.bidirectional_download = bandwidth(timed, bidirectional_download)
+        for index, size in enumerate(self.__sizes):
+            timed = size - 1
+            result.streams.append(StreamResult(
+                index + 1, sum(rtts[index]) * 1000 / len(rtts[index]), jitter(rtts[index]) * 1000,
+                bandwidth(timed, [upload[index]]), bandwidth(timed, [download[index]]),
+                bandwidth(timed, [bidirectional_upload[index]]), bandwidth(timed, [bidirectional_download[index]])))
+        return result
+
+    def respond(self) -> dict:
+        """
+        响应方执行与发起方对应的各阶段
+
+        @return: 上传及双向传输阶段各连接的接收时刻，交给发起方计算带宽
+        """
+        self.__run(lambda conn, _: echo(conn))
+        upload = self.__run(recv_stream)
+        self.__run(send_stream, self.__payload)
+        bidirectional = self.__run(exchange_stream, self.__payload)
+        return {'upload': upload, 'bidirectional': bidirectional}
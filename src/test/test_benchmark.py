@@ -0,0 +1,334 @@
+"""
+端到端传输基准测试：在同一进程中通过回环地址连接 FTC 与 FTS，对合成数据集测量各传输路径的
+文件数/秒、MB/秒、每 GB 的 CPU 时间及峰值内存，并与保存的基准值比较以发现性能退化。
+
+环境变量:
+    FTT_BENCH_SCALE      数据集规模，1 为完整规模 (100 万个小文件等)，默认 0.01
+    FTT_BENCH_DIR        数据集及结果的保存目录，默认为系统临时目录下的 ftt_benchmark
+    FTT_BENCH_THREADS    数据连接数，默认 8
+    FTT_BENCH_BASELINE   基准值文件，默认为 FTT_BENCH_DIR 下的 baseline.json，首次运行时以本次结果生成
+    FTT_BENCH_UPDATE     为 1 时以本次结果更新基准值
+    FTT_BENCH_TOLERANCE  允许的退化比例，默认 0.25
+    FTT_BENCH_REPEAT     每个场景执行的次数，取耗时最短的一次，默认 3
+
+运行: cd src/test && python -m unittest test_benchmark
+"""
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from unittest.mock import patch
+
+import psutil
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from tools import create_dataset, tree_digest, connect_peers, drop_connection, wait_for_file_data
+from constants import DATA_CHANNEL
+from ftt import FTT
+from ftt_sn import FTTSn
+
+SCALE = float(os.environ.get('FTT_BENCH_SCALE', '0.01'))
+BENCH_DIR = Path(os.environ.get('FTT_BENCH_DIR', Path(tempfile.gettempdir(), 'ftt_benchmark')))
+THREADS = int(os.environ.get('FTT_BENCH_THREADS', '8'))
+BASELINE_FILE = Path(os.environ.get('FTT_BENCH_BASELINE', Path(BENCH_DIR, 'baseline.json')))
+UPDATE_BASELINE = os.environ.get('FTT_BENCH_UPDATE') == '1'
+TOLERANCE = float(os.environ.get('FTT_BENCH_TOLERANCE', '0.25'))
+REPEAT = int(os.environ.get('FTT_BENCH_REPEAT', '3'))
+# 不同规模及连接数的结果分别保存基准值
+BASELINE_KEY = f'scale={SCALE:g},threads={THREADS}'
+PASSWORD = 'benchmark'
+# 耗时短于该秒数的场景只报告结果，不与基准值比较，计时及 CPU 时间统计的粒度会使结果波动过大
+MIN_CHECK_SECONDS = 1
+# 采样内存占用的间隔(秒)
+RSS_SAMPLE_INTERVAL = 0.02
+
+
+@dataclass
+class BenchmarkResult:
+    scenario: str
+    files: int
+    size: int
+    seconds: float
+    files_per_second: float
+    mb_per_second: float
+    cpu_seconds_per_gb: float
+    peak_rss_mb: float
+
+
+class PeakMemory:
+    """
+    在后台线程中采样本进程的常驻内存，记录测量期间的峰值
+    """
+
+    def __init__(self):
+        self.__process = psutil.Process()
+        self.__stopped = threading.Event()
+        self.peak = self.__process.memory_info().rss
+        self.__thread = threading.Thread(target=self.__sample, daemon=True)
+
+    def __sample(self):
+        while not self.__stopped.wait(RSS_SAMPLE_INTERVAL):
+            self.peak = max(self.peak, self.__process.memory_info().rss)
+
+    def __enter__(self):
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.__stopped.set()
+        self.__thread.join()
+        self.peak = max(self.peak, self.__process.memory_info().rss)
+
+
+def cpu_seconds() -> float:
+    # 包括计算哈希的子进程
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def measure(scenario: str, files: int, size: int, func) -> BenchmarkResult:
+    start_cpu, start = cpu_seconds(), time.perf_counter()
+    with PeakMemory() as memory:
+        func()
+    seconds, cpu = time.perf_counter() - start, cpu_seconds() - start_cpu
+    return BenchmarkResult(scenario, files, size, seconds, files / seconds, size / 1e6 / seconds,
+                           cpu / (size / 1e9) if size else 0.0, memory.peak / 1e6)
+
+
+def load_baselines() -> dict:
+    if not BASELINE_FILE.exists():
+        return {}
+    with open(BASELINE_FILE, encoding='utf-8') as fp:
+        return json.load(fp)
+
+
+class BenchmarkTest(unittest.TestCase):
+    """
+    各场景按名称顺序执行，后面的比较及强制同步使用前面已发送到对方的文件夹
+    """
+    results: list[BenchmarkResult] = []
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir, cls.work_dir = Path(BENCH_DIR, f'data_{SCALE:g}'), Path(BENCH_DIR, 'work')
+        cls.datasets = {name: (Path(cls.data_dir, name), *create_dataset(name, Path(cls.data_dir, name), SCALE))
+                        for name in ('tiny', 'mixed', 'huge', 'deep', 'random', 'compressible')}
+        shutil.rmtree(cls.work_dir, ignore_errors=True)
+        cls.recv_dir = Path(cls.work_dir, 'recv')
+        cls.recv_dir.mkdir(parents=True)
+        # 两端的日志及进度条写入文件，只输出测量结果
+        cls.redirect = contextlib.ExitStack()
+        output = cls.redirect.enter_context(open(Path(BENCH_DIR, 'benchmark.log'), 'w', encoding='utf-8'))
+        cls.redirect.enter_context(contextlib.redirect_stdout(output))
+        cls.redirect.enter_context(contextlib.redirect_stderr(output))
+        cls.server, cls.client = connect_peers(PASSWORD, cls.recv_dir, Path(cls.work_dir, 'client'), THREADS)
+        # 未加密数据通道需双方协商，单独连接一对
+        cls.plain_server, cls.plain_client = connect_peers(PASSWORD, cls.recv_dir, Path(cls.work_dir, 'client'),
+                                                           THREADS, data_channel=DATA_CHANNEL.PLAIN)
+        cls.single_node = FTTSn(THREADS)
+        cls.single_node._boot()
+        cls.baselines = load_baselines().get(BASELINE_KEY, {})
+
+    @classmethod
+    def tearDownClass(cls):
+        for peer in cls.server, cls.client, cls.plain_server, cls.plain_client, cls.single_node:
+            peer._history_file.close()
+        cls.redirect.close()
+        print(f'\nBenchmark results (scale {SCALE:g}, {THREADS} connections):')
+        print(f'{"scenario":<22}{"files":>9}{"size(MB)":>11}{"seconds":>9}{"files/s":>11}{"MB/s":>9}'
+              f'{"CPU s/GB":>10}{"RSS(MB)":>9}')
+        for result in cls.results:
+            print(f'{result.scenario:<22}{result.files:>9}{result.size / 1e6:>11.1f}{result.seconds:>9.2f}'
+                  f'{result.files_per_second:>11.1f}{result.mb_per_second:>9.1f}{result.cpu_seconds_per_gb:>10.2f}'
+                  f'{result.peak_rss_mb:>9.1f}')
+        results = {result.scenario: asdict(result) for result in cls.results}
+        with open(Path(BENCH_DIR, f'results_{time.strftime("%Y%m%d_%H%M%S")}.json'), 'w', encoding='utf-8') as fp:
+            json.dump({'scale': SCALE, 'threads': THREADS, 'results': results}, fp, indent=2)
+        # 要求更新时保存全部结果，否则只为还没有基准值的场景保存
+        if not UPDATE_BASELINE:
+            results = {scenario: result for scenario, result in results.items() if scenario not in cls.baselines}
+        if results:
+            baselines = load_baselines()
+            baselines[BASELINE_KEY] = {**baselines.get(BASELINE_KEY, {}), **results}
+            with open(BASELINE_FILE, 'w', encoding='utf-8') as fp:
+                json.dump(baselines, fp, indent=2)
+
+    def __run(self, scenario: str, files: int, size: int, func, reset=None, source: Path = None, target: Path = None):
+        """
+        重复执行 REPEAT 次，取耗时最短的一次作为结果
+
+        @param reset: 每次执行前恢复初始状态，不计入耗时
+        @param source: 执行后与 target 比较内容
+        """
+        results = []
+        with patch('builtins.input', return_value='y'):
+            for _ in range(REPEAT):
+                if reset:
+                    reset()
+                results.append(measure(scenario, files, size, func))
+        self.results.append(result := min(results, key=lambda item: item.seconds))
+        if source:
+            self.assertEqual(tree_digest(source), tree_digest(target), f'{scenario}: files differ after transfer')
+        self.__check_regression(result)
+
+    def __check_regression(self, result: BenchmarkResult):
+        baseline = self.baselines.get(result.scenario)
+        if UPDATE_BASELINE or result.seconds < MIN_CHECK_SECONDS or not baseline:
+            return
+        self.assertGreaterEqual(result.mb_per_second, baseline['mb_per_second'] * (1 - TOLERANCE),
+                                f'{result.scenario}: throughput regressed')
+        self.assertGreaterEqual(result.files_per_second, baseline['files_per_second'] * (1 - TOLERANCE),
+                                f'{result.scenario}: files per second regressed')
+        self.assertLessEqual(result.cpu_seconds_per_gb, baseline['cpu_seconds_per_gb'] * (1 + TOLERANCE),
+                             f'{result.scenario}: CPU per GB regressed')
+        self.assertLessEqual(result.peak_rss_mb, baseline['peak_rss_mb'] * (1 + TOLERANCE),
+                             f'{result.scenario}: peak memory regressed')
+
+    def __wait_for_receiver(self, server: FTT = None):
+        # 发送任务结束时对方可能还在设置文件夹的时间，接收期间对方持有 busy_lock
+        with (server or self.server).busy_lock:
+            pass
+
+    def __send(self, path: Path, client: FTT = None, server: FTT = None):
+        (client or self.client).execute(str(path))
+        (client or self.client).wait_for_jobs()
+        self.__wait_for_receiver(server)
+
+    def __force_sync(self, local: Path, target: Path):
+        self.client.execute(f'fsync "{local}" "{target}"')
+        self.__wait_for_receiver()
+
+    def __send_folder(self, scenario: str, name: str, send=None, **options):
+        """
+        @param send: 发送文件夹的方式，默认由 self.client 发送
+        @param options: 发送期间 self.client 的设置，如 compress、verify、auto_tune
+        """
+        source, files, size = self.datasets[name]
+        target = Path(self.recv_dir, name)
+        saved = {option: getattr(self.client, option) for option in options}
+        for option, value in options.items():
+            setattr(self.client, option, value)
+        try:
+            self.__run(scenario, files, size, lambda: (send or self.__send)(source),
+                       lambda: shutil.rmtree(target, ignore_errors=True), source, target)
+        finally:
+            for option, value in saved.items():
+                setattr(self.client, option, value)
+
+    def __send_and_drop(self, source: Path):
+        """
+        对方开始写入文件后断开一个数据连接，发送方重新连接后继续发送
+        """
+        self.client.execute(str(source))
+        wait_for_file_data(Path(self.recv_dir, source.name))
+        drop_connection(self.client.connections[1])
+        self.client.wait_for_jobs()
+        self.__wait_for_receiver()
+
+    def test_01_folder_tiny(self):
+        self.__send_folder('folder-tiny', 'tiny')
+
+    def test_02_folder_mixed(self):
+        self.__send_folder('folder-mixed', 'mixed')
+
+    def test_03_folder_huge(self):
+        self.__send_folder('folder-huge', 'huge')
+
+    def test_04_folder_deep(self):
+        self.__send_folder('folder-deep', 'deep')
+
+    def test_05_folder_random(self):
+        self.__send_folder('folder-random', 'random')
+
+    def test_06_folder_compressible(self):
+        self.__send_folder('folder-compressible', 'compressible', compress=True)
+
+    def test_07_single_file(self):
+        source, _, _ = self.datasets['huge']
+        file = max((path for path in source.rglob('*') if path.is_file()), key=lambda path: path.stat().st_size)
+        target = Path(self.recv_dir, 'single', file.name)
+        self.server.execute(f'setbase {target.parent}')
+        try:
+            self.__run('single-file', 1, file.stat().st_size, lambda: self.__send(file),
+                       lambda: target.unlink(missing_ok=True))
+        finally:
+            self.server.execute(f'setbase {self.recv_dir}')
+        self.assertEqual(tree_digest(file.parent).get(file.name), tree_digest(target.parent).get(file.name))
+
+    def __compare(self, source: Path, target: Path) -> list[str]:
+        """
+        @return: 比较结果中哈希值不一致的文件，没有时为 ['None']
+        """
+        shutil.rmtree(self.client.cache_dir, ignore_errors=True)
+        with contextlib.redirect_stdout(output := io.StringIO()), patch('builtins.input', return_value='y'):
+            self.client.execute(f'compare "{source}" "{target}"')
+        lines = output.getvalue().splitlines()
+        start = next(index for index, line in enumerate(lines) if line.startswith('hash not matching'))
+        return [line.strip() for line in lines[start + 1:] if line.startswith('\t')]
+
+    def test_08_compare(self):
+        source, files, size = self.datasets['mixed']
+        target = Path(self.recv_dir, 'mixed')
+        # 每次比较前清除哈希缓存，使双方都重新计算哈希
+        self.__run('compare', files, size, lambda: self.client.execute(f'compare "{source}" "{target}"'),
+                   lambda: shutil.rmtree(self.client.cache_dir, ignore_errors=True))
+        self.assertEqual(['None'], self.__compare(source, target))
+        # 大小不变只修改末尾的文件由完整的哈希值发现
+        modified = max((path for path in target.rglob('*') if path.is_file()), key=lambda path: path.stat().st_size)
+        with open(modified, 'r+b') as fp:
+            fp.seek(-1, os.SEEK_END)
+            last = fp.read(1)
+            fp.seek(-1, os.SEEK_END)
+            fp.write(bytes([last[0] ^ 0xff]))
+        try:
+            self.assertEqual([modified.relative_to(target).as_posix()], self.__compare(source, target))
+        finally:
+            shutil.copy2(Path(source, modified.relative_to(target)), modified)
+
+    def test_09_fsync(self):
+        source, files, size = self.datasets['mixed']
+        # 修改本地副本中的部分文件，使强制同步需要发送差异；每次执行前恢复对方的文件夹
+        local, target = Path(self.work_dir, 'fsync'), Path(self.recv_dir, 'mixed')
+        shutil.copytree(source, local, dirs_exist_ok=True)
+        for path in sorted(path for path in local.rglob('*') if path.is_file())[::10]:
+            with open(path, 'ab') as fp:
+                fp.write(os.urandom(1024))
+        self.__run('fsync', files, size, lambda: self.__force_sync(local, target),
+                   lambda: shutil.copytree(source, target, dirs_exist_ok=True), local, target)
+
+    def test_10_single_node_copy(self):
+        source, files, size = self.datasets['mixed']
+        target = Path(self.work_dir, 'copy')
+
+        def reset():
+            shutil.rmtree(target, ignore_errors=True)
+            target.mkdir()
+
+        self.__run('single-node-cp', files, size, lambda: self.single_node.execute(f'cp "{source}" "{target}"'),
+                   reset, source, target)
+
+    def test_11_folder_plain(self):
+        self.__send_folder('folder-plain', 'mixed',
+                           lambda source: self.__send(source, self.plain_client, self.plain_server))
+
+    def test_12_folder_verify(self):
+        self.__send_folder('folder-verify', 'mixed', verify=True)
+
+    def test_13_folder_reconnect(self):
+        self.__send_folder('folder-reconnect', 'mixed', self.__send_and_drop)
+
+    def test_14_folder_auto_tune(self):
+        self.__send_folder('folder-auto-tune', 'huge', auto_tune=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+单节点模式的本地拷贝：检查各拷贝方式出错时的回退，以及多线程并行拷贝大文件各区间后的内容
+
+运行: cd src/test && python -m unittest test_copier
+"""
+import contextlib
+import errno
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import copier
+from copier import CopyEngine
+from constants import STRIPE_FILE_SIZE_THRESHOLD
+from ftt_sn import FTTSn
+from tools import create_random_file, tree_digest
+
+THREADS = 4
+# 超过条带化阈值的大文件按线程数切分为多个区间并行拷贝，末尾不对齐
+LARGE_FILE_SIZE = (1 << STRIPE_FILE_SIZE_THRESHOLD) * THREADS + 12345
+SMALL_FILE_SIZE = 1024 * 1024 + 123
+
+
+def failing(error_number: int):
+    """
+    @return: 总是以该错误码失败的函数，记录调用次数
+    """
+
+    def func(*_):
+        func.calls += 1
+        raise OSError(error_number, os.strerror(error_number))
+
+    func.calls = 0
+    return func
+
+
+class CopyEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = Path(tempfile.mkdtemp(prefix='ftt_copier_'))
+        self.source = Path(self.work_dir, 'source.bin')
+        create_random_file(self.source, SMALL_FILE_SIZE)
+        self.engine = CopyEngine()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def __copy(self, name: str):
+        target = Path(self.work_dir, name)
+        self.engine.copy_file(str(self.source), str(target), SMALL_FILE_SIZE)
+        self.assertEqual(self.source.read_bytes(), target.read_bytes())
+
+    def test_fall_back_for_one_call(self):
+        # EINVAL 只使本次调用改用下一种方式，之后的文件仍尝试该方式
+        copy_file_range = failing(errno.EINVAL)
+        with patch.object(copier.os, 'copy_file_range', copy_file_range, create=True), \
+                patch.object(copier.fcntl, 'ioctl', failing(errno.EINVAL)):
+            self.__copy('first.bin')
+            self.__copy('second.bin')
+        self.assertEqual(2, copy_file_range.calls)
+
+    def test_disable_unsupported(self):
+        copy_file_range = failing(errno.ENOSYS)
+        with patch.object(copier.os, 'copy_file_range', copy_file_range, create=True), \
+                patch.object(copier.fcntl, 'ioctl', failing(errno.EOPNOTSUPP)):
+            self.__copy('first.bin')
+            self.__copy('second.bin')
+        self.assertEqual(1, copy_file_range.calls)
+
+    def test_raise_other_errors(self):
+        with patch.object(copier.os, 'copy_file_range', failing(errno.EBADF), create=True), \
+                patch.object(copier.fcntl, 'ioctl', failing(errno.EOPNOTSUPP)), \
+                self.assertRaises(OSError) as context:
+            self.engine.copy_file(str(self.source), str(Path(self.work_dir, 'target.bin')), SMALL_FILE_SIZE)
+        self.assertEqual(errno.EBADF, context.exception.errno)
+
+
+class SingleNodeCopyTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = Path(tempfile.mkdtemp(prefix='ftt_single_node_'))
+        cls.source = Path(cls.work_dir, 'source')
+        cls.source.mkdir()
+        create_random_file(Path(cls.source, 'large.bin'), LARGE_FILE_SIZE)
+        create_random_file(Path(cls.source, 'small.bin'), SMALL_FILE_SIZE)
+        cls.redirect = contextlib.ExitStack()
+        output = cls.redirect.enter_context(open(Path(cls.work_dir, 'copy.log'), 'w', encoding='utf-8'))
+        cls.redirect.enter_context(contextlib.redirect_stdout(output))
+        cls.redirect.enter_context(contextlib.redirect_stderr(output))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.redirect.close()
+        shutil.rmtree(cls.work_dir, ignore_errors=True)
+
+    def __copy(self, name: str):
+        # 每次使用新的实例，停用的拷贝方式不影响其他测试
+        single_node = FTTSn(THREADS)
+        single_node._boot()
+        target = Path(self.work_dir, name)
+        target.mkdir()
+        single_node.execute(f'cp "{self.source}" "{target}"')
+        single_node.executor.shutdown()
+        self.assertEqual(tree_digest(self.source), tree_digest(target))
+
+    def test_copy(self):
+        self.__copy('kernel')
+
+    def test_copy_without_kernel(self):
+        # 内核拷贝方式均不被支持时以缓冲区读写拷贝各区间
+        with patch.object(copier.os, 'copy_file_range', failing(errno.ENOSYS), create=True), \
+                patch.object(copier.os, 'sendfile', failing(errno.ENOSYS), create=True), \
+                patch.object(copier.fcntl, 'ioctl', failing(errno.EOPNOTSUPP)):
+            self.__copy('buffer')
+
+
+if __name__ == '__main__':
+    unittest.main()
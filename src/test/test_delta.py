@@ -0,0 +1,153 @@
+"""
+大文件的差量同步：直接检查 delta 模块生成的文件及发送的数据量，并在同一进程中通过回环地址连接 FTC 与 FTS，
+强制同步原地修改、追加及截断后的大文件，检查对方的文件与本地一致，本地文件无法读取时对方保留旧文件
+
+运行: cd src/test && python -m unittest test_delta
+"""
+import builtins
+import contextlib
+import io
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch, Mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import ftc
+from delta import send_signatures, send_delta, recv_delta, delta_block_size
+from constants import DELTA_SYNC_SIZE_THRESHOLD
+from tools import tree_digest, connect_peers
+from utils import ESocket, ThreadWithResult
+
+PASSWORD = 'delta'
+THREADS = 2
+# 双方都不小于差量同步阈值的文件才只发送差异
+FILE_SIZE = (1 << DELTA_SYNC_SIZE_THRESHOLD) + 1024 * 1024 * 4
+UNIT_SIZE = 1024 * 1024
+# 等待对方接收完成的最长时间(秒)
+RECV_TIMEOUT = 60
+
+
+def modify(data: bytes, offset: int, size: int) -> bytes:
+    return data[:offset] + os.urandom(size) + data[offset + size:]
+
+
+def sync(old: bytes, new: bytes) -> tuple[bytes | None, int]:
+    """
+    由 old 及差量生成 new
+
+    @return: 接收方生成的文件，发送的新数据大小
+    """
+    left, right = socket.socketpair()
+    receiver, sender = ESocket(left), ESocket(right)
+    old_fp, new_fp = io.BytesIO(old), io.BytesIO()
+
+    def receive():
+        send_signatures(receiver, old_fp, len(old))
+        return recv_delta(receiver, old_fp, new_fp)
+
+    receiving = ThreadWithResult(receive)
+    receiving.start()
+    try:
+        sent_size = send_delta(sender, io.BytesIO(new), Mock())
+        return new_fp.getvalue() if receiving.get_result() else None, sent_size
+    finally:
+        receiver.close()
+        sender.close()
+
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.old = os.urandom(UNIT_SIZE)
+        self.block_size = delta_block_size(UNIT_SIZE)
+
+    def test_identical(self):
+        self.assertEqual((self.old, 0), sync(self.old, self.old))
+
+    def test_modified_in_place(self):
+        new = modify(self.old, self.block_size * 3 + 100, 10)
+        self.assertEqual((new, self.block_size), sync(self.old, new))
+
+    def test_appended(self):
+        new = self.old + os.urandom(1000)
+        self.assertEqual((new, 1000), sync(self.old, new))
+
+    def test_truncated(self):
+        new = self.old[:self.block_size * 5 + 1000]
+        # 截断处的不完整块与旧文件中的块不同
+        self.assertEqual((new, 1000), sync(self.old, new))
+
+    def test_inserted(self):
+        # 插入数据后的块全部错位，只能复用插入位置之前的块
+        new = self.old[:self.block_size] + b'x' + self.old[self.block_size:]
+        self.assertEqual((new, len(new) - self.block_size), sync(self.old, new))
+
+
+class DeltaSyncTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = Path(tempfile.mkdtemp(prefix='ftt_delta_'))
+        cls.local = Path(cls.work_dir, 'local')
+        cls.local.mkdir()
+        cls.recv_dir = Path(cls.work_dir, 'recv')
+        cls.target = Path(cls.recv_dir, 'sync')
+        cls.target.mkdir(parents=True)
+        cls.redirect = contextlib.ExitStack()
+        output = cls.redirect.enter_context(open(Path(cls.work_dir, 'delta.log'), 'w', encoding='utf-8'))
+        cls.redirect.enter_context(contextlib.redirect_stdout(output))
+        cls.redirect.enter_context(contextlib.redirect_stderr(output))
+        cls.server, cls.client = connect_peers(PASSWORD, cls.recv_dir, Path(cls.work_dir, 'client'), THREADS)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.redirect.close()
+        shutil.rmtree(cls.work_dir, ignore_errors=True)
+
+    def __create(self, name: str, old: bytes, new: bytes):
+        Path(self.target, name).write_bytes(old)
+        Path(self.local, name).write_bytes(new)
+        # 大小相同的文件按修改时间判断是否需要同步
+        mtime = os.stat(Path(self.local, name)).st_mtime - 3600
+        os.utime(Path(self.target, name), (mtime, mtime))
+
+    def test_force_sync(self):
+        old = os.urandom(FILE_SIZE)
+        self.__create('modified.bin', old, modify(old, FILE_SIZE // 2, 4096))
+        self.__create('appended.bin', old, old + os.urandom(1024 * 1024))
+        self.__create('truncated.bin', old, old[:FILE_SIZE - 1024 * 1024 - 100])
+        self.__create('aborted.bin', old, modify(old, 0, 4096))
+        unreadable = str(Path(self.local, 'aborted.bin'))
+        sent_sizes = []
+
+        def open_source(file, *args, **kwargs):
+            if str(file) == unreadable:
+                raise PermissionError(f'Permission denied: {file}')
+            return original_open(file, *args, **kwargs)
+
+        def record_delta(conn, fp, pbar):
+            sent_sizes.append(original_send_delta(conn, fp, pbar))
+            return sent_sizes[-1]
+
+        original_open, original_send_delta = builtins.open, ftc.send_delta
+        with patch('builtins.input', return_value='y'), patch.object(ftc, 'send_delta', record_delta), \
+                patch('builtins.open', open_source):
+            self.client.execute(f'fsync "{self.local}" "{self.target}"')
+            self.assertTrue(self.server.busy_lock.acquire(timeout=RECV_TIMEOUT), 'Receiving did not finish')
+            self.server.busy_lock.release()
+        # 三个可读的文件都只发送了差异
+        self.assertEqual(3, len(sent_sizes))
+        self.assertLess(sum(sent_sizes), FILE_SIZE)
+        local, peer = tree_digest(self.local), tree_digest(self.target)
+        for name in 'modified.bin', 'appended.bin', 'truncated.bin':
+            self.assertEqual(local[name], peer[name], name)
+        self.assertEqual(old, Path(self.target, 'aborted.bin').read_bytes())
+        self.assertEqual([], list(self.target.glob('*.ftsdelta')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+"""
+主连接上的多路流：通过 socketpair 连接两端的复用器，检查流在对方关闭、超时及窗口耗尽时的收发
+
+运行: cd src/test && python -m unittest test_mux
+"""
+import os
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from mux import Multiplexer, MUX_FRAME_SIZE, MUX_WINDOW_SIZE
+from utils import ESocket, ConnectionDisappearedError, ThreadWithResult
+
+# 超过接收窗口的数据量，对方不读取时发送方必然等待归还窗口
+DATA_SIZE = (1 << MUX_WINDOW_SIZE) * 2
+# 等待收发结束的最长时间(秒)
+WAIT_TIMEOUT = 10
+
+
+class MultiplexerTest(unittest.TestCase):
+    def setUp(self):
+        left, right = socket.socketpair()
+        self.local, self.peer = Multiplexer(ESocket(left)), Multiplexer(ESocket(right))
+        self.stream = self.local.open_stream()
+        self.peer_stream = self.peer.accept_stream()
+
+    def tearDown(self):
+        self.local.close()
+        self.peer.close()
+
+    def __send(self, data) -> tuple[threading.Thread, list[Exception]]:
+        """
+        在另一个线程中发送数据
+
+        @return: 发送线程，发送出错时记录异常的列表
+        """
+        errors = []
+
+        def sendall():
+            try:
+                self.stream.sendall(data)
+            except Exception as error:
+                errors.append(error)
+
+        sending = threading.Thread(target=sendall, daemon=True)
+        sending.start()
+        return sending, errors
+
+    def test_send_and_receive(self):
+        data = os.urandom(DATA_SIZE)
+        sending, errors = self.__send(data)
+        self.assertEqual(data, self.peer_stream.recv_data(DATA_SIZE))
+        sending.join(WAIT_TIMEOUT)
+        self.assertEqual([], errors)
+
+    def test_peer_close_while_waiting_for_credit(self):
+        # 对方读取部分数据后关闭流，等待窗口的发送方随即出错而不是一直阻塞
+        sending, errors = self.__send(os.urandom(DATA_SIZE))
+        self.peer_stream.recv_data(1 << MUX_FRAME_SIZE)
+        self.peer_stream.close()
+        sending.join(WAIT_TIMEOUT)
+        self.assertFalse(sending.is_alive(), 'Sending did not finish after the peer closed the stream')
+        self.assertIsInstance(errors[0], ConnectionDisappearedError)
+
+    def test_data_for_closed_stream(self):
+        # 对方尚未收到关闭帧时发送的数据被丢弃，窗口仍然归还，发送不会阻塞
+        self.peer.remove(self.peer_stream)
+        sending, errors = self.__send(os.urandom(DATA_SIZE))
+        sending.join(WAIT_TIMEOUT)
+        self.assertFalse(sending.is_alive(), 'Credit for discarded data was not returned')
+        self.assertEqual([], errors)
+
+    def test_send_timeout(self):
+        self.stream.settimeout(0.5)
+        with self.assertRaises(TimeoutError):
+            self.stream.sendall(os.urandom(DATA_SIZE))
+
+    def test_sendfile(self):
+        data = os.urandom(DATA_SIZE)
+        with tempfile.TemporaryFile() as file:
+            file.write(data)
+            file.flush()
+            receiving = ThreadWithResult(self.peer_stream.recv_data, (DATA_SIZE - 1000,))
+            receiving.start()
+            self.assertEqual(DATA_SIZE - 1000, self.stream.sendfile(file, 1000, DATA_SIZE))
+            self.assertEqual(data[1000:], receiving.get_result())
+
+
+if __name__ == '__main__':
+    unittest.main()
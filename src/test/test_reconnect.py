@@ -0,0 +1,90 @@
+"""
+数据连接在传输过程中断开后重新连接：在同一进程中通过回环地址连接 FTC 与 FTS，发送文件夹期间断开一个数据连接，
+检查发送任务能够结束且对方收到的文件内容完整
+
+运行: cd src/test && python -m unittest test_reconnect
+"""
+import contextlib
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from tools import create_random_file, tree_digest, connect_peers, drop_connection, wait_for_file_data
+
+PASSWORD = 'reconnect'
+THREADS = 4
+FILE_COUNT = 6
+FILE_SIZE = 1024 * 1024 * 64
+# 等待发送任务结束的最长时间(秒)，超时说明重新连接后传输无法继续
+JOB_TIMEOUT = 120
+
+
+class ReconnectTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = Path(tempfile.mkdtemp(prefix='ftt_reconnect_'))
+        cls.source = Path(cls.work_dir, 'source')
+        cls.source.mkdir()
+        for index in range(FILE_COUNT):
+            create_random_file(Path(cls.source, f'big{index}.bin'), FILE_SIZE)
+        # 只有一个文件，其余连接没有文件可发送
+        cls.single = Path(cls.work_dir, 'single')
+        cls.single.mkdir()
+        create_random_file(Path(cls.single, 'small.bin'), 1024 * 16)
+        cls.recv_dir = Path(cls.work_dir, 'recv')
+        cls.recv_dir.mkdir()
+        cls.redirect = contextlib.ExitStack()
+        output = cls.redirect.enter_context(open(Path(cls.work_dir, 'reconnect.log'), 'w', encoding='utf-8'))
+        cls.redirect.enter_context(contextlib.redirect_stdout(output))
+        cls.redirect.enter_context(contextlib.redirect_stderr(output))
+        cls.server, cls.client = connect_peers(PASSWORD, cls.recv_dir, Path(cls.work_dir, 'client'), THREADS)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.redirect.close()
+        shutil.rmtree(cls.work_dir, ignore_errors=True)
+
+    def __send(self, source: Path, drop_peer=None):
+        """
+        发送文件夹并比较对方收到的内容
+
+        @param drop_peer: 对方开始写入文件后，由这一方断开第二个数据连接
+        """
+        target = Path(self.recv_dir, source.name)
+        shutil.rmtree(target, ignore_errors=True)
+        with patch('builtins.input', return_value='y'):
+            self.client.execute(str(source))
+            if drop_peer:
+                wait_for_file_data(target)
+                time.sleep(0.2)
+                drop_connection(drop_peer.connections[1])
+            waiting = threading.Thread(target=self.client.wait_for_jobs, daemon=True)
+            waiting.start()
+            waiting.join(JOB_TIMEOUT)
+        self.assertFalse(waiting.is_alive(), 'Sending did not finish after reconnecting')
+        # 发送任务结束时对方可能还在设置文件夹的时间，接收期间对方持有 busy_lock
+        self.assertTrue(self.server.busy_lock.acquire(timeout=JOB_TIMEOUT), 'Receiving did not finish')
+        self.server.busy_lock.release()
+        self.assertEqual(tree_digest(source), tree_digest(target))
+
+    def test_drop_on_sender(self):
+        self.__send(self.source, self.client)
+
+    def test_drop_on_receiver(self):
+        self.__send(self.source, self.server)
+
+    def test_drop_while_idle(self):
+        # 两次发送之间断开的连接到下次发送时才被发现，没有文件可发送的连接只需在新连接上发送结束标记
+        self.__send(self.single)
+        drop_connection(self.client.connections[1])
+        self.__send(self.single)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+"""
+多连接测速：通过 socketpair 连接发起方与响应方，检查各阶段的结果及导出的 JSON
+
+运行: cd src/test && python -m unittest test_speedtest
+"""
+import json
+import socket
+import sys
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from speedtest import SpeedTest, SpeedTestResult, split_size
+from utils import ESocket
+
+CONNECTIONS = 4
+DATA_SIZE = 1000 * 1000 * 8
+# 等待测速结束的最长时间(秒)
+TEST_TIMEOUT = 30
+
+
+class SpeedTestTest(unittest.TestCase):
+    def setUp(self):
+        pairs = [socket.socketpair() for _ in range(CONNECTIONS)]
+        self.local = [ESocket(left) for left, _ in pairs]
+        self.peer = [ESocket(right) for _, right in pairs]
+        self.executors = ThreadPoolExecutor(CONNECTIONS), ThreadPoolExecutor(CONNECTIONS)
+
+    def tearDown(self):
+        for executor in self.executors:
+            executor.shutdown(wait=False)
+        for conn in self.local + self.peer:
+            conn.close()
+
+    def __run(self, data_size: int) -> SpeedTestResult:
+        """
+        在另一个线程中响应测速，发起方在对方响应结束后取得其记录的接收时刻
+        """
+        responder = SpeedTest(self.peer, self.executors[1], data_size)
+        timings, result = {}, []
+        responding = threading.Thread(target=lambda: timings.update(responder.respond()), daemon=True)
+        responding.start()
+
+        def peer_timings() -> dict:
+            responding.join()
+            return timings
+
+        speedtest = SpeedTest(self.local, self.executors[0], data_size)
+        running = threading.Thread(target=lambda: result.append(speedtest.run(peer_timings=peer_timings)),
+                                   daemon=True)
+        running.start()
+        running.join(TEST_TIMEOUT)
+        self.assertFalse(running.is_alive(), 'Speed test did not finish')
+        return result[0]
+
+    def test_run(self):
+        result = self.__run(DATA_SIZE)
+        self.assertEqual(CONNECTIONS, result.connections)
+        self.assertEqual(DATA_SIZE, result.size)
+        self.assertEqual(list(range(1, CONNECTIONS + 1)), [stream.stream for stream in result.streams])
+        for stream in result.streams:
+            for value in (stream.rtt, stream.upload, stream.download,
+                          stream.bidirectional_upload, stream.bidirectional_download):
+                self.assertGreater(value, 0)
+        self.assertTrue(0 < result.rtt_min <= result.rtt_avg <= result.rtt_max)
+        self.assertGreater(result.upload, 0)
+        self.assertGreater(result.download, 0)
+        data = json.loads(json.dumps(result.to_dict()))
+        self.assertEqual(CONNECTIONS, len(data['streams']))
+        self.assertEqual(result.upload, data['upload'])
+        self.assertEqual(result.streams[0].download, data['streams'][0]['download'])
+
+    def test_fewer_bytes_than_connections(self):
+        # 数据量少于连接数时只使用部分连接，不会有连接一直等待首个字节
+        self.assertEqual([1, 1, 0, 0], split_size(2, CONNECTIONS))
+        result = self.__run(2)
+        self.assertEqual(2, result.connections)
+        self.assertEqual(2, len(result.streams))
+
+    def test_invalid_size(self):
+        with self.assertRaises(ValueError):
+            SpeedTest(self.local, self.executors[0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
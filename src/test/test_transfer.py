@@ -0,0 +1,149 @@
+"""
+文件数据的发送路径：在同一进程中通过回环地址连接 FTC 与 FTS，检查各类文件实际使用的发送方式及对方收到的内容
+
+运行: cd src/test && python -m unittest test_transfer
+"""
+import contextlib
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from tools import ContentSource, create_random_file, tree_digest, connect_peers
+from utils import ESocket, MacSocket, ThreadWithResult, ktls_send_enabled
+
+PASSWORD = 'transfer'
+THREADS = 2
+FILE_SIZE = 1024 * 1024 * 8
+# 等待对方接收完成的最长时间(秒)
+RECV_TIMEOUT = 60
+
+
+class TransferTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = Path(tempfile.mkdtemp(prefix='ftt_transfer_'))
+        cls.source = Path(cls.work_dir, 'source')
+        cls.source.mkdir()
+        # 压缩文件及随机数据不值得压缩，文本可以压缩
+        create_random_file(Path(cls.source, 'archive.zip'), FILE_SIZE)
+        create_random_file(Path(cls.source, 'random.bin'), FILE_SIZE)
+        with open(Path(cls.source, 'text.txt'), 'wb') as fp:
+            ContentSource('text', random.Random(0)).write(fp, FILE_SIZE)
+        cls.recv_dir = Path(cls.work_dir, 'recv')
+        cls.recv_dir.mkdir()
+        cls.redirect = contextlib.ExitStack()
+        output = cls.redirect.enter_context(open(Path(cls.work_dir, 'transfer.log'), 'w', encoding='utf-8'))
+        cls.redirect.enter_context(contextlib.redirect_stdout(output))
+        cls.redirect.enter_context(contextlib.redirect_stderr(output))
+        cls.server, cls.client = connect_peers(PASSWORD, cls.recv_dir, Path(cls.work_dir, 'client'), THREADS)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.redirect.close()
+        shutil.rmtree(cls.work_dir, ignore_errors=True)
+
+    def __send(self) -> list[str]:
+        """
+        发送文件夹并比较对方收到的内容
+
+        @return: 通过 sendfile 发送的文件名
+        """
+        target = Path(self.recv_dir, self.source.name)
+        shutil.rmtree(target, ignore_errors=True)
+        sent = []
+
+        def sendfile(conn, file, offset=0, count=None):
+            sent.append(Path(file.name).name)
+            return original(conn, file, offset, count)
+
+        original = ESocket.sendfile
+        with patch.object(ESocket, 'sendfile', sendfile), patch('builtins.input', return_value='y'):
+            self.client.execute(str(self.source))
+            self.client.wait_for_jobs()
+        # 发送任务结束时对方可能还在设置文件夹的时间，接收期间对方持有 busy_lock
+        self.assertTrue(self.server.busy_lock.acquire(timeout=RECV_TIMEOUT), 'Receiving did not finish')
+        self.server.busy_lock.release()
+        self.assertEqual(tree_digest(self.source), tree_digest(target))
+        return sent
+
+    def test_sendfile(self):
+        self.assertEqual({'archive.zip', 'random.bin', 'text.txt'}, set(self.__send()))
+
+    def test_sendfile_with_compress(self):
+        if not self.client.codec:
+            self.skipTest('No compression codec available')
+        self.client.compress = True
+        try:
+            sent = set(self.__send())
+        finally:
+            self.client.compress = False
+        # 不值得压缩的数据仍由 sendfile 直接发送，压缩的数据经过缓冲区
+        self.assertEqual({'archive.zip', 'random.bin'}, sent)
+
+
+class MacSocketTest(unittest.TestCase):
+    """
+    未加密数据连接上 sendfile 发送的字节与摘要一致
+    """
+
+    def setUp(self):
+        left, right = socket.socketpair()
+        self.sender, self.receiver = MacSocket(left, b'a' * 16, b'b' * 16), MacSocket(right, b'b' * 16, b'a' * 16)
+        self.file = tempfile.TemporaryFile()
+        self.data = os.urandom(FILE_SIZE // 4)
+        self.file.write(self.data)
+        self.file.flush()
+
+    def tearDown(self):
+        self.file.close()
+        self.sender.close()
+        self.receiver.close()
+
+    def __send(self, offset: int, count: int) -> tuple[int, bytes]:
+        """
+        对方在另一个线程中接收数据并校验摘要，避免发送填满套接字缓冲区后阻塞
+
+        @return: sendfile 返回的字节数，对方收到的数据
+        """
+        expected = max(0, min(count, len(self.data) - offset))
+        receiving = ThreadWithResult(lambda: (self.receiver.recv_data(expected), self.receiver.check_mac()))
+        receiving.start()
+        sent = self.sender.sendfile(self.file, offset, count)
+        self.sender.send_mac()
+        return sent, receiving.get_result()[0]
+
+    def test_sendfile(self):
+        sent, received = self.__send(4097, 1024 * 1024)
+        self.assertEqual(1024 * 1024, sent)
+        self.assertEqual(self.data[4097:4097 + sent], received)
+
+    def test_sendfile_beyond_end(self):
+        # 文件比调用方预期的短时只发送实际存在的数据，摘要仍然一致
+        offset = len(self.data) - 1000
+        sent, received = self.__send(offset, 1024 * 1024)
+        self.assertEqual(1000, sent)
+        self.assertEqual(self.data[offset:], received)
+
+    def test_sendfile_truncated(self):
+        self.file.truncate(1024)
+        self.assertEqual(0, self.sender.sendfile(self.file, 4096, 1024))
+
+
+class KtlsTest(unittest.TestCase):
+    def test_not_enabled(self):
+        # 内核未接管加密的连接不能由 os.sendfile 直接发送，否则文件数据将以明文发出
+        with socket.create_server(('127.0.0.1', 0)) as server, \
+                socket.create_connection(server.getsockname()) as conn:
+            self.assertFalse(ktls_send_enabled(conn))
+
+
+if __name__ == '__main__':
+    unittest.main()
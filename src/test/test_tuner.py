@@ -0,0 +1,72 @@
+"""
+数据连接数的自动调整：在吞吐量随连接数增加到饱和点为止的模拟链路上，逐轮检查 ConnectionTuner 选择的连接数
+
+运行: cd src/test && python -m unittest test_tuner
+"""
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from constants import TUNE_HOLD_ROUNDS, MAX_CONNECTIONS
+from tuner import ConnectionTuner
+
+LAN_RTT = 0.001
+WAN_RTT = 0.1
+# 每个连接的吞吐量 (字节/秒)
+CONNECTION_THROUGHPUT = 1024 * 1024 * 10
+HOLD = TUNE_HOLD_ROUNDS - 1
+
+# (名称, 初始连接数, 往返时延, 链路饱和时的连接数, 每轮之后的连接数)
+CASES = [
+    # 低时延链路上每次增加四分之一，越过饱和点后回到最好的连接数，保持后先减少再增加试探
+    ('lan saturation', 8, LAN_RTT, 16,
+     [10, 12, 15, 18, 22, 18] + [18] * HOLD + [14, 18] + [18] * HOLD + [22, 18]),
+    ('lan above saturation', 32, LAN_RTT, 16,
+     [40, 32] + [32] * HOLD + [24, 18, 14, 18] + [18] * HOLD + [22, 18]),
+    # 往返时延未知时按低时延链路调整
+    ('unknown rtt', 8, None, 16, [10, 12, 15, 18, 22, 18]),
+    # 高时延链路上每次成倍增加，减少时仍逐步减少
+    ('wan saturation', 8, WAN_RTT, 16,
+     [16, 32, 16] + [16] * HOLD + [12, 16] + [16] * HOLD + [32, 16]),
+    # 链路始终未饱和时增加到连接数的上限后保持
+    ('wan unsaturated', 4, WAN_RTT, MAX_CONNECTIONS * 2,
+     [8, 16, 32, 64] + [64] * TUNE_HOLD_ROUNDS + [48, 64]),
+    ('single connection', 1, LAN_RTT, 1, [2, 1] + [1] * HOLD + [1] * TUNE_HOLD_ROUNDS + [2, 1]),
+]
+
+
+def simulate(tuner: ConnectionTuner, rtt: float | None, saturation: int, rounds: int) -> list[int]:
+    """
+    @return: 每轮之后的连接数
+    """
+    return [tuner.update(min(tuner.connections, saturation) * CONNECTION_THROUGHPUT, rtt) for _ in range(rounds)]
+
+
+class ConnectionTunerTest(unittest.TestCase):
+    def test_update(self):
+        for name, start, rtt, saturation, expected in CASES:
+            with self.subTest(name):
+                self.assertEqual(expected, simulate(ConnectionTuner(start), rtt, saturation, len(expected)))
+
+    def test_limit(self):
+        # 无法建立更多连接后不再超过现有连接数，最好的连接数也随之降低
+        tuner = ConnectionTuner(8)
+        self.assertEqual([16, 32], simulate(tuner, WAN_RTT, MAX_CONNECTIONS, 2))
+        tuner.limit(20)
+        self.assertEqual(20, tuner.connections)
+        # 达到上限后无法继续增加，保持若干轮后向减少的方向试探
+        self.assertEqual([20] * TUNE_HOLD_ROUNDS + [15, 20],
+                         simulate(tuner, WAN_RTT, MAX_CONNECTIONS, TUNE_HOLD_ROUNDS + 2))
+
+    def test_limit_below_best(self):
+        tuner = ConnectionTuner(16)
+        simulate(tuner, LAN_RTT, 16, 8)
+        tuner.limit(6)
+        self.assertEqual(6, tuner.connections)
+        self.assertTrue(all(count <= 6 for count in simulate(tuner, LAN_RTT, 16, 20)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,14 @@
+import hashlib
+import math
 import os
 import random
+import shutil
+import socket
+import threading
+import time
+from pathlib import Path
+
+import psutil
 
 min_size = 1024 * 5
 max_size = 1024 * 500
@@ -14,3 +23,168 @@ def create_random_file(file_path, file_size=0):
     with open(file_path, 'wb') as file:
         random_data = os.urandom(file_size)
         file.write(random_data)
+
+
+# 基准测试数据集在 scale = 1 时的规模: (文件数, 最小大小, 最大大小, 目录深度, 内容)
+DATASETS = {
+    'tiny': (1000000, 0, 1024, 2, 'random'),
+    'mixed': (20000, 0, 1024 * 1024 * 64, 3, 'random'),
+    'huge': (4, 1024 * 1024 * 1024, 1024 * 1024 * 1024 * 2, 0, 'random'),
+    'deep': (20000, 1024, 1024 * 64, 32, 'random'),
+    'random': (2000, 1024 * 1024, 1024 * 1024 * 4, 1, 'random'),
+    'compressible': (2000, 1024 * 1024, 1024 * 1024 * 4, 1, 'text'),
+}
+# 每个目录中最多的文件数；超过该大小的文件随规模缩小，但不小于该大小
+FILES_PER_FOLDER = 1000
+SCALABLE_FILE_SIZE = 1024 * 1024 * 4
+WORDS = [b'file', b'transfer', b'tools', b'server', b'client', b'socket', b'buffer', b'folder', b'thread',
+         b'connection', b'the', b'of', b'and', b'to', b'in', b'data', b'size', b'time', b'log', b'info']
+
+
+class ContentSource:
+    """
+    按种子生成可复现的文件内容：random 为不可压缩的随机字节，text 为由常见单词组成的可压缩文本
+    """
+    POOL_SIZE = 1024 * 1024 * 4
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, kind: str, rng: random.Random):
+        self.__rng = rng
+        self.__pool = b' '.join(rng.choices(WORDS, k=self.POOL_SIZE // 5))[:self.POOL_SIZE] if kind == 'text' else b''
+
+    def write(self, fp, size: int):
+        for offset in range(0, size, self.CHUNK_SIZE):
+            length = min(self.CHUNK_SIZE, size - offset)
+            if self.__pool:
+                start = self.__rng.randrange(len(self.__pool) - length + 1)
+                fp.write(self.__pool[start:start + length])
+            else:
+                fp.write(self.__rng.randbytes(length))
+
+
+def scale_file_size(size: int, scale: float) -> int:
+    return size if size <= SCALABLE_FILE_SIZE else max(SCALABLE_FILE_SIZE, int(size * min(1.0, scale * 10)))
+
+
+def dataset_folder(root: Path, index: int, depth: int) -> Path:
+    """
+    文件依次分布在第 0 至 depth 层目录中，每层再按序号分组，使每个目录中的文件数不超过 FILES_PER_FOLDER
+    """
+    if not depth:
+        return root
+    levels = [f'level_{level}' for level in range(index % (depth + 1))]
+    return Path(root, *levels, f'group_{index // (FILES_PER_FOLDER * (depth + 1))}')
+
+
+def dataset_marker(root: Path) -> Path:
+    # 记录数据集已生成，放在数据集目录之外以免被一起发送
+    return Path(root.parent, f'{root.name}.dataset')
+
+
+def create_dataset(name: str, root: Path, scale: float = 1.0, seed: int = 0) -> tuple[int, int]:
+    """
+    在 root 下生成指定的数据集，同一规模及种子生成的目录结构及内容相同；已生成时直接返回
+
+    @param scale: 文件数的缩放比例，较大的文件大小也随之缩小
+    @return: 文件数，总大小
+    """
+    if (marker := dataset_marker(root)).exists():
+        count, total = marker.read_text().split()
+        return int(count), int(total)
+    count, min_size, max_size, depth, kind = DATASETS[name]
+    count, min_size, max_size = max(1, int(count * scale)), scale_file_size(min_size, scale), \
+        scale_file_size(max_size, scale)
+    rng = random.Random(f'{name}-{seed}')
+    source, total = ContentSource(kind, rng), 0
+    shutil.rmtree(root, ignore_errors=True)
+    for index in range(count):
+        (folder := dataset_folder(root, index, depth)).mkdir(parents=True, exist_ok=True)
+        # 小文件居多、大文件较少的对数均匀分布
+        size = int(math.exp(rng.uniform(math.log(min_size + 1), math.log(max_size + 1)))) - 1
+        with open(Path(folder, f'file_{index}.bin'), 'wb') as fp:
+            source.write(fp, size)
+        total += size
+    marker.write_text(f'{count} {total}')
+    return count, total
+
+
+def tree_digest(root: Path) -> dict[str, tuple[int, str]]:
+    """
+    @return: 目录下每个文件的相对路径及其大小、摘要
+    """
+    result = {}
+    for folder, _, files in os.walk(root):
+        for name in files:
+            path = Path(folder, name)
+            digest = hashlib.md5()
+            with open(path, 'rb') as fp:
+                while data := fp.read(1024 * 1024):
+                    digest.update(data)
+            result[path.relative_to(root).as_posix()] = path.stat().st_size, digest.hexdigest()
+    return result
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def net_connections(kind: str = 'inet'):
+    """
+    本进程的网络连接，psutil 6.0 起 Process.connections 更名为 net_connections
+    """
+    process = psutil.Process()
+    return process.net_connections(kind) if hasattr(process, 'net_connections') else process.connections(kind)
+
+
+def wait_for_listening(port: int, timeout: float = 10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if any(conn.laddr.port == port and conn.status == psutil.CONN_LISTEN
+               for conn in net_connections(kind='tcp')):
+            return
+        time.sleep(0.05)
+    raise TimeoutError(f'Server did not listen on port {port}')
+
+
+def connect_peers(password: str, recv_dir: Path, send_dir: Path, threads: int, **options):
+    """
+    在同一进程中通过回环地址连接一对 FTT，options 同时用于双方
+
+    @return: 接收方，发送方
+    """
+    from ftt_lib import config
+    from ftt import FTT
+    config.server_port = free_port()
+    server = FTT(password, '', recv_dir, threads, **options)
+    server_thread = threading.Thread(target=server._boot, daemon=True)
+    server_thread.start()
+    wait_for_listening(config.server_port)
+    client = FTT(password, f'127.0.0.1:{config.server_port}', send_dir, threads, **options)
+    client._boot()
+    server_thread.join()
+    return server, client
+
+
+def wait_for_file_data(folder: Path, timeout: float = 30):
+    """
+    等待对方开始在 folder 中写入文件数据，在此之后断开连接可使断开发生在文件传输的中途
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if any(path.stat().st_size for path in folder.rglob('*') if path.is_file()):
+            return
+        time.sleep(0.01)
+    raise TimeoutError(f'No file data was written to {folder}')
+
+
+def drop_connection(conn):
+    """
+    模拟数据连接在传输过程中断开：绕过 TLS 直接关闭底层 TCP 连接的双向传输
+    """
+    try:
+        socket.socket.shutdown(conn._ESocket__conn, socket.SHUT_RDWR)
+    except OSError:
+        # 连接已经断开
+        pass
@@ -0,0 +1,61 @@
+from constants import TUNE_GAIN, TUNE_HOLD_ROUNDS, MAX_CONNECTIONS, HIGH_LATENCY_RTT
+
+
+class ConnectionTuner:
+    """
+    按发送过程中测得的吞吐量调整参与发送的数据连接数：沿一个方向试探，吞吐量明显提升 (减少连接时不明显下降) 则继续，
+    否则回到之前最好的连接数，保持若干轮后再向另一方向试探。高时延链路上每次成倍增加连接，低时延链路上逐步增加
+    """
+
+    def __init__(self, connections: int, limit: int = MAX_CONNECTIONS):
+        self.connections = connections
+        self.__limit = limit
+        self.__best = 0.0
+        self.__best_count = connections
+        # 当前试探的方向：1 为增加，-1 为减少，0 为保持
+        self.__probe = 1
+        self.__next_probe = -1
+        self.__held = 0
+
+    def __step(self, direction: int, rtt: float | None) -> int:
+        if direction > 0 and rtt is not None and rtt >= HIGH_LATENCY_RTT:
+            return self.connections
+        return max(1, self.connections // 4)
+
+    def __move(self, direction: int, rtt: float | None):
+        count = self.connections + direction * self.__step(direction, rtt)
+        count = max(1, min(self.__limit, count))
+        if count == self.connections:
+            self.__probe, self.__held, self.__next_probe = 0, 0, -direction
+            return
+        self.connections, self.__probe = count, direction
+
+    def update(self, throughput: float, rtt: float | None) -> int:
+        """
+        @param throughput: 上一轮的吞吐量 (字节/秒)
+        @param rtt: 数据连接的往返时延(秒)，未知时为 None
+        @return: 下一轮使用的连接数
+        """
+        if self.__probe > 0 and throughput > self.__best * (1 + TUNE_GAIN) or \
+                self.__probe < 0 and throughput >= self.__best * (1 - TUNE_GAIN):
+            # 试探有效，沿同一方向继续
+            self.__best, self.__best_count = max(self.__best, throughput), self.connections
+            self.__move(self.__probe, rtt)
+        elif self.__probe:
+            # 试探无效，回到之前最好的连接数
+            self.connections, self.__next_probe = self.__best_count, -self.__probe
+            self.__probe, self.__held = 0, 0
+        else:
+            # 保持期间以当前吞吐量为基准，以适应链路的变化
+            self.__best, self.__held = throughput, self.__held + 1
+            if self.__held >= TUNE_HOLD_ROUNDS:
+                self.__move(self.__next_probe, rtt)
+        return self.connections
+
+    def limit(self, count: int):
+        """
+        无法建立更多的数据连接时，以现有连接数为上限
+        """
+        self.__limit = count
+        self.connections = min(self.connections, count)
+        self.__best_count = min(self.__best_count, count)
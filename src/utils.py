@@ -1,21 +1,32 @@
-import lzma
+import hmac
+import json
+import mmap
+import multiprocessing
 import re
 import os
-import pickle
+import queue
 import random
 import socket
+import sqlite3
+import ssl
+import struct
 import threading
 import time
+import zlib
 from collections import deque
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from hashlib import md5
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed, wait
+from hashlib import blake2b
 from os import PathLike
 from pathlib import PurePath, Path
 from datetime import datetime
-from typing import TextIO
+from typing import TextIO, Iterable, Iterator
 from tqdm import tqdm
 import pyperclip
 from constants import *
+from manifest import *
+from scanner import *
+from hash_engine import *
 
 # 解决win10的cmd中直接使用转义序列失效问题
 if windows:
@@ -95,7 +106,7 @@ class ESocket:
         return self.__conn.sendfile(file, offset, count)
 
     def send_size(self, size: int):
-        self.__conn.sendall(size_struct.pack(size))
+        self.sendall(size_struct.pack(size))
 
     def recv(self, size=MAX_BUFFER_SIZE):
         size = self.__conn.recv_into(self.__buf, size)
@@ -106,20 +117,58 @@ class ESocket:
     def getpeername(self):
         return self.__conn.getpeername()
 
+    def getsockname(self):
+        return self.__conn.getsockname()
+
     def close(self):
         self.__conn.shutdown(socket.SHUT_RDWR)
         self.__conn.close()
 
+    def abort(self):
+        """
+        以 RST 立即断开连接，对方阻塞中的收发随即出错，不必等到超时才发现连接已失效
+        """
+        try:
+            self.__conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        finally:
+            self.__conn.close()
+
     def settimeout(self, value: float | None):
         self.__conn.settimeout(value)
 
+    def rtt(self) -> float | None:
+        """
+        内核统计的往返时延(秒)，平台不支持时为 None
+        """
+        if not hasattr(socket, 'TCP_INFO'):
+            return None
+        try:
+            info = self.__conn.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, tcp_info_struct.size)
+            return tcp_info_struct.unpack(info)[23] / 1000000
+        except (OSError, ValueError, struct.error):
+            return None
+
+    def recv_into(self, buffer, size: int = 0) -> int:
+        """
+        将数据直接接收到调用方提供的缓冲区中，直到接收满 size 字节
+
+        @param buffer: 可写缓冲区，如 bytearray、memoryview、mmap
+        @param size: 接收的字节数，默认为缓冲区大小
+        @return: 接收的字节数
+        """
+        view = memoryview(buffer)
+        size = size or len(view)
+        received = 0
+        while received < size:
+            recv_size = self.__conn.recv_into(view[received:size])
+            if recv_size == 0:
+                raise ConnectionDisappearedError('Connection Disappeared')
+            received += recv_size
+        return size
+
     def recv_data(self, size: int):
-        # 避免粘包
-        result = bytearray()
-        while size:
-            data, recv_size = self.recv(min(self.MAX_BUFFER_SIZE, size))
-            result += data
-            size -= recv_size
+        # 预先分配好缓冲区，避免粘包及反复拼接
+        self.recv_into(result := bytearray(size))
         return result
 
     def recv_size(self) -> int:
@@ -127,13 +176,39 @@ class ESocket:
 
     def send_data_with_size(self, data: bytes):
         self.send_size(len(data))
-        self.__conn.sendall(data)
+        self.sendall(data)
 
     def send_with_compress(self, data):
-        self.send_data_with_size(lzma.compress(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL), preset=9))
+        self.send_data_with_size(zlib.compress(json.dumps(data).encode(utf8), 1))
 
     def recv_with_decompress(self):
-        return pickle.loads(lzma.decompress(self.recv_data(self.recv_size())))
+        return json.loads(zlib.decompress(self.recv_data(self.recv_size())))
+
+    def send_manifest(self, schema: Struct, records: Iterable[tuple]):
+        """
+        分帧发送文件清单，records 可以是边扫描边产生结果的生成器
+
+        @param schema: 清单字段格式
+        @param records: (文件相对路径, *字段)
+        """
+        encoder = ManifestEncoder(schema)
+        for record in records:
+            encoder.encode(*record)
+            if len(encoder) >= MANIFEST_FRAME_SIZE:
+                self.send_data_with_size(encoder.flush())
+        if len(encoder):
+            self.send_data_with_size(encoder.flush())
+        self.send_size(0)
+
+    def recv_manifest(self, schema: Struct) -> Iterator[tuple]:
+        """
+        逐帧接收并解析文件清单
+
+        @return: (文件相对路径, *字段)
+        """
+        decoder = ManifestDecoder(schema)
+        while frame_size := self.recv_size():
+            yield from decoder.decode(self.recv_data(frame_size))
 
     def recv_head(self) -> tuple[str, str, int]:
         """
@@ -153,13 +228,134 @@ class ESocket:
         @return: 打包后的文件头
         """
         length = len(name := name.encode(utf8))
-        self.__conn.sendall(head_struct.pack(command, size, length))
-        self.__conn.sendall(name)
+        self.sendall(head_struct.pack(command, size, length))
+        self.sendall(name)
+
+    def send_mac(self):
+        """
+        发送截至目前已发送数据的校验码，仅明文数据连接需要
+        """
+        pass
+
+    def check_mac(self):
+        """
+        校验截至目前已接收数据的校验码，仅明文数据连接需要
+        """
+        pass
 
     # def __getattr__(self, name):
     #     return getattr(self.__conn, name)
 
 
+class IntegrityError(ConnectionError):
+    pass
+
+
+class BufferPool:
+    """
+    数量有限的等大缓冲区，用完时取用方等待其他缓冲区归还，以此限制占用的内存并形成背压
+    """
+
+    def __init__(self, count: int, size: int):
+        self.size = size
+        self.__buffers = queue.LifoQueue()
+        self.__slots = threading.Semaphore(count)
+
+    def acquire(self) -> bytearray:
+        self.__slots.acquire()
+        try:
+            return self.__buffers.get_nowait()
+        except queue.Empty:
+            return bytearray(self.size)
+
+    def release(self, buffer: bytearray):
+        self.__buffers.put(buffer)
+        self.__slots.release()
+
+
+# 数据连接断开时可能出现的异常，出现时重新建立数据连接
+CONNECTION_ERRORS = (ConnectionError, TimeoutError, ssl.SSLError)
+
+
+def ktls_send_enabled(conn: ssl.SSLSocket) -> bool:
+    """
+    内核是否已接管该连接发送方向的 TLS 加密；OpenSSL 无法开启 kTLS 时 (如内核未加载 tls 模块、算法不支持)
+    会静默地在用户态加密，只有内核中已设置发送方向的加密参数时才能读取到
+    """
+    try:
+        # 长度只够读取版本及算法，不读取密钥
+        conn.getsockopt(SOL_TLS, TLS_TX, 4)
+        return True
+    except OSError:
+        return False
+
+
+class KtlsSocket(ESocket):
+    """
+    内核已接管发送方向加密的 TLS 数据连接，文件数据由内核直接读取、加密并发送，不经过用户态
+    """
+
+    def __init__(self, conn: ssl.SSLSocket):
+        super().__init__(conn)
+        self.__conn = conn
+
+    def sendfile(self, file, offset=0, count=None):
+        # SSLSocket.sendfile 总是在用户态读取文件后加密发送，这里绕过它直接在套接字上使用 os.sendfile，
+        # 写入的数据由内核作为应用数据记录加密，与 OpenSSL 开启 kTLS 后的 SSL_sendfile 相同
+        return socket.socket.sendfile(self.__conn, file, offset, count)
+
+
+class MacSocket(ESocket):
+    """
+    未加密的数据连接，对双向的所有数据持续计算带密钥的 BLAKE2 摘要，
+    在每个文件(分段)结束时发送/校验截至当时的摘要，以保证数据完整且来自对端
+    """
+    MAC_SIZE = 16
+
+    def __init__(self, conn: socket.socket, send_key: bytes, recv_key: bytes):
+        super().__init__(conn)
+        self.__send_mac = blake2b(key=send_key, digest_size=self.MAC_SIZE)
+        self.__recv_mac = blake2b(key=recv_key, digest_size=self.MAC_SIZE)
+
+    def sendall(self, data):
+        self.__send_mac.update(data)
+        super().sendall(data)
+
+    def sendfile(self, file, offset=0, count=None):
+        # 文件可能已被截短，只发送实际存在的数据
+        available = os.fstat(file.fileno()).st_size - offset
+        count = available if count is None else min(count, available)
+        if count <= 0:
+            return 0
+        # 文件数据由内核直接发送，摘要通过只读映射计算，映射的页会读入用户态但不复制到额外的缓冲区；
+        # 发送后只对实际发出的字节计算摘要
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        with mmap.mmap(file.fileno(), offset + count - start, offset=start, access=mmap.ACCESS_READ) as mm:
+            sent = super().sendfile(file, offset, count)
+            with memoryview(mm)[offset - start:offset - start + sent] as view:
+                self.__send_mac.update(view)
+        return sent
+
+    def recv(self, size=ESocket.MAX_BUFFER_SIZE):
+        data, size = super().recv(size)
+        self.__recv_mac.update(data)
+        return data, size
+
+    def recv_into(self, buffer, size: int = 0) -> int:
+        size = super().recv_into(buffer, size)
+        with memoryview(buffer) as view:
+            self.__recv_mac.update(view[:size])
+        return size
+
+    def send_mac(self):
+        super().sendall(self.__send_mac.digest())
+
+    def check_mac(self):
+        super().recv_into(mac := bytearray(self.MAC_SIZE))
+        if not hmac.compare_digest(mac, self.__recv_mac.digest()):
+            raise IntegrityError('Data integrity check failed')
+
+
 class ThreadWithResult(threading.Thread):
     def __init__(self, func, args=()):
         super(ThreadWithResult, self).__init__()
@@ -175,6 +371,28 @@ class ThreadWithResult(threading.Thread):
         return self.result
 
 
+@contextmanager
+def acquire_within(lock: threading.Lock, timeout: float) -> Iterator[bool]:
+    """
+    在限定时间内获取锁，产出是否获取成功，获取成功时在退出时释放
+    """
+    acquired = lock.acquire(timeout=timeout)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            lock.release()
+
+
+def wait_for_workers(futures: list[Future]):
+    """
+    等待工作线程全部结束，由线程结束事件唤醒，最后一个线程结束时立即返回。
+    分段超时只为主线程在等待期间仍能响应 Ctrl+C (Windows 上无超时的等待无法被中断)
+    """
+    while wait(futures, timeout=1).not_done:
+        pass
+
+
 def send_clipboard(conn: ESocket, logger: Logger, ftc=True):
     # 读取并编码剪切板的内容
     try:
@@ -241,39 +459,17 @@ def get_files_info_relative_to_basedir(base_dir: str, desc_suffix='files', posit
     """
     获取某个目录下所有文件的相对路径和文件大小，并显示进度条
     """
-    result = {}
-    root_abs_path = os.path.abspath(base_dir)
-    queue = deque([(root_abs_path, '.')])
-    processed_paths = set()
-    folders = 0
-    total_size = 0
-
-    # 初始化进度显示
-    pbar = tqdm(desc=f"Collecting {desc_suffix}", unit=" files", position=position, dynamic_ncols=True)
-    while queue:
-        current_abs_path, current_rel_path = queue.popleft()
-        if current_abs_path in processed_paths:
-            continue
-        processed_paths.add(current_abs_path)
-        folders += 1
-        try:
-            with os.scandir(current_abs_path) as it:
-                for entry in it:
-                    entry_rel_path = f"{current_rel_path}/{entry.name}" if current_rel_path != '.' else entry.name
-                    if entry.is_dir(follow_symlinks=False):
-                        queue.append((entry.path, entry_rel_path))
-                    elif entry.is_file(follow_symlinks=False):
-                        size = entry.stat().st_size
-                        result[entry_rel_path] = size
-                        total_size += size
-                        pbar.update(1)
-        except PermissionError:
-            continue
+    return dict(iter_files_info(base_dir, desc_suffix, position))
 
-    # 更新进度条描述
-    pbar.set_postfix(folders=folders, size=get_size(total_size))
-    pbar.close()
-    return result
+
+def iter_files_info(base_dir: str, desc_suffix='files', position=0) -> Iterator[tuple[str, int]]:
+    """
+    逐个产生某个目录下所有文件的相对路径和文件大小，并显示进度条，可以边扫描边发送结果
+
+    @return: (文件相对路径, 文件大小)
+    """
+    for result in scan_tree(base_dir, f"Collecting {desc_suffix}", position):
+        yield from zip(result.names, result.sizes)
 
 
 def format_time(time_interval):
@@ -411,9 +607,9 @@ def format_timestamp(timestamp: float):
 
 class FileHash:
     @staticmethod
-    def _file_digest(file, file_md5, remained_size):
+    def _file_digest(file, file_hash, remained_size):
         """
-        计算文件的MD5值
+        计算文件的哈希值
 
         @param remained_size: 文件剩余需要读取的大小
         @return:
@@ -422,21 +618,21 @@ class FileHash:
             buf = bytearray(buf_size)
             view = memoryview(buf)
             while size := file.readinto(buf):
-                file_md5.update(view[:size])
+                file_hash.update(view[:size])
         else:
-            file_md5.update(file.read())
-        return file_md5.hexdigest()
+            file_hash.update(file.read())
+        return file_hash.hexdigest()
 
     @staticmethod
-    def full_digest(filename):
+    def full_digest(filename, algorithm='md5'):
         with open(filename, 'rb') as fp:
-            return FileHash._file_digest(fp, md5(), os.path.getsize(filename))
+            return FileHash._file_digest(fp, new_hash(algorithm), os.path.getsize(filename))
 
     @staticmethod
-    def fast_digest(filename):
+    def fast_digest(filename, algorithm='md5'):
         file_size = os.path.getsize(filename)
         with open(filename, 'rb') as fp:
-            file_md5 = md5()
+            file_hash = new_hash(algorithm)
             if file_size >> SMALL_FILE_CHUNK_SIZE:
                 tiny_buf = bytearray(32 * KB)
                 tiny_view = memoryview(tiny_buf)
@@ -445,29 +641,120 @@ class FileHash:
                 for offset in range(48):
                     fp.seek(offset * (tail // 48))
                     size = fp.readinto(tiny_buf)
-                    file_md5.update(tiny_view[:size])
+                    file_hash.update(tiny_view[:size])
                 # Read the tail of the file
                 fp.seek(tail)
-                return FileHash._file_digest(fp, file_md5, FILE_TAIL_SIZE)
-            return FileHash._file_digest(fp, file_md5, file_size)
+                return FileHash._file_digest(fp, file_hash, FILE_TAIL_SIZE)
+            return FileHash._file_digest(fp, file_hash, file_size)
 
     @staticmethod
-    def parallel_calc_hash(base_folder, file_rel_paths: list[str], is_fast: bool):
+    def digest_files(base_folder, file_rel_paths: list[str], is_fast: bool, algorithm='md5', cached_entries=None):
+        """
+        计算一批文件的哈希值，stat 与缓存记录一致的文件直接使用缓存的值，可以在子进程中执行
+
+        @param cached_entries: 这批文件在哈希缓存中的记录
+        @return: [(文件相对路径, [大小, 修改时间ns, inode], 哈希值, 是否重新计算)]
+        """
         digest_func = FileHash.fast_digest if is_fast else FileHash.full_digest
+        results = []
+        for rel_path in file_rel_paths:
+            filename = PurePath(base_folder, rel_path)
+            stat = os.stat(filename)
+            key = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+            entry = cached_entries.get(rel_path) if cached_entries else None
+            if entry and entry[:3] == key and (digest_value := entry[3 if is_fast else 4]):
+                results.append((rel_path, key, digest_value, False))
+            else:
+                results.append((rel_path, key, digest_func(filename, algorithm), True))
+        return results
+
+    @staticmethod
+    def parallel_calc_hash(base_folder, file_rel_paths: list[str], is_fast: bool, cache_dir=None, algorithm='md5'):
+        """
+        并行计算文件的哈希值，文件数量很多时按批交给进程池计算，不受 GIL 限制
+
+        @param cache_dir: 哈希缓存所在的文件夹，为空时不使用缓存
+        @param algorithm: 哈希算法
+        """
+        cache = HashCache(cache_dir, base_folder, algorithm) if cache_dir else None
         file_rel_paths = file_rel_paths.copy()
         random.shuffle(file_rel_paths)
+        if len(file_rel_paths) >= HASH_PROCESS_THRESHOLD:
+            batch_size = HASH_BATCH_SIZE
+            methods = multiprocessing.get_all_start_methods()
+            executor = ProcessPoolExecutor(max_workers=cpu_count, mp_context=multiprocessing.get_context(
+                'forkserver' if 'forkserver' in methods else 'spawn'))
+        else:
+            batch_size, executor = 1, ThreadPoolExecutor(max_workers=cpu_count)
         results = {}
-        with ThreadPoolExecutor(max_workers=cpu_count) as executor:
-            future_to_file = {executor.submit(digest_func, PurePath(base_folder, rel_path)): rel_path for rel_path in
-                              file_rel_paths}
-            for future in tqdm(as_completed(future_to_file), total=len(file_rel_paths), unit='files', mininterval=0.2,
-                               desc=f'{"fast" if is_fast else "full"} hash calc', leave=False):
-                filename = future_to_file[future]
-                digest_value = future.result()
-                results[filename] = digest_value
+        with executor, tqdm(total=len(file_rel_paths), unit='files', mininterval=0.2,
+                            desc=f'{"fast" if is_fast else "full"} hash calc', leave=False) as pbar:
+            futures = []
+            for idx in range(0, len(file_rel_paths), batch_size):
+                batch = file_rel_paths[idx:idx + batch_size]
+                futures.append(executor.submit(FileHash.digest_files, base_folder, batch, is_fast, algorithm,
+                                               cache.get_entries(batch) if cache else None))
+            for future in as_completed(futures):
+                batch_results = future.result()
+                for filename, key, digest_value, computed in batch_results:
+                    results[filename] = digest_value
+                    if cache and computed:
+                        cache.put(filename, key, is_fast, digest_value)
+                pbar.update(len(batch_results))
+        if cache:
+            cache.save()
         return results
 
 
+class HashCache:
+    """
+    文件夹的哈希缓存，保存在本地磁盘上，以文件相对路径为键记录 (大小, 修改时间ns, inode, 快速哈希, 完整哈希)，
+    再次比较时只需重新计算 stat 发生变化的文件
+    """
+
+    def __init__(self, cache_dir, base_folder, algorithm='md5'):
+        name = blake2b(os.path.abspath(base_folder).encode(utf8), digest_size=16).hexdigest()
+        self.__cache_file = PurePath(cache_dir, f'{name}_{algorithm}.sqlite')
+        self.__entries: dict[str, list] = {}
+        self.__changed: set[str] = set()
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with closing(sqlite3.connect(self.__cache_file)) as db, db:
+                db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                           'inode INTEGER, fast_hash TEXT, full_hash TEXT)')
+                for path, *entry in db.execute('SELECT * FROM files'):
+                    self.__entries[path] = entry
+        except (OSError, sqlite3.Error) as error:
+            # 缓存损坏或无法访问时不影响比较，重新计算所有哈希值
+            print_color(get_log_msg(f'Failed to load the hash cache {self.__cache_file}, {error}'), LEVEL.WARNING)
+            self.__entries.clear()
+
+    def get_entries(self, rel_paths: list[str]) -> dict[str, list]:
+        return {rel_path: entry for rel_path in rel_paths if (entry := self.__entries.get(rel_path))}
+
+    def put(self, rel_path: str, key: list, is_fast: bool, digest_value: str):
+        """
+        @param key: 计算哈希时文件的 [大小, 修改时间ns, inode]
+        """
+        entry = self.__entries.get(rel_path)
+        if not entry or entry[:3] != key:
+            self.__entries[rel_path] = entry = [*key, None, None]
+        entry[3 if is_fast else 4] = digest_value
+        self.__changed.add(rel_path)
+
+    def save(self):
+        if not self.__changed:
+            return
+        try:
+            with closing(sqlite3.connect(self.__cache_file)) as db, db:
+                db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                               [(path, *self.__entries[path]) for path in self.__changed])
+        except (OSError, sqlite3.Error) as error:
+            # 无法保存时下次比较仍需重新计算这些文件的哈希值
+            print_color(get_log_msg(f'Failed to save the hash cache {self.__cache_file}, {error}'), LEVEL.WARNING)
+        self.__changed.clear()
+
+
 def shorten_path(path: str, max_width: float) -> str:
     return path[:int((max_width - 3) / 3)] + '...' + path[-2 * int((max_width - 3) / 3):] if len(
         path) > max_width else path + ' ' * (int(max_width) - len(path))